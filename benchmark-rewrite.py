@@ -0,0 +1,237 @@
+# Benchmark of the local SQL rewrite rules in test-NLP.py against the regex
+# rule sets they replaced
+import argparse
+import importlib.util
+import logging
+import os
+import re
+import time
+
+# test-NLP.py is not importable by name, so load it from its path
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test-NLP.py")
+spec = importlib.util.spec_from_file_location("test_nlp_script", SCRIPT_PATH)
+nlp = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(nlp)
+
+
+class RewriteRule:
+    """
+    A regex rewrite compiled once at import. `triggers` lists substrings
+    (matched case-insensitively) of which at least one must occur in a query
+    for the pattern to possibly match; None means the rule always runs. An
+    optional `guard` gets the upper-cased query and can rule out a match
+    more cheaply than the regex itself.
+    """
+
+    def __init__(self, pattern, replacement, triggers=None, guard=None):
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.replacement = replacement
+        self.triggers = tuple(trigger.upper() for trigger in triggers) if triggers else None
+        self.guard = guard
+
+
+class RewriteEngine:
+    """
+    Applies an ordered list of RewriteRules to SQL strings.
+
+    The query is upper-cased once and each rule's triggers are checked with
+    plain substring tests, so a query only pays the regex cost of rules whose
+    trigger tokens it contains. Rules run in their original order, and the
+    upper-cased copy is refreshed whenever a rule changes the query, so the
+    result is the same as running every rule in sequence.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def apply(self, query):
+        """
+        :param query: SQL query
+        :return: Query with every applicable rule applied in order
+        """
+        upper = query.upper()
+        for rule in self.rules:
+            triggers = rule.triggers
+            if triggers is not None:
+                for trigger in triggers:
+                    if trigger in upper:
+                        break
+                else:
+                    continue
+                if rule.guard is not None and not rule.guard(upper):
+                    continue
+            query, changed = rule.regex.subn(rule.replacement, query)
+            if changed:
+                upper = query.upper()
+        return query
+
+    def apply_many(self, queries):
+        """
+        :param queries: Iterable of SQL queries
+        :return: List of rewritten queries, in input order
+        """
+        apply = self.apply
+        return [apply(query) for query in queries]
+
+
+# Previous regex rule sets. The token rewriter in test-NLP.py replaced them; they
+# are kept only as the baseline for benchmark_rewrite_engine.
+REGEX_QUICK_FIX_ENGINE = RewriteEngine([
+    # Missing semicolons at the end
+    RewriteRule(r'(?<!\;)$', ';'),
+
+    # Fix quote issues (PostgreSQL uses single quotes for strings, double quotes for identifiers)
+    RewriteRule(r'(?<!")"([^"]*?)"(?!")', r"'\1'", ['"']),  # Replace standalone double quotes with single quotes for strings
+
+    # PostgreSQL specific fixes
+    RewriteRule(r'(?i)\bLIMIT\s+(\d+)\s+OFFSET\s+(\d+)', r'LIMIT \1 OFFSET \2', ['OFFSET']),  # Ensure proper LIMIT OFFSET syntax
+    RewriteRule(r'(?i)\bILIKE\b', 'ILIKE', ['ILIKE']),  # Preserve ILIKE operator (PostgreSQL specific)
+    RewriteRule(r'(?i)\bTEXT\(\)', 'TEXT', ['TEXT(']),  # Fix TEXT() data type to TEXT
+
+    # Fix common typos
+    RewriteRule(r'\bSELET\b', 'SELECT', ['SELET']),
+    RewriteRule(r'\bFROM\s+FORM\b', 'FROM', ['FORM']),
+    RewriteRule(r'\bWHERE\s+HWERE\b', 'WHERE', ['HWERE']),
+    RewriteRule(r'\bGROUP BY\s+GRUOP BY\b', 'GROUP BY', ['GRUOP']),
+    RewriteRule(r'\bJION\b', 'JOIN', ['JION']),
+    RewriteRule(r'\bINNER JION\b', 'INNER JOIN', ['JION']),
+    RewriteRule(r'\bLEFT JION\b', 'LEFT JOIN', ['JION']),
+
+    # Fix missing spaces
+    RewriteRule(r'(?<=\w)(?=SELECT|FROM|WHERE|GROUP|ORDER|HAVING|JOIN)', ' ',
+                nlp.GLUED_KEYWORDS, guard=nlp.has_glued_keyword),
+
+    # Fix doubled keywords
+    RewriteRule(r'\b(SELECT|FROM|WHERE|GROUP BY|ORDER BY|HAVING)\s+\1\b', r'\1',
+                nlp.DOUBLED_KEYWORDS, guard=nlp.has_doubled_keyword),
+
+    # Replace CONCAT function with PostgreSQL's concatenation operator
+    RewriteRule(r'CONCAT\((.*?),(.*?)\)', r'\1 || \2', ['CONCAT(']),
+
+    # Fix datetime functions to PostgreSQL syntax
+    RewriteRule(r'(?i)DATE_FORMAT\((.*?),\s*[\'"](%[YmdHis])[\'"].*?\)', r'TO_CHAR(\1, \'YYYY-MM-DD\')', ['DATE_FORMAT(']),
+    RewriteRule(r'(?i)NOW\(\)', r'CURRENT_TIMESTAMP', ['NOW()']),
+
+    # Fix incorrect TOP syntax (SQL Server) to LIMIT (PostgreSQL)
+    RewriteRule(r'(?i)SELECT\s+TOP\s+(\d+)', r'SELECT', ['TOP']),  # Remove TOP
+    RewriteRule(r'(?i)SELECT\s+TOP\s+(\d+)(.*?)FROM', r'SELECT\2 FROM', ['TOP']),  # Remove TOP and preserve other parts
+])
+
+TOP_CLAUSE_PATTERN = re.compile(r'(?i)TOP\s+(\d+)')
+
+
+def regex_quick_postgresql_fix(sql_query):
+    """
+    Previous regex implementation of attempt_quick_postgresql_fix (benchmark baseline).
+
+    :param sql_query: Incorrect SQL query string
+    :return: Fixed SQL query string
+    """
+    fixed_query = REGEX_QUICK_FIX_ENGINE.apply(sql_query)
+
+    # Add LIMIT clause at the end if TOP was removed
+    top_match = TOP_CLAUSE_PATTERN.search(sql_query)
+    if top_match and 'LIMIT' not in fixed_query:
+        if ';' in fixed_query:
+            fixed_query = fixed_query[:-1] + f" LIMIT {top_match.group(1)};"
+        else:
+            fixed_query = fixed_query + f" LIMIT {top_match.group(1)};"
+
+    # Balance parentheses
+    open_count = fixed_query.count('(')
+    close_count = fixed_query.count(')')
+    if open_count > close_count:
+        fixed_query += ')' * (open_count - close_count)
+
+    return fixed_query
+
+
+REGEX_COMPATIBILITY_ENGINE = RewriteEngine([
+    # Date functions
+    RewriteRule(r'(?i)GETDATE\(\)', 'CURRENT_DATE', ['GETDATE(']),
+    RewriteRule(r'(?i)CURRENT_TIMESTAMP\(\)', 'CURRENT_TIMESTAMP', ['CURRENT_TIMESTAMP(']),
+
+    # String functions
+    RewriteRule(r'(?i)CHARINDEX\((.*?),(.*?)\)', r'POSITION(\1 IN \2)', ['CHARINDEX(']),
+    RewriteRule(r'(?i)LEN\((.*?)\)', r'LENGTH(\1)', ['LEN(']),
+    RewriteRule(r'(?i)SUBSTRING\((.*?),(.*?),(.*?)\)', r'SUBSTRING(\1 FROM \2 FOR \3)', ['SUBSTRING(']),
+
+    # Concatenation
+    RewriteRule(r'(?i)CONCAT_WS\((.*?),(.*?)\)', r'array_to_string(ARRAY[\2], \1)', ['CONCAT_WS(']),
+
+    # Replace LIMIT n,m syntax (MySQL) with LIMIT m OFFSET n (PostgreSQL)
+    RewriteRule(r'(?i)LIMIT\s+(\d+)\s*,\s*(\d+)', r'LIMIT \2 OFFSET \1', ['LIMIT']),
+
+    # Replace non-standard operators
+    RewriteRule(r'(?i)\bRLIKE\b', '~', ['RLIKE']),  # RLIKE to ~ (regex match)
+
+    # Handle auto-increment columns in PostgreSQL (if in CREATE TABLE)
+    RewriteRule(r'(?i)AUTO_INCREMENT', 'SERIAL', ['AUTO_INCREMENT']),
+
+    # Handle table hints (not supported in PostgreSQL)
+    RewriteRule(r'(?i)WITH\s*\(\s*NOLOCK\s*\)', '', ['NOLOCK']),
+
+    # Fix any use of square brackets (SQL Server style) for identifiers
+    RewriteRule(r'\[([^\]]+)\]', r'"\1"', ['[']),
+])
+
+
+# Function to benchmark the local rewrite tiers
+def benchmark_rewrite_engine(count=100000, seed=0):
+    """
+    Time three generations of the local fix path on the same synthetic corpus:
+    the original loop (every raw pattern through re.sub, one rule after
+    another), the precompiled and keyword-prefiltered regex engine, and the
+    token rewriter that replaced both. The two regex versions must give
+    identical output. The token rewriter is expected to differ where the
+    regex rules corrupted queries.
+
+    :param count: Number of synthetic queries
+    :param seed: Random seed for the corpus
+    :return: Dictionary of queries/second per stage and implementation
+    """
+    queries = nlp.make_synthetic_queries(count, seed)
+
+    def rule_by_rule(engine, query):
+        for rule in engine.rules:
+            query = re.sub(rule.pattern, rule.replacement, query)
+        return query
+
+    def timed(function):
+        start = time.perf_counter()
+        outputs = [function(query) for query in queries]
+        return outputs, count / (time.perf_counter() - start)
+
+    stages = (
+        ("quick_fix", REGEX_QUICK_FIX_ENGINE, nlp.QUICK_FIX_ENGINE),
+        ("compatibility", REGEX_COMPATIBILITY_ENGINE, nlp.COMPATIBILITY_ENGINE),
+    )
+    results = {"queries": count}
+    for name, regex_engine, token_engine in stages:
+        loop_output, loop_qps = timed(lambda query: rule_by_rule(regex_engine, query))
+        regex_output, regex_qps = timed(regex_engine.apply)
+        token_output, token_qps = timed(token_engine.apply)
+
+        if loop_output != regex_output:
+            raise AssertionError(f"{name} regex engine output differs from the rule-by-rule loop")
+        results[name] = {
+            "regex_loop_qps": loop_qps,
+            "regex_engine_qps": regex_qps,
+            "token_rewriter_qps": token_qps,
+            "token_rewriter_changed": sum(1 for old, new in zip(regex_output, token_output) if old != new),
+        }
+        nlp.logger.info(f"{name}: regex loop {loop_qps:,.0f}, regex engine {regex_qps:,.0f}, "
+                        f"token rewriter {token_qps:,.0f} queries/sec")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the local SQL rewrite rules.")
+    parser.add_argument("count", type=int, nargs="?", default=100000,
+                        help="number of synthetic queries (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the corpus (default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    benchmark_rewrite_engine(args.count, args.seed)
@@ -1,510 +1,4943 @@
-# Import necessary libraries
-import json
-import requests
-import time
-
-# Global variable to keep track of the total number of tokens
-total_tokens = 0
-
-
-# Function to load input file
-def load_input_file(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-    return data
-
-
-# Function to generate SQL statements
-def generate_sqls(data):
-    """
-    Generate SQL statements from the NL queries.
-
-    :param data: List of NL queries
-    :return: List of SQL statements
-    """
-    sql_statements = []
-    # TODO: Implement logic to generate SQL statements
-
-    api_key = "<API_KEY>"  # Replace with your actual API key
-    model = "llama-3.3-70b-versatile"
-
-    # Add rate limiting to stay within RPM limits
-    requests_this_minute = 0
-    minute_start_time = time.time()
-
-    for index, item in enumerate(data):
-        nl_query = item.get('NL', '')
-
-        # Skip if NL query is empty
-        if not nl_query:
-            sql_statements.append({"NL": nl_query, "Query": ""})
-            continue
-
-        # Rate limiting check
-        current_time = time.time()
-        if current_time - minute_start_time >= 60:
-            # Reset counter for new minute
-            requests_this_minute = 0
-            minute_start_time = current_time
-
-        if requests_this_minute >= 29:  # Keep one below limit for safety
-            # Wait until next minute begins
-            sleep_time = 60 - (current_time - minute_start_time) + 1
-            print(f"Rate limit approaching. Waiting {sleep_time} seconds...")
-            time.sleep(sleep_time)
-            requests_this_minute = 0
-            minute_start_time = time.time()
-
-        # Prepare PostgreSQL-specific prompt
-        messages = [
-            {
-                "role": "system",
-                "content": "You are a PostgreSQL expert. Convert natural language to PostgreSQL-compliant SQL. Output only the SQL query with no explanations or markdown. Use PostgreSQL syntax and features."
-            },
-            {
-                "role": "user",
-                "content": f"Convert the following request to PostgreSQL SQL syntax: {nl_query}"
-            }
-        ]
-
-        try:
-            # Call the API with proper error handling
-            try:
-                # First verify if our API call function is working correctly
-                temp_msg = [{"role": "user", "content": "Write SELECT 1"}]
-                test_response, _ = call_groq_api(api_key, model, temp_msg, max_tokens=50)
-                if 'choices' not in test_response:
-                    print(f"API call function is not working correctly. Response: {test_response}")
-                    print("Please check your call_groq_api function implementation and API key.")
-                    raise Exception("API call function not working properly")
-
-                # If test succeeded, proceed with the actual query
-                response, tokens_used = call_groq_api(api_key, model, messages, max_tokens=500)
-                requests_this_minute += 1
-            except Exception as api_error:
-                print(f"API call error for query '{nl_query}': {str(api_error)}")
-                # If we get an API error, add empty result and continue
-                sql_statements.append({"NL": nl_query, "Query": ""})
-                continue
-
-            # Check if response contains expected keys
-            if not response or 'choices' not in response or not response['choices']:
-                print(f"Invalid API response for query '{nl_query}': {response}")
-                sql_statements.append({"NL": nl_query, "Query": ""})
-                continue
-
-            # Extract the SQL query from the response
-            try:
-                sql_query = response['choices'][0]['message']['content'].strip()
-            except (KeyError, IndexError) as e:
-                print(f"Failed to extract SQL from response for query '{nl_query}': {str(e)}")
-                print(f"Response structure: {response}")
-                sql_statements.append({"NL": nl_query, "Query": ""})
-                continue
-
-            # Clean up the SQL (remove any markdown formatting if present)
-            if "```" in sql_query:
-                # Extract content between SQL code blocks
-                import re
-                sql_match = re.search(r"```(?:sql)?(.*?)```", sql_query, re.DOTALL)
-                if sql_match:
-                    sql_query = sql_match.group(1).strip()
-                else:
-                    # If regex fails, use simple string splitting
-                    sql_query = sql_query.replace("```sql", "").replace("```", "").strip()
-
-            # Ensure PostgreSQL compatibility
-            sql_query = ensure_postgresql_compatibility(sql_query)
-
-            # Add to results
-            sql_statements.append({"NL": nl_query, "Query": sql_query})
-
-            # Progress tracking
-            if (index + 1) % 10 == 0:
-                print(f"Generated {index + 1}/{len(data)} SQL queries, Total tokens used: {total_tokens}")
-
-        except Exception as e:
-            print(f"Unexpected error for query '{nl_query}': {str(e)}")
-            sql_statements.append({"NL": nl_query, "Query": ""})
-
-            # If error is related to rate limiting, wait and then retry
-            if "rate limit" in str(e).lower():
-                print("Rate limit exceeded. Waiting 60 seconds...")
-                time.sleep(60)
-                requests_this_minute = 0
-                minute_start_time = time.time()
-
-    return sql_statements
-
-
-# Function to correct SQL statements
-def correct_sqls(sql_statements):
-    """
-    Correct SQL statements if necessary.
-
-    :param sql_statements: List of Dict with incorrect SQL statements and NL query
-    :return: List of corrected SQL statements
-    """
-    corrected_sqls = []
-    # TODO: Implement logic to correct SQL statements
-
-    api_key = "<API_KEY>"  # Replace with your actual API key
-    model = "llama-3.3-70b-versatile"
-
-    # Add rate limiting to stay within RPM limits
-    requests_this_minute = 0
-    minute_start_time = time.time()
-
-    for index, item in enumerate(sql_statements):
-        nl_query = item.get('NL', '')
-        incorrect_query = item.get('IncorrectQuery', '')
-
-        # Skip if incorrect query is empty
-        if not incorrect_query:
-            corrected_sqls.append({"IncorrectQuery": incorrect_query, "CorrectQuery": ""})
-            continue
-
-        # Rate limiting check
-        current_time = time.time()
-        if current_time - minute_start_time >= 60:
-            # Reset counter for new minute
-            requests_this_minute = 0
-            minute_start_time = current_time
-
-        if requests_this_minute >= 29:  # Keep one below limit for safety
-            # Wait until next minute begins
-            sleep_time = 60 - (current_time - minute_start_time) + 1
-            print(f"Rate limit approaching. Waiting {sleep_time} seconds...")
-            time.sleep(sleep_time)
-            requests_this_minute = 0
-            minute_start_time = time.time()
-
-        # First, check for common PostgreSQL syntax errors and fix them without API call if possible
-        fixed_query = attempt_quick_postgresql_fix(incorrect_query)
-
-        # If simple fixes didn't change it or if NL context is needed, use the API
-        if fixed_query == incorrect_query:
-            # Prepare PostgreSQL-specific prompt
-            messages = [
-                {
-                    "role": "system",
-                    "content": "You are a PostgreSQL expert. Fix the incorrect SQL query to make it valid PostgreSQL syntax. Output only the corrected SQL with no explanations or markdown."
-                },
-                {
-                    "role": "user",
-                    "content": f"Natural language: {nl_query}\nIncorrect PostgreSQL query: {incorrect_query}\nProvide only the corrected PostgreSQL query:"
-                }
-            ]
-
-            try:
-                # Call the API with proper error handling
-                try:
-                    response, tokens_used = call_groq_api(api_key, model, messages, max_tokens=500)
-                    requests_this_minute += 1
-                except Exception as api_error:
-                    print(f"API call error for correction: {str(api_error)}")
-                    corrected_sqls.append({"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query})
-                    continue
-
-                # Check if response contains expected keys
-                if not response or 'choices' not in response or not response['choices']:
-                    print(f"Invalid API response for correction: {response}")
-                    corrected_sqls.append({"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query})
-                    continue
-
-                # Extract the corrected SQL query from the response
-                try:
-                    corrected_query = response['choices'][0]['message']['content'].strip()
-                except (KeyError, IndexError) as e:
-                    print(f"Failed to extract SQL from correction response: {str(e)}")
-                    print(f"Response structure: {response}")
-                    corrected_sqls.append({"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query})
-                    continue
-
-                # Clean up the SQL (remove any markdown formatting if present)
-                if "```" in corrected_query:
-                    # Extract content between SQL code blocks
-                    import re
-                    sql_match = re.search(r"```(?:sql)?(.*?)```", corrected_query, re.DOTALL)
-                    if sql_match:
-                        corrected_query = sql_match.group(1).strip()
-                    else:
-                        # If regex fails, use simple string splitting
-                        corrected_query = corrected_query.replace("```sql", "").replace("```", "").strip()
-
-                # Ensure PostgreSQL compatibility
-                corrected_query = ensure_postgresql_compatibility(corrected_query)
-
-                # Add to results
-                corrected_sqls.append({"IncorrectQuery": incorrect_query, "CorrectQuery": corrected_query})
-
-                # Progress tracking
-                if (index + 1) % 10 == 0:
-                    print(f"Corrected {index + 1}/{len(sql_statements)} SQL queries, Total tokens used: {total_tokens}")
-
-            except Exception as e:
-                print(f"Unexpected error for correction: {str(e)}")
-                corrected_sqls.append({"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query})
-
-                # If error is related to rate limiting, wait and then retry
-                if "rate limit" in str(e).lower():
-                    print("Rate limit exceeded. Waiting 60 seconds...")
-                    time.sleep(60)
-                    requests_this_minute = 0
-                    minute_start_time = time.time()
-        else:
-            # Use our local fix instead of calling the API
-            corrected_sqls.append({"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query})
-
-    return corrected_sqls
-
-
-def attempt_quick_postgresql_fix(sql_query):
-    """
-    Attempt to fix common PostgreSQL syntax errors without calling the API.
-    This saves tokens and time for simple errors.
-
-    :param sql_query: Incorrect SQL query string
-    :return: Fixed SQL query string or original if no fixes applied
-    """
-    # Make a copy of the original query
-    fixed_query = sql_query
-
-    # Common PostgreSQL syntax error fixes
-    common_fixes = [
-        # Missing semicolons at the end
-        (r'(?<!\;)$', ';'),
-
-        # Fix quote issues (PostgreSQL uses single quotes for strings, double quotes for identifiers)
-        (r'(?<!")"([^"]*?)"(?!")', r"'\1'"),  # Replace standalone double quotes with single quotes for strings
-
-        # PostgreSQL specific fixes
-        (r'(?i)\bLIMIT\s+(\d+)\s+OFFSET\s+(\d+)', r'LIMIT \1 OFFSET \2'),  # Ensure proper LIMIT OFFSET syntax
-        (r'(?i)\bILIKE\b', 'ILIKE'),  # Preserve ILIKE operator (PostgreSQL specific)
-        (r'(?i)\bTEXT\(\)', 'TEXT'),  # Fix TEXT() data type to TEXT
-
-        # Fix common typos
-        (r'\bSELET\b', 'SELECT'),
-        (r'\bFROM\s+FORM\b', 'FROM'),
-        (r'\bWHERE\s+HWERE\b', 'WHERE'),
-        (r'\bGROUP BY\s+GRUOP BY\b', 'GROUP BY'),
-        (r'\bJION\b', 'JOIN'),
-        (r'\bINNER JION\b', 'INNER JOIN'),
-        (r'\bLEFT JION\b', 'LEFT JOIN'),
-
-        # Fix missing spaces
-        (r'(?<=\w)(?=SELECT|FROM|WHERE|GROUP|ORDER|HAVING|JOIN)', ' '),
-
-        # Fix doubled keywords
-        (r'\b(SELECT|FROM|WHERE|GROUP BY|ORDER BY|HAVING)\s+\1\b', r'\1'),
-
-        # Replace CONCAT function with PostgreSQL's concatenation operator
-        (r'CONCAT\((.*?),(.*?)\)', r'\1 || \2'),
-
-        # Fix datetime functions to PostgreSQL syntax
-        (r'(?i)DATE_FORMAT\((.*?),\s*[\'"](%[YmdHis])[\'"].*?\)', r'TO_CHAR(\1, \'YYYY-MM-DD\')'),
-        (r'(?i)NOW\(\)', r'CURRENT_TIMESTAMP'),
-
-        # Fix incorrect TOP syntax (SQL Server) to LIMIT (PostgreSQL)
-        (r'(?i)SELECT\s+TOP\s+(\d+)', r'SELECT'),  # Remove TOP
-        (r'(?i)SELECT\s+TOP\s+(\d+)(.*?)FROM', r'SELECT\2 FROM'),  # Remove TOP and preserve other parts
-    ]
-
-    import re
-    for pattern, replacement in common_fixes:
-        fixed_query = re.sub(pattern, replacement, fixed_query)
-
-    # Add LIMIT clause at the end if TOP was removed
-    top_match = re.search(r'(?i)TOP\s+(\d+)', sql_query)
-    if top_match and 'LIMIT' not in fixed_query:
-        if ';' in fixed_query:
-            fixed_query = fixed_query[:-1] + f" LIMIT {top_match.group(1)};"
-        else:
-            fixed_query = fixed_query + f" LIMIT {top_match.group(1)};"
-
-    # Balance parentheses
-    open_count = fixed_query.count('(')
-    close_count = fixed_query.count(')')
-    if open_count > close_count:
-        fixed_query += ')' * (open_count - close_count)
-
-    return fixed_query
-
-
-def ensure_postgresql_compatibility(sql_query):
-    """
-    Ensures the generated SQL is compatible with PostgreSQL.
-
-    :param sql_query: SQL query to check
-    :return: PostgreSQL-compatible SQL query
-    """
-    # Replace functions and syntax that might be incompatible with PostgreSQL
-    replacements = [
-        # Date functions
-        (r'(?i)GETDATE\(\)', 'CURRENT_DATE'),
-        (r'(?i)CURRENT_TIMESTAMP\(\)', 'CURRENT_TIMESTAMP'),
-
-        # String functions
-        (r'(?i)CHARINDEX\((.*?),(.*?)\)', r'POSITION(\1 IN \2)'),
-        (r'(?i)LEN\((.*?)\)', r'LENGTH(\1)'),
-        (r'(?i)SUBSTRING\((.*?),(.*?),(.*?)\)', r'SUBSTRING(\1 FROM \2 FOR \3)'),
-
-        # Concatenation
-        (r'(?i)CONCAT_WS\((.*?),(.*?)\)', r'array_to_string(ARRAY[\2], \1)'),
-
-        # Replace LIMIT n,m syntax (MySQL) with LIMIT m OFFSET n (PostgreSQL)
-        (r'(?i)LIMIT\s+(\d+)\s*,\s*(\d+)', r'LIMIT \2 OFFSET \1'),
-
-        # Replace non-standard operators
-        (r'(?i)\bRLIKE\b', '~'),  # RLIKE to ~ (regex match)
-
-        # Handle auto-increment columns in PostgreSQL (if in CREATE TABLE)
-        (r'(?i)AUTO_INCREMENT', 'SERIAL'),
-
-        # Handle table hints (not supported in PostgreSQL)
-        (r'(?i)WITH\s*\(\s*NOLOCK\s*\)', ''),
-
-        # Fix any use of square brackets (SQL Server style) for identifiers
-        (r'\[([^\]]+)\]', r'"\1"'),
-    ]
-
-    import re
-    for pattern, replacement in replacements:
-        sql_query = re.sub(pattern, replacement, sql_query)
-
-    return sql_query
-
-
-# Function to properly test the Groq API call before using it in main functions
-def verify_groq_api_connection(api_key, model):
-    """
-    Test the Groq API connection to ensure it's working properly.
-
-    :param api_key: API key for authentication
-    :param model: Model name to use
-    :return: True if connection works, False otherwise
-    """
-    print("Verifying Groq API connection...")
-    url = "https://api.groq.com/openai/v1/chat/completions"
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-    }
-    data = {
-        "model": model,
-        "messages": [{"role": "user", "content": "Say 'Connection successful'"}],
-        'temperature': 0.0,
-        'max_tokens': 20,
-        'n': 1
-    }
-
-    try:
-        response = requests.post(url, headers=headers, json=data)
-
-        # Check if we get a successful response
-        if response.status_code == 200:
-            response_json = response.json()
-            if 'choices' in response_json and response_json['choices']:
-                content = response_json['choices'][0]['message']['content']
-                print(f"API Connection verified. Response: {content}")
-                return True
-
-        print(f"API connection failed. Status code: {response.status_code}")
-        print(f"Response: {response.text}")
-        return False
-
-    except Exception as e:
-        print(f"API connection error: {str(e)}")
-        return False
-
-
-# Function to call the Groq API
-def call_groq_api(api_key, model, messages, temperature=0.0, max_tokens=1000, n=1):
-    """
-    NOTE: DO NOT CHANGE/REMOVE THE TOKEN COUNT CALCULATION
-    Call the Groq API to get a response from the language model.
-    :param api_key: API key for authentication
-    :param model: Model name to use
-    :param messages: List of message dictionaries
-    :param temperature: Temperature for the model
-    :param max_tokens: Maximum number of tokens to generate (these are max new tokens)
-    :param n: Number of responses to generate
-    :return: Response from the API
-    """
-    global total_tokens
-    url = "https://api.groq.com/openai/v1/chat/completions"
-
-    api_key = "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"
-    model = "llama-3.3-70b-versatile"
-    messages = [
-        {
-            "role": "user",
-            "content": "Explain the importance of fast language models"
-        }
-    ]
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-    }
-    data = {
-        "model": model,
-        "messages": messages,
-        'temperature': temperature,
-        'max_tokens': max_tokens,
-        'n': n
-    }
-
-    response = requests.post(url, headers=headers, json=data)
-    response_json = response.json()
-
-    # Update the global token count
-    total_tokens += response_json.get('usage', {}).get('completion_tokens', 0)
-
-    # You can get the completion from response_json['choices'][0]['message']['content']
-    return response_json, total_tokens
-
-
-# Main function
-def main():
-    # TODO: Specify the path to your input file
-    input_file_path_1 = '/train_generate_task.json'
-    input_file_path_2 = '/train_query_coorection_task.json'
-
-    # Load data from input file
-    data_1 = load_input_file(input_file_path_1)
-    data_2 = load_input_file(input_file_path_2)
-
-    start = time.time()
-    # Generate SQL statements
-    sql_statements = generate_sqls(data_1)
-    generate_sqls_time = time.time() - start
-
-    start = time.time()
-    # Correct SQL statements
-    corrected_sqls = correct_sqls(data_2)
-    correct_sqls_time = time.time() - start
-
-    assert len(data_2) == len(corrected_sqls)  # If no answer, leave blank
-    assert len(data_1) == len(sql_statements)  # If no answer, leave blank
-
-    # TODO: Process the outputs
-
-    # Get the outputs as a list of dicts with keys 'IncorrectQuery' and 'CorrectQuery'
-    with open('output_sql_correction_task.json', 'w') as f:
-        json.dump(corrected_sqls, f)
-
-        # Get the outputs as a list of dicts with keys 'NL' and 'Query'
-    with open('output_sql_generation_task.json', 'w') as f:
-        json.dump(sql_statements, f)
-
-    return generate_sqls_time, correct_sqls_time
-
-
-if __name__ == "__main__":
-    generate_sqls_time, correct_sqls_time = main()
-    print(f"Time taken to generate SQLs: {generate_sqls_time} seconds")
-    print(f"Time taken to correct SQLs: {correct_sqls_time} seconds")
-    print(f"Total tokens: {total_tokens}")
-
+# Import necessary libraries
+import argparse
+import collections
+import contextlib
+import functools
+import hashlib
+import http.server
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# psycopg2 is only needed to verify queries against a real PostgreSQL server
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+logger = logging.getLogger(__name__)
+
+# Global variable to keep track of the total number of tokens
+total_tokens = 0
+total_tokens_lock = threading.Lock()
+
+# Per-thread usage of the item currently being processed (tokens spent, failed API calls)
+call_usage = threading.local()
+
+# API settings shared by the generation and correction tasks; any OpenAI-compatible endpoint works
+API_BASE_URL = os.environ.get("LLM_BASE_URL", "https://api.groq.com/openai/v1")
+API_KEY = os.environ.get("LLM_API_KEY", "<API_KEY>")  # Replace with your actual API key
+MODEL = os.environ.get("LLM_MODEL", "llama-3.3-70b-versatile")
+API_SUPPORTS_N = os.environ.get("LLM_SUPPORTS_N", "0") == "1"  # Several choices per call (Groq only accepts n=1)
+
+# Directory holding the checkpoint journals of interrupted runs
+CHECKPOINT_DIR = ".checkpoints"
+
+# Maximum number of chat-completion calls in flight at once (1 = sequential)
+MAX_CONCURRENCY = 8
+
+# Process pool for the CPU-bound local rewrite stages
+LOCAL_STAGE_PROCESSES = os.cpu_count() or 1
+LOCAL_STAGE_CHUNK_SIZE = 256  # Queries per task sent to a worker process
+LOCAL_STAGE_MIN_ITEMS = 2000  # Smaller inputs are processed without starting a pool
+
+# Service mode (--serve / --serve-jsonl)
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8080
+SERVICE_BATCH_WINDOW_MS = 10  # How long a request waits for others to share its micro-batch
+SERVICE_MAX_BATCH_ITEMS = 64
+SERVICE_MAX_BATCHES = 4  # Micro-batches in flight at once
+
+# Completion budgets (max_tokens) learned per kind of call from the lengths of past answers
+TOKEN_BUDGET_PATH = ".token_budget.json"  # Set to None to keep the statistics in memory only
+TOKEN_BUDGET_DEFAULT = 500  # Budget until a kind has enough samples
+TOKEN_BUDGET_MIN = 32
+TOKEN_BUDGET_MAX = 2000  # Also the largest budget a truncated answer is retried with
+TOKEN_BUDGET_MIN_SAMPLES = 20
+
+# Prompt batching: items packed into one chat-completion call (1 = one call per item)
+BATCH_SIZE = 1
+BATCH_MAX_TOKENS = 2000  # Completion budget of one batched call
+BATCH_MAX_PROMPT_TOKENS = 3000  # Estimated prompt size of one batched call
+
+# Speculative generation: candidates requested per question and ranked locally (1 = off)
+CANDIDATES = 1
+CANDIDATE_TEMPERATURE = 0.4  # Sampling temperature of the extra candidates
+
+# Provider rate limits shared by every API call
+REQUESTS_PER_MINUTE = 30
+TOKENS_PER_MINUTE = 6000
+
+# Seconds to wait for a connection and for the response of one API call
+REQUEST_TIMEOUT = (10, 120)
+
+# On-disk response cache for deterministic (temperature 0) API calls
+RESPONSE_CACHE_PATH = ".llm_response_cache.sqlite3"  # Set to None to disable caching
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # Seconds before a cached response expires
+RESPONSE_CACHE_MAX_ENTRIES = 100000
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESPONSE_CACHE_EVICT_EVERY = 500  # Stores between eviction sweeps
+
+# Local near-duplicate cache in front of generate_sqls
+SEMANTIC_CACHE_PATH = ".semantic_cache.jsonl"  # Set to None to disable the semantic cache
+SEMANTIC_CACHE_MAX_ENTRIES = 20000
+
+# Optional database schema (DDL file or JSON catalog) used to ground generation prompts
+SCHEMA_PATH = None
+SCHEMA_MAX_TABLES = 5  # Tables included in one prompt
+SCHEMA_MAX_COLUMNS = 15  # Columns listed per table
+
+# Optional execution-based verification: a PostgreSQL DSN, or "sqlite://" for an embedded stand-in
+VERIFY_DSN = None
+VERIFY_TIMEOUT_MS = 2000  # Statement timeout while verifying against PostgreSQL
+
+# Metrics export: per-call records as JSONL, counters and histograms as Prometheus text
+METRICS_JSONL_PATH = None
+METRICS_PROMETHEUS_PATH = None
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096)
+STAGE_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 1e-1)
+BATCH_ITEM_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# Shared pooled HTTP session, created lazily by get_http_session()
+http_session = None
+http_session_pool_size = 0
+http_session_lock = threading.Lock()
+
+
+# Function to load input file
+def load_input_file(file_path):
+    with open(file_path, 'r') as file:
+        data = json.load(file)
+    return data
+
+
+# Function to stream items from an input file
+def iter_input_items(file_path, chunk_size=1 << 16):
+    """
+    Lazily yield the items of a JSON array file or a JSONL file, so memory
+    does not grow with the size of the input.
+
+    :param file_path: Path to a .json array or .jsonl/.ndjson file
+    :param chunk_size: Number of characters read at a time
+    :return: Generator of items
+    """
+    with open(file_path, 'r') as file:
+        head = file.read(chunk_size)
+        if file_path.endswith(('.jsonl', '.ndjson')) or not head.lstrip().startswith('['):
+            file.seek(0)
+            for line_number, line in enumerate(file, 1):
+                line = line.strip()
+                if line:
+                    try:
+                        yield json.loads(line)
+                    except ValueError as e:
+                        raise ValueError(f"{file_path}:{line_number}: invalid JSON line: {e}") from e
+            return
+
+        yield from iter_json_array(file, head, chunk_size)
+
+
+# Function to incrementally parse a top-level JSON array
+def iter_json_array(file, buffer, chunk_size):
+    """
+    :param file: Open text file positioned just after `buffer`
+    :param buffer: Text already read from the file, starting with the array
+    :param chunk_size: Number of characters read at a time
+    :return: Generator of array elements
+    """
+    decoder = json.JSONDecoder()
+    pos = buffer.index('[') + 1
+    eof = False
+
+    while True:
+        # Skip whitespace and separators, reading more input as needed
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            buffer, pos = file.read(chunk_size), 0
+            eof = not buffer
+
+        if pos >= len(buffer):
+            raise ValueError("Unexpected end of input: JSON array is not closed")
+        if buffer[pos] == ']':
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+            # A scalar is only complete once a delimiter follows it: "4." may be "4.5" in the next chunk
+            if end == len(buffer) or buffer[end] not in ' \t\r\n,]':
+                raise ValueError(f"Unexpected character after array element at offset {end - pos}"
+                                 if eof else "Element may be incomplete")
+        except ValueError:
+            if eof:
+                raise
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        yield item
+        pos = end
+
+
+class JsonOutputWriter:
+    """
+    Writes results to disk as they are produced: a JSON array for .json
+    paths, or one object per line for .jsonl/.ndjson paths. Every item is
+    flushed immediately, and the array is closed even if the run fails,
+    so completed results are always on disk.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.jsonl = file_path.endswith(('.jsonl', '.ndjson'))
+        self.count = 0
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.file_path, 'w')
+        if not self.jsonl:
+            self.file.write('[')
+            self.file.flush()
+        return self
+
+    def write(self, item):
+        if self.jsonl:
+            self.file.write(json.dumps(item) + '\n')
+        else:
+            self.file.write((', ' if self.count else '') + json.dumps(item))
+        self.file.flush()
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.jsonl:
+            self.file.write(']')
+        self.file.close()
+        return False
+
+
+class CountingIterator:
+    """Wraps an iterable and counts the items drawn from it."""
+
+    def __init__(self, items):
+        self.items = iter(items)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self.items)
+        self.count += 1
+        return item
+
+
+# Function to get the shared HTTP session
+def get_http_session(pool_size=MAX_CONCURRENCY):
+    """
+    Return the process-wide requests session, creating it on first use.
+    All API calls share its connection pool so concurrent workers reuse
+    keep-alive connections instead of opening one per request. If a caller
+    needs more concurrent connections than the pool holds, the pool is
+    replaced by a larger one.
+
+    :param pool_size: Maximum number of pooled connections per host
+    :return: requests.Session instance
+    """
+    global http_session, http_session_pool_size
+    with http_session_lock:
+        if http_session is None:
+            http_session = requests.Session()
+        if pool_size > http_session_pool_size:
+            # The old adapter is not closed: requests in flight still hold its connections
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+            http_session_pool_size = pool_size
+        return http_session
+
+
+class Metrics:
+    """
+    Counters, histograms and per-call records for the whole pipeline.
+
+    Every chat-completion call adds one record (latency, prompt and
+    completion tokens, status, retries, cache hit), kept in a bounded
+    in-memory buffer and optionally appended to a JSONL file. Counters and
+    histograms are keyed by name and labels and can be exported in the
+    Prometheus text format. With profiling on, profile() times the local
+    rewrite stages; otherwise it costs nothing.
+    """
+
+    def __init__(self, jsonl_path=METRICS_JSONL_PATH, max_records=10000, profiling=False):
+        """
+        :param jsonl_path: File per-call records are appended to (None = memory only)
+        :param max_records: Number of recent call records kept in memory
+        :param profiling: Time the local rewrite stages
+        """
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.records = collections.deque(maxlen=max_records)
+        self.profiling = profiling
+        self.file = None
+        self.lock = threading.Lock()
+        if jsonl_path:
+            self.open_jsonl(jsonl_path)
+
+    def open_jsonl(self, path):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(path, 'a')
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self.key(name, labels)] += value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        :param name: Histogram name
+        :param value: Observed value
+        :param buckets: Upper bounds, used when the histogram is first created
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": tuple(buckets), "counts": [0] * len(buckets),
+                                                    "sum": 0.0, "count": 0}
+            for position, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][position] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, buckets=LATENCY_BUCKETS, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, buckets, **labels)
+
+    def profile(self, stage):
+        """:return: Context manager timing a local stage when profiling is on, a no-op otherwise"""
+        if not self.profiling:
+            return contextlib.nullcontext()
+        return self.timer("local_stage_seconds", STAGE_BUCKETS, stage=stage)
+
+    def record_call(self, latency, status, prompt_tokens=0, completion_tokens=0, retries=0, cache_hit=False,
+                    model=None):
+        """
+        Record one chat-completion call and update the call counters and histograms.
+
+        :param latency: Seconds spent in the call, including rate-limit waits and retries
+        :param status: "ok", "cache_hit", "http_<code>", "error" or "circuit_open"
+        """
+        record = {"time": time.time(), "model": model, "latency": latency, "status": status,
+                  "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "retries": retries, "cache_hit": cache_hit}
+        self.increment("llm_calls_total", status=status)
+        self.increment("llm_retries_total", retries)
+        self.increment("llm_prompt_tokens_total", prompt_tokens)
+        self.increment("llm_completion_tokens_total", completion_tokens)
+        if not cache_hit:
+            self.observe("llm_call_latency_seconds", latency)
+            self.observe("llm_completion_tokens", completion_tokens, TOKEN_BUCKETS)
+        with self.lock:
+            self.records.append(record)
+            if self.file is not None:
+                self.file.write(json.dumps(record) + '\n')
+                self.file.flush()
+
+    def prometheus(self):
+        """:return: Counters and histograms in the Prometheus text exposition format"""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{label_text(labels)} {value:g}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', f'{bound:g}')])} {cumulative}")
+                lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{label_text(labels)} {histogram['sum']:g}")
+                lines.append(f"{name}_count{label_text(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path, 'w') as file:
+            file.write(self.prometheus())
+
+    def drain(self):
+        """
+        :return: Tuple of (counters, histograms) recorded since the last drain, which are then cleared
+        """
+        with self.lock:
+            drained = dict(self.counters), self.histograms
+            self.counters = collections.defaultdict(float)
+            self.histograms = {}
+        return drained
+
+    def merge(self, counters, histograms):
+        """Add counters and histograms drained from another Metrics (e.g. in a worker process)."""
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] += value
+            for key, other in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = {"buckets": other["buckets"], "counts": list(other["counts"]),
+                                            "sum": other["sum"], "count": other["count"]}
+                    continue
+                histogram["counts"] = [mine + theirs for mine, theirs in zip(histogram["counts"], other["counts"])]
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+
+    def summary(self):
+        """:return: Dict of counter totals by name, and count/mean of each histogram"""
+        with self.lock:
+            totals = collections.defaultdict(float)
+            for (name, labels), value in self.counters.items():
+                totals[name] += value
+            histograms = {}
+            for (name, labels), histogram in self.histograms.items():
+                label = name + "".join(f"[{value}]" for _, value in labels)
+                histograms[label] = {"count": histogram["count"],
+                                     "mean": histogram["sum"] / histogram["count"] if histogram["count"] else 0.0}
+        return {"counters": dict(totals), "histograms": histograms}
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Metrics shared by every stage of the pipeline
+metrics = Metrics()
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter shared by every API call.
+
+    Two buckets refill continuously: one for requests-per-minute and one for
+    tokens-per-minute. The provider's rate-limit headers correct the local
+    estimate after every response, and 429/5xx responses are retried with
+    jittered exponential backoff (or the server's retry-after, when given).
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 max_retries=5, base_backoff=1.0, max_backoff=60.0, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param requests_per_minute: Request budget per minute
+        :param tokens_per_minute: Token budget per minute
+        :param max_retries: Retries of a throttled or failed call
+        :param base_backoff: First backoff in seconds, doubled on every retry
+        :param max_backoff: Longest backoff in seconds
+        :param clock: Monotonic time source in seconds (replaceable in tests)
+        :param sleep: Function used to wait for budget (replaceable in tests)
+        """
+        self.clock = clock
+        self.sleep = sleep
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.request_tokens = float(requests_per_minute)
+        self.token_tokens = float(tokens_per_minute)
+        self.blocked_until = 0.0
+        self.last_refill = clock()
+        self.total_sleep_time = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        """Top up both buckets for the time elapsed since the last refill (lock held)."""
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_tokens = min(self.requests_per_minute,
+                                  self.request_tokens + elapsed * self.requests_per_minute / 60.0)
+        self.token_tokens = min(self.tokens_per_minute,
+                                self.token_tokens + elapsed * self.tokens_per_minute / 60.0)
+
+    def acquire(self, estimated_tokens=0):
+        """
+        Block until one request and `estimated_tokens` tokens are available, then take them.
+
+        :param estimated_tokens: Expected prompt plus completion tokens for the call
+        """
+        # A single call larger than the whole budget can only wait for a full bucket
+        needed_tokens = min(float(estimated_tokens), float(self.tokens_per_minute))
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    request_wait = (1.0 - self.request_tokens) * 60.0 / self.requests_per_minute
+                    token_wait = (needed_tokens - self.token_tokens) * 60.0 / self.tokens_per_minute
+                    wait = max(request_wait, token_wait)
+                    if wait <= 0:
+                        self.request_tokens -= 1.0
+                        self.token_tokens -= needed_tokens
+                        return
+                self.total_sleep_time += wait
+            metrics.increment("rate_limit_sleep_seconds_total", wait)
+            self.sleep(wait)
+
+    def refund(self, requests=0, tokens=0):
+        """
+        Give back budget taken by acquire() for an attempt the provider did not serve.
+
+        :param requests: Request slots to return
+        :param tokens: Tokens to return
+        """
+        with self.lock:
+            self.request_tokens = min(self.requests_per_minute, self.request_tokens + requests)
+            self.token_tokens = min(self.tokens_per_minute, self.token_tokens + tokens)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """
+        Settle the token bucket once the real usage of a call is known.
+
+        :param estimated_tokens: Tokens reserved by acquire()
+        :param actual_tokens: Tokens the provider reported for the call
+        """
+        with self.lock:
+            reserved = min(float(estimated_tokens), float(self.tokens_per_minute))
+            self.token_tokens = min(self.tokens_per_minute, self.token_tokens + reserved - actual_tokens)
+
+    def update_from_headers(self, headers):
+        """
+        Align the local buckets with the provider's x-ratelimit-* and retry-after headers.
+
+        :param headers: Response headers (case-insensitive mapping)
+        """
+        if not headers:
+            return
+        with self.lock:
+            now = self.clock()
+            self.refill(now)
+
+            remaining_requests = parse_header_number(headers.get('x-ratelimit-remaining-requests'))
+            if remaining_requests is not None:
+                self.request_tokens = min(self.request_tokens, remaining_requests)
+                if remaining_requests <= 0:
+                    reset = parse_reset_duration(headers.get('x-ratelimit-reset-requests'))
+                    if reset:
+                        self.blocked_until = max(self.blocked_until, now + reset)
+
+            remaining_tokens = parse_header_number(headers.get('x-ratelimit-remaining-tokens'))
+            if remaining_tokens is not None:
+                self.token_tokens = min(self.token_tokens, remaining_tokens)
+                if remaining_tokens <= 0:
+                    reset = parse_reset_duration(headers.get('x-ratelimit-reset-tokens'))
+                    if reset:
+                        self.blocked_until = max(self.blocked_until, now + reset)
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Pause every caller after a throttled or failed call.
+
+        :param attempt: Zero-based retry attempt number
+        :param retry_after: Server supplied retry-after value in seconds, if any
+        :return: Number of seconds callers will be held back
+        """
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, self.base_backoff)
+        else:
+            # Full jitter keeps concurrent workers from retrying in lockstep
+            delay = random.uniform(0, min(self.max_backoff, self.base_backoff * (2 ** attempt)))
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, self.clock() + delay)
+        return delay
+
+
+# Function to parse a numeric rate-limit header
+def parse_header_number(value):
+    """
+    :param value: Header value or None
+    :return: Float value, or None when missing or malformed
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Function to parse rate-limit reset durations such as "2m59.56s", "7.66s" or "250ms"
+def parse_reset_duration(value):
+    """
+    :param value: Header value or None
+    :return: Duration in seconds, or None when missing or malformed
+    """
+    if value is None:
+        return None
+    number = parse_header_number(value)
+    if number is not None:
+        return number
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', str(value))
+    if not parts:
+        return None
+    scale = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+
+# Word pieces, digit groups, newlines and punctuation: roughly what a BPE tokenizer splits SQL and English into
+TOKEN_ESTIMATE_PATTERN = re.compile(r"[A-Za-z]+|\d{1,3}|\n|[^\sA-Za-z\d]")
+
+
+# Function to estimate the number of tokens in a text without a tokenizer
+def estimate_tokens(text):
+    """
+    :param text: Prompt or answer text
+    :return: Approximate token count (common words are one token, long words one per six letters)
+    """
+    return sum(1 + (len(piece) - 1) // 6 for piece in TOKEN_ESTIMATE_PATTERN.findall(text or ''))
+
+
+# Function to estimate the prompt tokens of a chat-completion call
+def estimate_prompt_tokens(messages, scaled=True):
+    """
+    :param messages: List of message dictionaries
+    :param scaled: Correct the estimate by the error observed against the API's prompt_tokens
+    :return: Approximate prompt tokens, including the per-message overhead
+    """
+    tokens = sum(estimate_tokens(str(message.get('content', ''))) + 4 for message in messages) + 3
+    return int(tokens * token_budget.prompt_scale) if scaled else tokens
+
+
+class TokenBudget:
+    """
+    Completion budgets (max_tokens) learned from the answers actually
+    received, instead of one fixed budget for every call. Calls are grouped
+    by kind: the task and the size class of its input, since a long broken
+    query needs a longer fix than a short one. Once a kind has enough
+    samples, its budget is a high quantile of the observed completion
+    lengths plus headroom; until then the default applies. Answers cut off
+    at max_tokens are retried once with a larger budget and are not counted.
+
+    The budget also tracks how far the offline prompt estimate is from the
+    prompt_tokens the API reports, so rate-limit reservations stay close to
+    what is really used. Statistics are kept in a JSON file between runs.
+    """
+
+    def __init__(self, path=TOKEN_BUDGET_PATH, default_tokens=TOKEN_BUDGET_DEFAULT, min_tokens=TOKEN_BUDGET_MIN,
+                 max_tokens=TOKEN_BUDGET_MAX, min_samples=TOKEN_BUDGET_MIN_SAMPLES, quantile=0.98,
+                 headroom=1.25, history=500):
+        """
+        :param path: JSON file the statistics are loaded from and saved to (None = in memory only)
+        :param default_tokens: Budget of a kind with too few samples
+        :param min_tokens: Smallest budget ever used
+        :param max_tokens: Largest budget, also the limit for retries of truncated answers
+        :param min_samples: Samples needed before a kind uses its learned budget
+        :param quantile: Quantile of the observed lengths the budget is based on
+        :param headroom: Factor applied on top of the quantile
+        :param history: Most recent samples kept per kind
+        """
+        self.path = path
+        self.default_tokens = default_tokens
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.min_samples = min_samples
+        self.quantile = quantile
+        self.headroom = headroom
+        self.history = history
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.history))
+        self.budgets = {}  # kind -> learned budget, recomputed when samples change
+        self.prompt_scale = 1.0
+        self.truncated = 0
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def kind(self, task, text):
+        """
+        :param task: Call type, e.g. "generate", "correct" or "repair"
+        :param text: Variable part of the prompt (question or query)
+        :return: Kind key such as "correct:64", the task plus the power-of-two size class of text
+        """
+        size = estimate_tokens(text)
+        return f"{task}:{1 << min(size, 4096).bit_length()}"
+
+    def budget(self, kind):
+        """:return: max_tokens to request for a call of this kind"""
+        with self.lock:
+            budget = self.budgets.get(kind)
+            if budget is None:
+                samples = self.samples.get(kind)
+                if samples is None or len(samples) < self.min_samples:
+                    return self.default_tokens
+                ordered = sorted(samples)
+                observed = ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+                budget = min(self.max_tokens, max(self.min_tokens, int(observed * self.headroom) + 8))
+                self.budgets[kind] = budget
+            return budget
+
+    def retry_budget(self, max_tokens):
+        """:return: Budget for retrying an answer truncated at max_tokens, or None if it cannot grow"""
+        if max_tokens >= self.max_tokens:
+            return None
+        return min(self.max_tokens, max(max_tokens * 2, self.default_tokens))
+
+    def record(self, kind, completion_tokens):
+        """
+        :param kind: Kind key of the call
+        :param completion_tokens: Completion tokens of one complete answer
+        """
+        with self.lock:
+            self.samples[kind].append(completion_tokens)
+            self.budgets.pop(kind, None)
+
+    def calibrate(self, estimated_tokens, actual_tokens):
+        """
+        :param estimated_tokens: Unscaled offline estimate of a prompt
+        :param actual_tokens: prompt_tokens reported by the API for it
+        """
+        if estimated_tokens > 0 and actual_tokens > 0:
+            with self.lock:
+                self.prompt_scale += 0.05 * (actual_tokens / estimated_tokens - self.prompt_scale)
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                state = json.load(file)
+        except (OSError, ValueError) as error:
+            logger.warning(f"Ignoring token budget statistics in {self.path}: {str(error)}")
+            return
+        self.prompt_scale = float(state.get('prompt_scale', 1.0))
+        for kind, samples in state.get('samples', {}).items():
+            self.samples[kind].extend(int(sample) for sample in samples)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            state = {"prompt_scale": self.prompt_scale,
+                     "samples": {kind: list(samples) for kind, samples in self.samples.items()}}
+        with open(self.path, 'w') as file:
+            json.dump(state, file)
+
+    def stats(self):
+        """:return: Dict with the learned budget per kind, truncated answers and the prompt estimate scale"""
+        kinds = sorted(self.samples)
+        return {"budgets": {kind: self.budget(kind) for kind in kinds}, "truncated": self.truncated,
+                "prompt_scale": round(self.prompt_scale, 3)}
+
+
+# Completion budgets shared by every API call
+token_budget = TokenBudget()
+
+
+# Function to estimate the token cost of a chat-completion call
+def estimate_request_tokens(messages, max_tokens):
+    """
+    Offline prompt estimate plus the completion budget.
+
+    :param messages: List of message dictionaries
+    :param max_tokens: Completion token budget
+    :return: Estimated total tokens for the call
+    """
+    return estimate_prompt_tokens(messages) + max_tokens
+
+
+# Function to send a request through the shared rate limiter
+def post_with_rate_limit(url, headers, data, limiter=None):
+    """
+    POST a chat-completion request, waiting for rate-limit budget first and
+    retrying throttled (429) or server-error (5xx) responses with backoff.
+
+    :param url: Endpoint URL
+    :param headers: Request headers
+    :param data: JSON body
+    :param limiter: RateLimiter to use (defaults to the shared one)
+    :return: Tuple of (requests.Response, estimated tokens reserved); response.retries holds the retry count
+    """
+    limiter = limiter or rate_limiter
+    estimated_tokens = estimate_request_tokens(data.get('messages', []), data.get('max_tokens', 0))
+
+    for attempt in range(limiter.max_retries + 1):
+        # Tokens are reserved once for the call; retries only wait for a request slot
+        limiter.acquire(estimated_tokens if attempt == 0 else 0)
+        try:
+            response = get_http_session().post(url, headers=headers, json=data, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException:
+            # The call never completed, so the tokens reserved for it were not used
+            limiter.record_usage(estimated_tokens, 0)
+            raise
+        limiter.update_from_headers(response.headers)
+
+        if response.status_code != 429 and response.status_code < 500:
+            break
+        if response.status_code == 429:
+            # A throttled attempt is not counted by the provider
+            limiter.refund(requests=1)
+        if attempt == limiter.max_retries:
+            break
+
+        retry_after = parse_header_number(response.headers.get('retry-after'))
+        delay = limiter.backoff(attempt, retry_after)
+        logger.warning(f"API returned status {response.status_code}. Retrying in {delay:.1f} seconds...")
+
+    response.retries = attempt
+    return response, estimated_tokens
+
+
+# Rate limiter shared by every API call
+rate_limiter = RateLimiter()
+
+
+class ChatBackend:
+    """
+    Endpoint that chat-completion calls are sent to. The base class speaks
+    the OpenAI-compatible HTTP API, which covers Groq, other providers,
+    local model servers and MockChatServer. Subclasses can override post()
+    to reach anything else, as long as it returns an object with
+    status_code, headers and json() like a requests.Response.
+    """
+
+    def __init__(self, base_url=API_BASE_URL, api_key=None, model=None, supports_n=API_SUPPORTS_N):
+        """
+        :param base_url: API root, e.g. "https://api.groq.com/openai/v1"
+        :param api_key: Key used instead of the caller's, if given
+        :param model: Model used instead of the caller's, if given (local servers name models differently)
+        :param supports_n: Whether one call can return several choices (Groq only accepts n=1)
+        """
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.model = model
+        self.supports_n = supports_n
+
+    @property
+    def chat_url(self):
+        return f"{self.base_url}/chat/completions"
+
+    def post(self, api_key, data):
+        """
+        :param api_key: Caller's API key
+        :param data: Chat-completion request body
+        :return: Tuple of (response, estimated tokens reserved in the rate limiter)
+        """
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key or api_key}",
+        }
+        return post_with_rate_limit(self.chat_url, headers, data)
+
+    def list_models(self, api_key):
+        """
+        :param api_key: Caller's API key
+        :return: requests.Response of GET /models, which checks the key without spending tokens
+        """
+        headers = {"Authorization": f"Bearer {self.api_key or api_key}"}
+        # Still a request against the per-minute limit
+        rate_limiter.acquire()
+        response = get_http_session().get(f"{self.base_url}/models", headers=headers, timeout=30)
+        rate_limiter.update_from_headers(response.headers)
+        return response
+
+
+# Backend used by every API call; replace with set_llm_backend()
+llm_backend = ChatBackend()
+
+
+# Function to switch every API call to another backend
+def set_llm_backend(backend):
+    """
+    :param backend: ChatBackend instance
+    :return: The backend
+    """
+    global llm_backend
+    llm_backend = backend
+    return llm_backend
+
+
+class MockChatServer:
+    """
+    Local OpenAI-compatible chat-completion server for load tests, so
+    concurrency, rate limiting and caching changes can be benchmarked
+    reproducibly without network access or quota.
+
+    Latency follows a log-normal distribution around `latency_ms`. The
+    server enforces its own per-minute request and token limits, answering
+    429 with retry-after and x-ratelimit-* headers like the real API, and can
+    also throttle a random fraction of calls. Answers are canned SQL (a JSON
+    array for batched prompts), with token usage counted at about four
+    characters per token and cut off at max_tokens. Every choice of a call
+    sampled above temperature 0 has that probability of coming back with a
+    typo or MySQL construct, so candidate ranking has something to rank.
+    """
+
+    def __init__(self, latency_ms=200.0, latency_sigma=0.5, throttle_rate=0.0,
+                 requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE, seed=0, port=0):
+        """
+        :param latency_ms: Median response latency in milliseconds
+        :param latency_sigma: Spread of the log-normal latency distribution (0 = constant)
+        :param throttle_rate: Fraction of calls answered 429 regardless of the limits
+        :param requests_per_minute: Request limit enforced by the server (None = unlimited)
+        :param tokens_per_minute: Token limit enforced by the server (None = unlimited)
+        :param seed: Random seed, so runs are reproducible
+        :param port: Port to listen on (0 = any free port)
+        """
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.throttle_rate = throttle_rate
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.port = port
+        self.random = random.Random(seed)
+        self.window = collections.deque()  # [time, tokens] of calls in the last minute
+        self.requests = 0
+        self.throttled = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """
+        :return: Base URL of the server, for ChatBackend
+        """
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    data = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    data = {}
+                status, headers, body = mock.respond(data)
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                status, body = (200, {"object": "list", "data": [{"id": MODEL, "object": "model"}]}) \
+                    if self.path.endswith('/models') else (404, {"error": {"message": "Not found"}})
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(http.server.ThreadingHTTPServer):
+            # The default listen backlog of 5 resets connections when many workers connect at once
+            request_queue_size = 128
+
+        self.server = Server(('127.0.0.1', self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        self.base_url = self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def respond(self, data):
+        """
+        :param data: Chat-completion request body
+        :return: Tuple of (status code, extra headers, JSON body)
+        """
+        messages = data.get('messages', [])
+        max_tokens = int(data.get('max_tokens') or 1000)
+        prompt_tokens = sum(len(str(message.get('content', ''))) // 4 + 4 for message in messages)
+
+        with self.lock:
+            now = time.monotonic()
+            while self.window and now - self.window[0][0] >= 60.0:
+                self.window.popleft()
+            used_requests = len(self.window)
+            used_tokens = sum(tokens for _, tokens in self.window)
+            latency = self.latency_ms / 1000.0
+            if self.latency_sigma > 0:
+                latency *= self.random.lognormvariate(0.0, self.latency_sigma)
+            over_requests = self.requests_per_minute is not None and used_requests >= self.requests_per_minute
+            over_tokens = self.tokens_per_minute is not None and used_tokens + prompt_tokens > self.tokens_per_minute
+            throttle = over_requests or over_tokens or self.random.random() < self.throttle_rate
+            self.requests += 1
+            reset = 60.0 - (now - self.window[0][0]) if self.window else 0.0
+            entry = None
+            if throttle:
+                self.throttled += 1
+            else:
+                # This request's own entry, so its completion tokens are added to it and not to a later call's
+                entry = [now, prompt_tokens]
+                self.window.append(entry)
+
+        headers = {}
+        if self.requests_per_minute is not None:
+            headers['x-ratelimit-limit-requests'] = str(self.requests_per_minute)
+            headers['x-ratelimit-remaining-requests'] = str(max(0, self.requests_per_minute - used_requests - (0 if throttle else 1)))
+            headers['x-ratelimit-reset-requests'] = f"{reset:.2f}s"
+        if self.tokens_per_minute is not None:
+            headers['x-ratelimit-limit-tokens'] = str(self.tokens_per_minute)
+            headers['x-ratelimit-remaining-tokens'] = str(max(0, self.tokens_per_minute - used_tokens - (0 if throttle else prompt_tokens)))
+            headers['x-ratelimit-reset-tokens'] = f"{reset:.2f}s"
+        if throttle:
+            headers['retry-after'] = f"{max(1.0, reset) if over_requests or over_tokens else 1.0:.0f}"
+            return 429, headers, {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}}
+
+        time.sleep(latency)
+        content = self.answer(messages)
+        temperature = float(data.get('temperature') or 0.0)
+        with self.lock:
+            contents = [self.perturb(content) if self.random.random() < temperature else content
+                        for _ in range(int(data.get('n') or 1))]
+        choices = []
+        completion_tokens = 0
+        for number, content in enumerate(contents):
+            finish_reason = "stop"
+            if len(content) // 4 > max_tokens:
+                content = content[:max_tokens * 4]
+                finish_reason = "length"
+            completion_tokens += max(1, len(content) // 4)
+            choices.append({"index": number, "message": {"role": "assistant", "content": content},
+                            "finish_reason": finish_reason})
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            entry[1] += completion_tokens
+
+        return 200, headers, {
+            "id": f"mock-{self.requests}",
+            "object": "chat.completion",
+            "model": data.get('model', 'mock'),
+            "choices": choices,
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def stats(self):
+        """:return: Dict with the number of requests, throttled requests and tokens served"""
+        with self.lock:
+            return {"requests": self.requests, "throttled": self.throttled,
+                    "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens}
+
+    def perturb(self, content):
+        """:return: Content with a typo or MySQL construct, like a sampled answer can have (call with the lock held)"""
+        variants = [
+            content.replace("SELECT", "SELEC", 1),
+            re.sub(r'FROM (\w+)', r'FROM `\1`', content, count=1),
+            re.sub(r'LIMIT (\d+)', r'LIMIT 0, \1', content, count=1),
+            f"```sql\n{content}\n```",
+        ]
+        return self.random.choice(variants)
+
+    @staticmethod
+    def answer(messages):
+        """:return: Canned answer to a generation, correction or batched prompt"""
+        system = next((str(message.get('content', '')) for message in messages if message.get('role') == 'system'), '')
+        user = str(messages[-1].get('content', '')) if messages else ''
+
+        def canned_sql(text):
+            # Name the table after the longest word of the request ("Request: ..." prefixes dropped)
+            text = text.splitlines()[0].split(':', 1)[-1] if text else ''
+            words = [word for word in re.findall(r'[a-z_]+', text.lower()) if word not in SCHEMA_STOPWORDS]
+            table = max(words, key=len) if words else 'items'
+            return f"SELECT * FROM {table} LIMIT 10;"
+
+        if 'JSON array' in system:
+            items = re.findall(r'^(\d+)\. (.*)$', user, re.MULTILINE)
+            return json.dumps([{"id": int(number), "sql": canned_sql(text)} for number, text in items])
+        if 'Connection successful' in user:
+            return "Connection successful"
+        return canned_sql(user)
+
+
+class CircuitBreakerOpen(Exception):
+    """Raised when the API endpoint is known to be down and the call is skipped."""
+
+
+class CircuitBreaker:
+    """
+    Endpoint health tracker fed by the outcome of real API calls.
+
+    The breaker is "closed" while calls succeed. After `failure_threshold`
+    consecutive failures (or a failed startup check) it opens and calls fail
+    fast for `reset_timeout` seconds. After that, a single trial call is let
+    through ("half-open"), and its result closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        """
+        :param failure_threshold: Consecutive failures that open the breaker
+        :param reset_timeout: Seconds the breaker stays open before a trial call
+        :param clock: Monotonic time source in seconds (replaceable in tests)
+        """
+        self.clock = clock
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.clock() - self.opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow_request(self):
+        """
+        :return: True if a call may be sent to the endpoint now
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at < self.reset_timeout or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.trial_in_flight or self.consecutive_failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"API endpoint marked unhealthy after {self.consecutive_failures} failures. "
+                                   f"Skipping API calls for {self.reset_timeout} seconds.")
+                self.opened_at = self.clock()
+            self.trial_in_flight = False
+
+    def trip(self):
+        """Open the breaker immediately, e.g. when the startup check fails."""
+        with self.lock:
+            self.consecutive_failures = max(self.consecutive_failures, self.failure_threshold)
+            self.opened_at = self.clock()
+            self.trial_in_flight = False
+
+
+# Health of the chat-completion endpoint, shared by every API call
+endpoint_health = CircuitBreaker()
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of chat-completion responses.
+
+    Entries live in an SQLite database keyed by a SHA-256 hash of the
+    endpoint, model, normalized messages and temperature. max_tokens is left
+    out so a learned budget change keeps the hits; only complete answers
+    (every choice finished with "stop") are stored. SQLite's file locking
+    (in WAL mode) makes the cache safe to share between worker threads and
+    processes. Entries expire after `ttl` seconds, and the least recently
+    used ones are evicted once the entry count or total size passes its bound.
+    Eviction runs on the first store of a process and then every
+    `evict_every` stores, so a store is normally a single insert and the
+    bounds may be overshot by up to `evict_every` entries between sweeps.
+    """
+
+    def __init__(self, path, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, evict_every=RESPONSE_CACHE_EVICT_EVERY):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.stores_since_evict = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.local = threading.local()
+        self.stats_lock = threading.Lock()
+
+    def connection(self):
+        """Return this thread's SQLite connection, creating the table on first use."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " response TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(model, messages, temperature, endpoint=""):
+        """
+        Hash a request into a cache key. Message content is whitespace-normalized
+        so trivially different copies of the same prompt share one entry, and
+        the endpoint is included so different backends never share answers.
+        max_tokens is left out: only complete answers are stored, and those do
+        not depend on the completion budget, which changes as it is learned.
+        """
+        normalized = [
+            {"role": message.get("role", ""), "content": " ".join(str(message.get("content", "")).split())}
+            for message in messages
+        ]
+        payload = json.dumps(
+            {"endpoint": endpoint, "model": model, "messages": normalized, "temperature": temperature},
+            sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        :param key: Cache key from make_key()
+        :return: Cached response dictionary, or None on a miss
+        """
+        conn = self.connection()
+        now = time.time()
+        row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            row = None
+
+        with self.stats_lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key, response_json):
+        """
+        Store a response; every `evict_every` stores, also evict expired and least recently used entries.
+
+        :param key: Cache key from make_key()
+        :param response_json: Response dictionary to store
+        """
+        conn = self.connection()
+        now = time.time()
+        body = json.dumps(response_json, separators=(",", ":"))
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, body, len(body), now, now)
+        )
+        with self.stats_lock:
+            self.stores += 1
+            self.stores_since_evict += 1
+            due = self.stores_since_evict >= self.evict_every
+            if due:
+                self.stores_since_evict = 0
+        if due:
+            evicted = self.evict(conn)
+            with self.stats_lock:
+                self.evictions += evicted
+
+    def evict(self, conn):
+        """Delete expired entries, then the least recently used ones until within bounds."""
+        evicted = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.ttl is not None:
+                evicted += conn.execute("DELETE FROM responses WHERE created_at < ?",
+                                        (time.time() - self.ttl,)).rowcount
+            count, total_size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            if count > self.max_entries or total_size > self.max_bytes:
+                excess_count = max(0, count - self.max_entries)
+                excess_bytes = max(0, total_size - self.max_bytes)
+                victims = []
+                for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                    if excess_count <= 0 and excess_bytes <= 0:
+                        break
+                    victims.append((key,))
+                    excess_count -= 1
+                    excess_bytes -= size
+                conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+                evicted += len(victims)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return evicted
+
+    def stats(self):
+        """
+        :return: Dictionary with hit/miss/store/eviction counts and the hit rate
+        """
+        with self.stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Response cache shared by the generation and correction paths
+response_cache = ResponseCache(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None
+
+
+class SemanticCache:
+    """
+    Local near-duplicate cache mapping NL questions to previously generated SQL.
+
+    Questions are normalized (stop words dropped, numbers masked, synonyms
+    and plurals mapped to one word) into an order-insensitive set of words,
+    so no model download or network is needed. Two questions are duplicates
+    when their word sets are equal, so "top 10 products by sales" matches
+    "10 best-selling products" while "customers from Berlin" never matches
+    "orders from Berlin". The index is a dict keyed on that set, so a lookup
+    costs one hash probe however many entries are cached. Because numbers
+    are masked, "top 10 products" also matches "top 5 products"; the cached
+    SQL is then adapted by swapping in the new numbers, or rejected if that
+    is not possible.
+
+    Entries are appended to a JSONL file and re-indexed on the next run. Past
+    `max_entries`, the oldest entry is dropped, and the file is compacted
+    once it holds twice as many lines as the index.
+    """
+
+    STOP_WORDS = frozenset(
+        "a an the of for to in on at by with and or all any me my our us please "
+        "what which who whose where how is are was were be been that this those these there "
+        "from located based living placed made work working per each every volume than".split()
+    )
+    SYNONYMS = {
+        "show": "list", "display": "list", "get": "list", "find": "list", "fetch": "list",
+        "retrieve": "list", "return": "list", "give": "list", "select": "list",
+        "best": "top", "highest": "top", "largest": "top", "biggest": "top", "most": "top",
+        "lowest": "bottom", "smallest": "bottom", "least": "bottom", "fewest": "bottom",
+        "selling": "sale", "sold": "sale", "sell": "sale", "sales": "sale",
+        "count": "number", "many": "number", "total": "sum", "avg": "average", "mean": "average",
+        "expensive": "top price", "priciest": "top price", "cheap": "bottom price", "cheapest": "bottom price",
+    }
+    NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+    def __init__(self, path=None, max_entries=SEMANTIC_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # Normalized word set -> (NL query, SQL), oldest first
+        self.file_lines = 0
+        self.lookups = 0
+        self.hits = 0
+        self.adapted = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def tokenize(self, text):
+        """Lowercase, mask numbers, split hyphenated words and map common synonyms."""
+        text = self.NUMBER_PATTERN.sub(" 0 ", text.lower()).replace("-", " ")
+        words = []
+        for word in re.findall(r"[a-z0-9_]+", text):
+            if word in self.STOP_WORDS:
+                continue
+            if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us")) and word not in self.SYNONYMS:
+                word = word[:-1]
+            words.extend(self.SYNONYMS.get(word, word).split())
+        return words
+
+    def key(self, text):
+        """:return: Set of normalized words a question must share with a cached one to reuse its SQL"""
+        # "10 best-selling products" asks for a list as much as "List the 10 best-selling products"
+        return frozenset(word for word in self.tokenize(text) if word != "list")
+
+    def load(self):
+        """Rebuild the index from the JSONL file on first use (lock held)."""
+        self.loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Skip a torn final line from an interrupted run
+                self.insert(entry.get("NL", ""), entry.get("Query", ""))
+                self.file_lines += 1
+
+    def insert(self, nl_query, sql_query):
+        """Add one entry to the in-memory index, dropping the oldest one when full (lock held)."""
+        key = self.key(nl_query)
+        # A newer answer for the same question replaces the old one and counts as the newest entry
+        self.entries.pop(key, None)
+        self.entries[key] = (nl_query, sql_query)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def adapt(self, cached_nl, cached_sql, nl_query):
+        """
+        Rewrite the cached SQL for the new question's numbers.
+
+        :return: Adapted SQL, or None if the numbers cannot be mapped safely
+        """
+        old_numbers = self.NUMBER_PATTERN.findall(cached_nl)
+        new_numbers = self.NUMBER_PATTERN.findall(nl_query)
+        if old_numbers == new_numbers:
+            return cached_sql
+        if len(old_numbers) != len(new_numbers) or len(set(old_numbers)) != len(old_numbers):
+            return None
+
+        replacements = dict(zip(old_numbers, new_numbers))
+        for number in old_numbers:
+            if not re.search(rf"(?<![\w.]){re.escape(number)}(?![\w.])", cached_sql):
+                return None
+        return re.sub(
+            r"(?<![\w.])(\d+(?:\.\d+)?)(?![\w.])",
+            lambda match: replacements.get(match.group(1), match.group(1)),
+            cached_sql
+        )
+
+    def lookup(self, nl_query):
+        """
+        :param nl_query: NL query
+        :return: Reusable SQL for a near-duplicate question, or None
+        """
+        key = self.key(nl_query)
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            self.lookups += 1
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            cached_nl, cached_sql = entry
+
+            sql_query = self.adapt(cached_nl, cached_sql, nl_query)
+            if sql_query is None:
+                self.rejected += 1
+                return None
+            self.hits += 1
+            if sql_query != cached_sql:
+                self.adapted += 1
+            return sql_query
+
+    def add(self, nl_query, sql_query):
+        """
+        Remember a generated query and append it to the JSONL file.
+
+        :param nl_query: NL query
+        :param sql_query: SQL generated for it
+        """
+        if not nl_query or not sql_query:
+            return
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            self.insert(nl_query, sql_query)
+            if self.path:
+                with open(self.path, 'a') as file:
+                    file.write(json.dumps({"NL": nl_query, "Query": sql_query}) + "\n")
+                self.file_lines += 1
+                if self.file_lines > 2 * self.max_entries:
+                    self.compact()
+
+    def compact(self):
+        """Rewrite the JSONL file with only the entries still in the index (lock held)."""
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w') as file:
+            # Oldest first, so a reload evicts in the same order
+            for nl_query, sql_query in self.entries.values():
+                file.write(json.dumps({"NL": nl_query, "Query": sql_query}) + "\n")
+        os.replace(temporary_path, self.path)
+        self.file_lines = len(self.entries)
+
+    def stats(self):
+        """
+        :return: Dictionary with lookup/hit counts and the number of API calls saved
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "adapted": self.adapted,
+                "rejected": self.rejected,
+                "evicted": self.evicted,
+                "api_calls_saved": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            }
+
+
+# Near-duplicate cache consulted before generating SQL
+semantic_cache = SemanticCache(SEMANTIC_CACHE_PATH) if SEMANTIC_CACHE_PATH else None
+
+
+# Function to run a worker over a list of items with bounded concurrency
+def run_in_order(worker, items, concurrency=MAX_CONCURRENCY):
+    """
+    Run worker(index, item) for every item, keeping at most `concurrency`
+    calls in flight. Results are returned in the same order as the input.
+
+    :param worker: Callable taking (index, item) and returning a result
+    :param items: Iterable of input items
+    :param concurrency: Maximum number of workers running at once
+    :return: List of results, one per input item
+    """
+    return list(iter_in_order(worker, items, concurrency))
+
+
+# Function to stream a worker's results over an iterable with bounded concurrency
+def iter_in_order(worker, items, concurrency=MAX_CONCURRENCY):
+    """
+    Streaming form of run_in_order. Items are pulled from `items` lazily and
+    results are yielded in input order as soon as they are ready, so memory
+    stays bounded by the concurrency window rather than the input size.
+
+    :param worker: Callable taking (index, item) and returning a result
+    :param items: Iterable of input items (consumed once)
+    :param concurrency: Maximum number of workers running at once
+    :return: Generator of results, one per input item
+    """
+    if concurrency <= 1:
+        for index, item in enumerate(items):
+            yield worker(index, item)
+        return
+
+    get_http_session(concurrency)
+    pending = collections.deque()
+    # Let workers run ahead of a slow head item, but never buffer the whole input
+    window = concurrency * 4
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for index, item in enumerate(items):
+            pending.append(executor.submit(worker, index, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            # Hand out finished results in order without waiting for the window to fill
+            while pending and pending[0].done():
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # The consumer stopped early or a worker failed: drop items that have not started
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+# Function to run a pure function over one chunk of items in a worker process
+def run_local_chunk(function, chunk):
+    """
+    :return: Tuple of (results, drained worker metrics) so the parent can merge stage timings
+    """
+    return [function(item) for item in chunk], metrics.drain()
+
+
+# Function to give each local-stage worker process its own metrics and the parent's schema
+def init_local_worker(profiling, schema_tables=None):
+    """
+    :param profiling: Whether the parent times the local stages
+    :param schema_tables: Tables of the parent's schema index (the rewrites consult it), or None
+    """
+    global metrics, schema_index
+    metrics = Metrics(jsonl_path=None, profiling=profiling)
+    schema_index = SchemaIndex(schema_tables) if schema_tables is not None else None
+
+
+# Start method of the local-stage pool. Forking a process that already runs
+# API and HTTP threads can copy locks those threads hold, so workers start
+# from a clean interpreter instead.
+LOCAL_STAGE_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+
+# Function to run a CPU-bound local stage over a process pool
+def iter_local_stage(function, items, processes=LOCAL_STAGE_PROCESSES, chunk_size=LOCAL_STAGE_CHUNK_SIZE,
+                     min_items=LOCAL_STAGE_MIN_ITEMS):
+    """
+    Map a pure, module-level function over items on a process pool, yielding
+    results lazily and in input order. Items are sent in chunks and at most
+    two chunks per process are in flight, so the stage runs ahead of its
+    consumer (e.g. while API calls for earlier items are in flight) without
+    buffering the whole input. Small inputs, where starting processes would
+    cost more than it saves, run in this process. Workers start from a fresh
+    interpreter (forkserver or spawn) with the parent's profiling setting and
+    schema index, so their output matches this process's, and their stage
+    timings are merged into this process's metrics.
+
+    :param function: Picklable function taking one item
+    :param items: Iterable of items (consumed once)
+    :param processes: Number of worker processes (1 = run in this process)
+    :param chunk_size: Items per task sent to a worker
+    :param min_items: Inputs with fewer items run in this process
+    :return: Generator of results, one per input item
+    """
+    items = iter(items)
+    head = list(itertools.islice(items, min_items))
+    if processes <= 1 or len(head) < min_items:
+        for item in itertools.chain(head, items):
+            yield function(item)
+        return
+
+    items = itertools.chain(head, items)
+    pending = collections.deque()
+
+    def collect(future):
+        results, (counters, histograms) = future.result()
+        metrics.merge(counters, histograms)
+        return results
+
+    schema_tables = dict(schema_index.tables) if schema_index is not None else None
+    with ProcessPoolExecutor(max_workers=processes, mp_context=LOCAL_STAGE_CONTEXT, initializer=init_local_worker,
+                             initargs=(metrics.profiling, schema_tables)) as executor:
+        try:
+            while True:
+                chunk = list(itertools.islice(items, chunk_size))
+                if not chunk:
+                    break
+                pending.append(executor.submit(run_local_chunk, function, chunk))
+                if len(pending) >= processes * 2:
+                    yield from collect(pending.popleft())
+            while pending:
+                yield from collect(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+# Function to strip markdown code fences from a model response
+def strip_markdown_fences(sql_query):
+    """
+    Remove markdown code block formatting from an SQL string, if present.
+
+    :param sql_query: SQL text returned by the model
+    :return: SQL text without markdown fences
+    """
+    if "```" in sql_query:
+        # Extract content between SQL code blocks
+        sql_match = re.search(r"```(?:sql)?(.*?)```", sql_query, re.DOTALL)
+        if sql_match:
+            sql_query = sql_match.group(1).strip()
+        else:
+            # If regex fails, use simple string splitting
+            sql_query = sql_query.replace("```sql", "").replace("```", "").strip()
+    return sql_query
+
+
+# System prompts of the two tasks
+# Instructions are stated once, in the system prompt; user messages carry only the item
+GENERATION_SYSTEM_PROMPT = "You are a PostgreSQL expert. Answer each request with one PostgreSQL query only: no explanations, no markdown."
+CORRECTION_SYSTEM_PROMPT = "You are a PostgreSQL expert. Fix the query so it is valid PostgreSQL. Answer with the corrected SQL only: no explanations, no markdown."
+
+# Output contract appended to the system prompt of a batched call
+BATCH_CONTRACT = (
+    " You will receive a numbered list of items. Answer every item and return only a JSON array,"
+    " in the same order, of objects of the form {\"id\": <item number>, \"sql\": \"<SQL query>\"}."
+    " Do not add explanations or markdown."
+)
+
+
+# Function to read the answers of a batched prompt
+def parse_batch_answers(content, count):
+    """
+    Objects are decoded one at a time, so an answer cut off by max_tokens
+    still yields every item before the cut.
+
+    :param content: Model response to a batched prompt
+    :param count: Number of items in the batch
+    :return: List of `count` SQL strings, None where an answer is missing or malformed
+    """
+    answers = [None] * count
+    text = strip_markdown_fences(content or '')
+    position = text.find('[')
+    if position < 0:
+        return answers
+    decoder = json.JSONDecoder()
+    position += 1
+    sequence = 0
+    while True:
+        while position < len(text) and (text[position].isspace() or text[position] == ','):
+            position += 1
+        if position >= len(text) or text[position] == ']':
+            break
+        try:
+            value, position = decoder.raw_decode(text, position)
+        except ValueError:
+            break
+        sequence += 1
+        if isinstance(value, dict):
+            number, answer = value.get('id', sequence), value.get('sql')
+        else:
+            number, answer = sequence, value
+        if isinstance(number, str) and number.strip().isdigit():
+            number = int(number)
+        if isinstance(number, int) and 1 <= number <= count and isinstance(answer, str) \
+                and answer.strip() and answers[number - 1] is None:
+            answers[number - 1] = answer.strip()
+    return answers
+
+
+class PromptBatcher:
+    """
+    Packs several items into one chat-completion call: a numbered list in the
+    user message and a JSON array contract for the answer, so the system
+    prompt and the per-request overhead are paid once per batch.
+
+    Batches are cut so that the estimated prompt stays under max_prompt_tokens
+    and the expected answers fit in max_tokens. The size limit halves after a
+    batch whose answer could not be parsed completely and grows back by one
+    after each complete batch.
+    """
+
+    def __init__(self, system_prompt, instruction, max_batch_size=BATCH_SIZE, max_tokens=BATCH_MAX_TOKENS,
+                 max_prompt_tokens=BATCH_MAX_PROMPT_TOKENS, tokens_per_answer=150):
+        self.system_prompt = system_prompt + BATCH_CONTRACT
+        self.instruction = instruction
+        self.max_batch_size = max_batch_size
+        self.batch_size = max_batch_size
+        self.max_tokens = max_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.tokens_per_answer = tokens_per_answer
+        self.lock = threading.Lock()
+
+    def answer_budget(self, entry):
+        # Room for a fresh query, plus the length of any SQL quoted in the entry
+        return self.tokens_per_answer + estimate_tokens(entry)
+
+    def plan(self, items, entry_of):
+        """
+        :param items: Iterable of input items
+        :param entry_of: Callable returning the prompt text of an item, or None if it needs no API call
+        :return: Generator of batches, each a list of (index, item) pairs in input order
+        """
+        base_tokens = estimate_tokens(self.system_prompt) + estimate_tokens(self.instruction)
+        batch = []
+        entries = 0
+        prompt_tokens = base_tokens
+        answer_tokens = 0
+        for index, item in enumerate(items):
+            entry = entry_of(item)
+            if entry is not None:
+                entry_tokens = estimate_tokens(entry) + 4
+                answer = self.answer_budget(entry)
+                if entries and (entries >= self.batch_size or prompt_tokens + entry_tokens > self.max_prompt_tokens
+                                or answer_tokens + answer > self.max_tokens):
+                    yield batch
+                    batch, entries, prompt_tokens, answer_tokens = [], 0, base_tokens, 0
+                entries += 1
+                prompt_tokens += entry_tokens
+                answer_tokens += answer
+            batch.append((index, item))
+        if batch:
+            yield batch
+
+    def call(self, api_key, model, entries):
+        """
+        Send one batched request.
+
+        :param entries: Prompt texts of the items
+        :return: List of answers (None for items missing from the response), or None if the request failed
+        """
+        numbered = "\n".join(f"{number}. {entry}" for number, entry in enumerate(entries, 1))
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": f"{self.instruction}\n{numbered}"}
+        ]
+        max_tokens = min(self.max_tokens, sum(self.answer_budget(entry) for entry in entries))
+        try:
+            response, tokens_used = call_groq_api(api_key, model, messages, max_tokens=max_tokens)
+            content = response['choices'][0]['message']['content']
+        except CircuitBreakerOpen:
+            raise
+        except Exception as api_error:
+            logger.warning(f"Batched API call error for {len(entries)} items: {str(api_error)}")
+            return None
+
+        answers = parse_batch_answers(content, len(entries))
+        with self.lock:
+            if None in answers:
+                self.batch_size = max(1, self.batch_size // 2)
+            else:
+                self.batch_size = min(self.max_batch_size, self.batch_size + 1)
+        return answers
+
+    def answer(self, api_key, model, entries):
+        """
+        Answer a batch, retrying only the items that failed to parse in smaller
+        batches. Items still unanswered at the end (single items, or all of them
+        after a failed request) stay None so the caller can send them through
+        the regular per-item prompt.
+
+        :param entries: Prompt texts of the items
+        :return: List of answers, None where batching did not produce one
+        """
+        answers = self.call(api_key, model, entries)
+        if answers is None:
+            return [None] * len(entries)
+        missing = [position for position, answer in enumerate(answers) if answer is None]
+        if len(missing) == len(entries):
+            # Nothing usable came back: retry in halves
+            groups = [missing[:len(missing) // 2], missing[len(missing) // 2:]]
+        else:
+            groups = [missing]
+        for group in groups:
+            if len(group) < 2:
+                continue
+            retried = self.answer(api_key, model, [entries[position] for position in group])
+            for position, answer in zip(group, retried):
+                answers[position] = answer
+        return answers
+
+
+# Function to generate SQL statements
+def generate_sqls(data, concurrency=MAX_CONCURRENCY, batch_size=BATCH_SIZE, candidates=CANDIDATES):
+    """
+    Generate SQL statements from the NL queries.
+
+    :param data: List of NL queries
+    :param concurrency: Maximum number of API calls in flight at once
+    :param batch_size: Maximum number of NL queries sent in one API call
+    :param candidates: Candidate queries requested per question and ranked locally
+    :return: List of SQL statements
+    """
+    return list(iter_generate_sqls(data, concurrency, batch_size=batch_size, candidates=candidates))
+
+
+# Function to generate SQL statements as a stream
+def iter_generate_sqls(data, concurrency=MAX_CONCURRENCY, journal=None, batch_size=BATCH_SIZE,
+                       candidates=CANDIDATES):
+    """
+    Streaming form of generate_sqls: yields each result, in input order, as soon as it is ready.
+
+    :param data: Iterable of NL queries (e.g. from iter_input_items)
+    :param concurrency: Maximum number of API calls in flight at once
+    :param journal: Optional CheckpointJournal to replay and record finished items
+    :param batch_size: Maximum number of NL queries sent in one API call (1 disables batching)
+    :param candidates: Candidate queries requested per question and ranked locally (1 disables
+        speculation; batched prompts always get one answer per question)
+    :return: Generator of SQL statements
+    """
+    total = f"/{len(data)}" if hasattr(data, '__len__') else ""
+    api_key = API_KEY
+    model = MODEL
+    # Without n > 1 support every worker fans out to one request per candidate
+    get_http_session(concurrency * candidate_requests(candidates))
+
+    def generate_locally(nl_query):
+        # Empty NL queries and near-duplicates of answered questions need no API call
+        if not nl_query:
+            return ""
+        if semantic_cache is not None:
+            return semantic_cache.lookup(nl_query)
+        return None
+
+    def schema_context(nl_query):
+        # Only the tables and columns relevant to this question, when a schema is configured
+        return schema_index.context(nl_query) if schema_index is not None else ""
+
+    def finish(index, nl_query, sql_query, alternatives=()):
+        # Clean up the SQL (remove any markdown formatting if present)
+        with metrics.profile("strip_fences"):
+            sql_query = strip_markdown_fences(sql_query)
+
+        # Ensure PostgreSQL compatibility
+        with metrics.profile("compatibility"):
+            sql_query = ensure_postgresql_compatibility(sql_query)
+
+        # Check that the query runs, falling back to the other candidates and then one repair attempt
+        sql_query, error = verify_and_repair(api_key, model, nl_query, sql_query, alternatives)
+
+        # Only SQL that passes the offline check and the database (when configured) is reused
+        if semantic_cache is not None and error is None and sql_query and not validate_postgresql(sql_query):
+            semantic_cache.add(nl_query, sql_query)
+
+        # Progress tracking; answers served entirely from the response cache never reached the backend
+        metrics.increment("items_total", task="generate", source=item_source())
+        if (index + 1) % 10 == 0:
+            logger.info(f"Generated {index + 1}{total} SQL queries, Total tokens used: {total_tokens}")
+
+        return {"NL": nl_query, "Query": sql_query}
+
+    def generate_candidates(index, nl_query, messages):
+        # Several answers from one round trip, ranked locally, instead of a later correction round trip
+        try:
+            answers = request_sql_candidates(api_key, model, messages, token_budget.kind("generate", nl_query),
+                                             candidates)
+        except CircuitBreakerOpen:
+            return {"NL": nl_query, "Query": ""}
+        except Exception as api_error:
+            logger.warning(f"API call error for query '{nl_query}': {str(api_error)}")
+            return {"NL": nl_query, "Query": ""}
+
+        ranked = rank_sql_candidates(answers)
+        if not ranked:
+            logger.warning(f"No usable candidate for query '{nl_query}'")
+            return {"NL": nl_query, "Query": ""}
+        metrics.increment("candidates_total", len(answers))
+        return finish(index, nl_query, ranked[0], ranked[1:])
+
+    def generate_one(index, item):
+        nl_query = item.get('NL', '')
+
+        # Skip empty NL queries and reuse the SQL of a previously answered near-duplicate question
+        local_sql = generate_locally(nl_query)
+        if local_sql is not None:
+            metrics.increment("items_total", task="generate", source="local")
+            return {"NL": nl_query, "Query": local_sql}
+
+        # Prepare PostgreSQL-specific prompt
+        request = f"Request: {nl_query}"
+        context = schema_context(nl_query)
+        if context:
+            request += f"\nUse these tables: {context}"
+        messages = [
+            {
+                "role": "system",
+                "content": GENERATION_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": request
+            }
+        ]
+        call_usage.requests = 0
+        if candidates > 1:
+            return generate_candidates(index, nl_query, messages)
+
+        try:
+            # Call the API with proper error handling
+            try:
+                response, tokens_used = call_with_budget(api_key, model, messages,
+                                                         token_budget.kind("generate", nl_query))
+            except CircuitBreakerOpen:
+                # Endpoint is known to be down; fail fast without a network round trip
+                return {"NL": nl_query, "Query": ""}
+            except Exception as api_error:
+                logger.warning(f"API call error for query '{nl_query}': {str(api_error)}")
+                # If we get an API error, add empty result and continue
+                return {"NL": nl_query, "Query": ""}
+
+            # Check if response contains expected keys
+            if not response or 'choices' not in response or not response['choices']:
+                logger.warning(f"Invalid API response for query '{nl_query}': {response}")
+                return {"NL": nl_query, "Query": ""}
+
+            # Extract the SQL query from the response
+            try:
+                sql_query = response['choices'][0]['message']['content'].strip()
+            except (KeyError, IndexError) as e:
+                logger.warning(f"Failed to extract SQL from response for query '{nl_query}': {str(e)}")
+                logger.warning(f"Response structure: {response}")
+                return {"NL": nl_query, "Query": ""}
+
+            return finish(index, nl_query, sql_query)
+
+        except Exception as e:
+            logger.warning(f"Unexpected error for query '{nl_query}': {str(e)}")
+            return {"NL": nl_query, "Query": ""}
+
+    single = journal.wrap(generate_one) if journal is not None else generate_one
+    if batch_size <= 1:
+        return iter_in_order(single, data, concurrency)
+
+    batcher = PromptBatcher(GENERATION_SYSTEM_PROMPT,
+                            "Convert each of the following requests to PostgreSQL SQL syntax:", batch_size)
+
+    def generation_entry(item):
+        nl_query = item.get('NL', '')
+        if not nl_query:
+            return None
+        context = schema_context(nl_query)
+        return f"{nl_query}\n   Use these tables: {context}" if context else nl_query
+
+    def generate_batch(batch_number, batch):
+        results = {}
+        pending = []
+        for index, item in batch:
+            if journal is not None and index in journal.completed:
+                results[index] = single(index, item)
+                continue
+            nl_query = item.get('NL', '')
+            local_sql = generate_locally(nl_query)
+            if local_sql is not None:
+                metrics.increment("items_total", task="generate", source="local")
+                results[index] = {"NL": nl_query, "Query": local_sql}
+                if journal is not None:
+                    journal.record(index, results[index], 0)
+            else:
+                pending.append((index, item, nl_query))
+
+        if pending:
+            call_usage.tokens = 0
+            call_usage.requests = 0
+            try:
+                answers = batcher.answer(api_key, model, [generation_entry(item) for _, item, _ in pending])
+            except CircuitBreakerOpen:
+                answers = [""] * len(pending)
+            share = call_usage.tokens // len(pending)
+            for (index, item, nl_query), answer in zip(pending, answers):
+                if answer is None:
+                    # Fall back to the regular per-item prompt
+                    results[index] = single(index, item)
+                elif not answer:
+                    results[index] = {"NL": nl_query, "Query": ""}
+                else:
+                    results[index] = finish(index, nl_query, answer)
+                    if journal is not None:
+                        journal.record(index, results[index], share)
+
+        return [results[index] for index, _ in batch]
+
+    batches = batcher.plan(data, generation_entry)
+    return (result for results in iter_in_order(generate_batch, batches, concurrency) for result in results)
+
+
+# Function to correct SQL statements
+def correct_sqls(sql_statements, concurrency=MAX_CONCURRENCY, batch_size=BATCH_SIZE,
+                 processes=LOCAL_STAGE_PROCESSES):
+    """
+    Correct SQL statements if necessary.
+
+    :param sql_statements: List of Dict with incorrect SQL statements and NL query
+    :param concurrency: Maximum number of API calls in flight at once
+    :param batch_size: Maximum number of queries sent in one API call
+    :param processes: Worker processes for the local fix and validation stage
+    :return: List of corrected SQL statements
+    """
+    return list(iter_correct_sqls(sql_statements, concurrency, batch_size=batch_size, processes=processes))
+
+
+# Function to correct SQL statements as a stream
+def iter_correct_sqls(sql_statements, concurrency=MAX_CONCURRENCY, journal=None, batch_size=BATCH_SIZE,
+                      processes=LOCAL_STAGE_PROCESSES):
+    """
+    Streaming form of correct_sqls: yields each result, in input order, as soon as it is ready.
+
+    :param sql_statements: Iterable of Dict with incorrect SQL statements and NL query
+    :param concurrency: Maximum number of API calls in flight at once
+    :param journal: Optional CheckpointJournal to replay and record finished items
+    :param batch_size: Maximum number of queries sent in one API call (1 disables batching)
+    :param processes: Worker processes for the local fix and validation stage
+    :return: Generator of corrected SQL statements
+    """
+    total = f"/{len(sql_statements)}" if hasattr(sql_statements, '__len__') else ""
+    api_key = API_KEY
+    model = MODEL
+
+    def finish(index, nl_query, incorrect_query, corrected_query):
+        # Clean up the SQL (remove any markdown formatting if present)
+        with metrics.profile("strip_fences"):
+            corrected_query = strip_markdown_fences(corrected_query)
+
+        # Ensure PostgreSQL compatibility
+        with metrics.profile("compatibility"):
+            corrected_query = ensure_postgresql_compatibility(corrected_query)
+
+        # Check that the query runs, with one repair attempt if it does not
+        corrected_query, _ = verify_and_repair(api_key, model, nl_query, corrected_query)
+
+        # Progress tracking; answers served entirely from the response cache never reached the backend
+        metrics.increment("items_total", task="correct", source=item_source())
+        if (index + 1) % 10 == 0:
+            logger.info(f"Corrected {index + 1}{total} SQL queries, Total tokens used: {total_tokens}")
+
+        return {"IncorrectQuery": incorrect_query, "CorrectQuery": corrected_query}
+
+    def correct_one(index, item, classified=None):
+        nl_query = item.get('NL', '')
+        incorrect_query = item.get('IncorrectQuery', '')
+
+        # Skip if incorrect query is empty
+        if not incorrect_query:
+            return {"IncorrectQuery": incorrect_query, "CorrectQuery": ""}
+
+        # First, fix common PostgreSQL syntax errors locally and validate the result;
+        # only queries that are still broken need an API call
+        status, fixed_query = classified or classify_sql_correction(incorrect_query)
+        if status != "broken":
+            metrics.increment("items_total", task="correct", source=status)
+            fixed_query, _ = verify_and_repair(api_key, model, nl_query, fixed_query)
+            return {"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query}
+
+        # Prepare PostgreSQL-specific prompt
+        messages = [
+            {
+                "role": "system",
+                "content": CORRECTION_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": f"Request: {nl_query}\nQuery: {incorrect_query}"
+            }
+        ]
+        call_usage.requests = 0
+
+        try:
+            # Call the API with proper error handling
+            try:
+                response, tokens_used = call_with_budget(api_key, model, messages,
+                                                         token_budget.kind("correct", incorrect_query))
+            except CircuitBreakerOpen:
+                # Endpoint is known to be down; keep the local fix
+                return {"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query}
+            except Exception as api_error:
+                logger.warning(f"API call error for correction: {str(api_error)}")
+                return {"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query}
+
+            # Check if response contains expected keys
+            if not response or 'choices' not in response or not response['choices']:
+                logger.warning(f"Invalid API response for correction: {response}")
+                return {"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query}
+
+            # Extract the corrected SQL query from the response
+            try:
+                corrected_query = response['choices'][0]['message']['content'].strip()
+            except (KeyError, IndexError) as e:
+                logger.warning(f"Failed to extract SQL from correction response: {str(e)}")
+                logger.warning(f"Response structure: {response}")
+                return {"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query}
+
+            return finish(index, nl_query, incorrect_query, corrected_query)
+
+        except Exception as e:
+            logger.warning(f"Unexpected error for correction: {str(e)}")
+            return {"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query}
+
+    def correct_pair(index, pair):
+        item, classified = pair
+        return correct_one(index, item, classified)
+
+    single = journal.wrap(correct_pair) if journal is not None else correct_pair
+
+    # The local fix and validation run as their own stage on a process pool, ahead of
+    # the API calls, which then only see (item, classification) pairs
+    classified_items = iter_local_stage(classify_correction_item, sql_statements, processes)
+
+    if batch_size <= 1:
+        return iter_in_order(single, classified_items, concurrency)
+
+    batcher = PromptBatcher(CORRECTION_SYSTEM_PROMPT,
+                            "Fix each of the following incorrect PostgreSQL queries:", batch_size)
+
+    def correction_entry(pair):
+        item, (status, fixed_query) = pair
+        if status != "broken":
+            return None
+        return f"Request: {item.get('NL', '')}\n   Query: {item.get('IncorrectQuery', '')}"
+
+    def correct_batch(batch_number, batch):
+        results = {}
+        pending = []
+        for index, pair in batch:
+            journaled = journal is not None and index in journal.completed
+            if pair[1][0] == "broken" and not journaled:
+                pending.append((index, pair))
+            else:
+                # Journaled, empty or locally fixed: no API call needed
+                results[index] = single(index, pair)
+
+        if pending:
+            call_usage.tokens = 0
+            call_usage.requests = 0
+            try:
+                answers = batcher.answer(api_key, model, [correction_entry(pair) for _, pair in pending])
+            except CircuitBreakerOpen:
+                answers = [""] * len(pending)
+            share = call_usage.tokens // len(pending)
+            for (index, (item, classified)), answer in zip(pending, answers):
+                if answer is None:
+                    # Fall back to the regular per-item prompt
+                    results[index] = single(index, (item, classified))
+                elif not answer:
+                    # Endpoint is known to be down; keep the local fix
+                    results[index] = {"IncorrectQuery": item.get('IncorrectQuery', ''), "CorrectQuery": classified[1]}
+                else:
+                    results[index] = finish(index, item.get('NL', ''), item.get('IncorrectQuery', ''), answer)
+                    if journal is not None:
+                        journal.record(index, results[index], share)
+
+        return [results[index] for index, _ in batch]
+
+    batches = batcher.plan(classified_items, correction_entry)
+    return (result for results in iter_in_order(correct_batch, batches, concurrency) for result in results)
+
+
+# Tokenizer for the local SQL rewriter. String literals, quoted identifiers and
+# comments come out as single tokens, so rewrites never look inside them.
+SQL_TOKEN_PATTERN = re.compile(r"""
+      \s+                                           # whitespace
+    | --[^\n]*                                      # line comment
+    | /\*.*?(?:\*/|\Z)                              # block comment
+    | [Ee]'(?:[^'\\]|\\.|'')*(?:'|\Z)               # escape string E'...'
+    | '(?:[^']|'')*(?:'|\Z)                         # string literal
+    | "(?:[^"]|"")*(?:"|\Z)                         # quoted identifier
+    | `[^`]*(?:`|\Z)                                # MySQL backtick identifier
+    | \$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?(?:\$(?P=tag)\$|\Z)  # dollar-quoted string, $$...$$ or $fn$...$fn$
+    | [^\W\d][\w$]*                                 # keyword or identifier
+    | (?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?          # number
+    | ::|<=|>=|<>|!=|\|\||->>|->|!~\*|!~|~\*|\#>>|\#>|@>|<@|&&
+    | .                                             # any other character
+""", re.VERBOSE | re.DOTALL)
+
+TERMINATED_ESCAPE_STRING = re.compile(r"[Ee]'(?:[^'\\]|\\.|'')*'", re.DOTALL)
+DOLLAR_QUOTE_PATTERN = re.compile(r"\$(?:[A-Za-z_]\w*)?\$")
+
+
+def tokenize_sql(sql_query):
+    """
+    :param sql_query: SQL text
+    :return: List of token strings; joining them gives back the original text
+    """
+    return [match.group() for match in SQL_TOKEN_PATTERN.finditer(sql_query)]
+
+
+def is_significant(token):
+    """True for tokens other than whitespace and comments."""
+    return not (token[0].isspace() or token.startswith('--') or token.startswith('/*'))
+
+
+def is_word(token):
+    """True for keywords and unquoted identifiers."""
+    return (token[0].isalpha() or token[0] == '_') and "'" not in token
+
+
+def is_string_literal(token):
+    return token[0] == "'" or token[:2] in ("E'", "e'") or dollar_quote_tag(token) is not None
+
+
+def dollar_quote_tag(token):
+    """:return: Opening delimiter of a dollar-quoted string ("$$" or "$fn$"), or None for other tokens"""
+    match = DOLLAR_QUOTE_PATTERN.match(token) if token[0] == '$' else None
+    return match.group() if match else None
+
+
+def is_quoted_identifier(token):
+    return token[0] in '"`'
+
+
+def is_unterminated(token):
+    """True for a string, quoted identifier or block comment cut off by the end of the query."""
+    first = token[0]
+    if first in "'\"":
+        return len(token) < 2 or token.count(first) % 2 == 1
+    if first == '`':
+        return len(token) < 2 or not token.endswith('`')
+    if token[:2] in ("E'", "e'"):
+        return not TERMINATED_ESCAPE_STRING.fullmatch(token)
+    if token.startswith('/*'):
+        return len(token) < 4 or not token.endswith('*/')
+    tag = dollar_quote_tag(token)
+    if tag is not None:
+        return len(token) < 2 * len(tag) or not token.endswith(tag)
+    return False
+
+
+def next_significant(tokens, index):
+    """:return: Index of the first significant token after `index`, or None"""
+    for position in range(index + 1, len(tokens)):
+        if is_significant(tokens[position]):
+            return position
+    return None
+
+
+def prev_significant(tokens, index):
+    """:return: Index of the last significant token before `index`, or None"""
+    for position in range(index - 1, -1, -1):
+        if is_significant(tokens[position]):
+            return position
+    return None
+
+
+def find_closing_bracket(tokens, open_index):
+    """:return: Index of the bracket closing tokens[open_index], or None if unbalanced"""
+    depth = 0
+    for position in range(open_index, len(tokens)):
+        token = tokens[position]
+        if token == '(' or token == '[':
+            depth += 1
+        elif token == ')' or token == ']':
+            depth -= 1
+            if depth == 0:
+                return position
+    return None
+
+
+def split_call_arguments(tokens, open_index, close_index):
+    """
+    :return: Stripped text of each top-level argument between the brackets
+    """
+    arguments = []
+    depth = 0
+    start = open_index + 1
+    for position in range(open_index + 1, close_index):
+        token = tokens[position]
+        if token == '(' or token == '[':
+            depth += 1
+        elif token == ')' or token == ']':
+            depth -= 1
+        elif token == ',' and depth == 0:
+            arguments.append(''.join(tokens[start:position]).strip())
+            start = position + 1
+    arguments.append(''.join(tokens[start:close_index]).strip())
+    return arguments
+
+
+def rewrite_calls(tokens, name, rewrite):
+    """
+    Replace calls name(...) with rewrite(arguments) wherever it returns text.
+    Arguments are split on top-level commas only, so nested calls and
+    literals containing commas or parentheses stay intact. The replacement
+    is tokenized and scanned again, so nested calls are rewritten too; it
+    must not start with a call that `rewrite` would accept again.
+
+    :param tokens: Token list, modified in place
+    :param name: Upper-case function name
+    :param rewrite: Callable taking the list of argument texts, returning text or None
+    :return: True if anything changed
+    """
+    changed = False
+    position = 0
+    name_length = len(name)
+    while position < len(tokens):
+        token = tokens[position]
+        # Only an unquoted word can equal the bare name, so no is_word() check is needed
+        if len(token) == name_length and token.upper() == name:
+            open_index = next_significant(tokens, position)
+            previous = prev_significant(tokens, position)
+            if open_index is not None and tokens[open_index] == '(' and (previous is None or tokens[previous] != '.'):
+                close_index = find_closing_bracket(tokens, open_index)
+                if close_index is not None:
+                    replacement = rewrite(split_call_arguments(tokens, open_index, close_index))
+                    if replacement is not None:
+                        tokens[position:close_index + 1] = tokenize_sql(replacement)
+                        changed = True
+                        continue
+        position += 1
+    return changed
+
+
+def last_significant(tokens):
+    return prev_significant(tokens, len(tokens))
+
+
+# Misspelled keywords fixed locally. Only all-caps spellings are corrected,
+# since lower-case words such as "form" are plausible column names, and only
+# where a keyword belongs (see is_keyword_typo).
+KEYWORD_TYPOS = {
+    'SELET': 'SELECT', 'SLECT': 'SELECT', 'SELCT': 'SELECT', 'SEELCT': 'SELECT',
+    'FORM': 'FROM', 'FRMO': 'FROM', 'FOMR': 'FROM',
+    'HWERE': 'WHERE', 'WERE': 'WHERE', 'WHRE': 'WHERE', 'WEHRE': 'WHERE',
+    'JION': 'JOIN', 'JIN': 'JOIN',
+    'GRUOP': 'GROUP', 'GROPU': 'GROUP', 'GORUP': 'GROUP',
+    'ODER': 'ORDER', 'OREDR': 'ORDER', 'ORDR': 'ORDER',
+    'HAVNG': 'HAVING', 'HAIVNG': 'HAVING',
+    'LIMT': 'LIMIT', 'LMIT': 'LIMIT',
+}
+
+
+# Keywords after which a misspelled keyword can only be a keyword: statement starts,
+# join modifiers, and words that end an expression ("ORDER BY x DESC LIMT 5")
+TYPO_KEYWORD_BEFORE = frozenset((
+    'UNION', 'INTERSECT', 'EXCEPT', 'ALL', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS', 'NATURAL',
+    'ASC', 'DESC', 'NULL', 'TRUE', 'FALSE', 'END', 'FIRST', 'LAST',
+))
+
+
+def is_keyword_typo(tokens, position):
+    """
+    True if tokens[position] is a misspelled keyword standing where a keyword
+    belongs: at the start of a statement, or right after a select list, table
+    or expression. "SELECT * FORM t" is a typo, but in "WHERE FORM = 1" or
+    "SELECT FORM FROM t" FORM is a column and stays as written.
+    """
+    token = tokens[position]
+    if token not in KEYWORD_TYPOS:
+        return False
+    previous = prev_significant(tokens, position)
+    following = next_significant(tokens, position)
+    before = tokens[previous] if previous is not None else None
+    after = tokens[following] if following is not None else None
+    # Leave qualified names, function calls and operands of an operator alone
+    if before == '.' or after in ('(', '.', ',', ')', '::', '[') or after in BINARY_OPERATORS:
+        return False
+    if KEYWORD_TYPOS[token] in ('GROUP', 'ORDER') and after is not None and after.upper() == 'BY':
+        return True
+    if before in (None, ';', '(', ')', '*') or is_string_literal(before) or before[0].isdigit():
+        return True
+    if is_quoted_identifier(before):
+        return True
+    return is_word(before) and (before.upper() not in SQL_KEYWORDS or before.upper() in TYPO_KEYWORD_BEFORE)
+
+
+def fix_keyword_typos(tokens):
+    changed = False
+    for position, token in enumerate(tokens):
+        if is_keyword_typo(tokens, position):
+            tokens[position] = KEYWORD_TYPOS[token]
+            changed = True
+    return changed
+
+
+def fix_doubled_keywords(tokens):
+    changed = False
+    position = 0
+    while position < len(tokens):
+        upper = tokens[position].upper() if is_word(tokens[position]) else None
+        if upper in ('SELECT', 'FROM', 'WHERE', 'HAVING'):
+            following = next_significant(tokens, position)
+            if following is not None and tokens[following].upper() == upper:
+                del tokens[position + 1:following + 1]
+                changed = True
+                continue
+        elif upper in ('GROUP', 'ORDER'):
+            by = next_significant(tokens, position)
+            again = next_significant(tokens, by) if by is not None else None
+            again_by = next_significant(tokens, again) if again is not None else None
+            if (again_by is not None and tokens[by].upper() == 'BY' and tokens[again].upper() == upper
+                    and tokens[again_by].upper() == 'BY'):
+                del tokens[by + 1:again_by + 1]
+                changed = True
+                continue
+        position += 1
+    return changed
+
+
+CLAUSE_KEYWORDS = frozenset(('SELECT', 'FROM', 'WHERE', 'GROUP', 'ORDER', 'HAVING', 'JOIN'))
+GLUED_KEYWORD_PATTERN = re.compile(r'^(.*[a-z0-9])(SELECT|FROM|WHERE|GROUP|ORDER|HAVING|JOIN)$')
+
+
+def fix_missing_spaces(tokens):
+    """
+    Separate clause keywords glued to what precedes them: "nameFROM" or
+    "COUNT(*)FROM". Identifiers such as USER_FROM are left alone because
+    the keyword must follow a lower-case letter or digit.
+    """
+    changed = False
+    position = 0
+    while position < len(tokens):
+        token = tokens[position]
+        if is_word(token):
+            match = GLUED_KEYWORD_PATTERN.match(token)
+            if match:
+                following = next_significant(tokens, position)
+                if match.group(2) not in ('GROUP', 'ORDER') or (following is not None and tokens[following].upper() == 'BY'):
+                    tokens[position:position + 1] = [match.group(1), ' ', match.group(2)]
+                    changed = True
+            elif token.upper() in CLAUSE_KEYWORDS and position > 0:
+                previous = tokens[position - 1]
+                if previous == ')' or is_string_literal(previous) or is_quoted_identifier(previous) or previous[0].isdigit():
+                    tokens.insert(position, ' ')
+                    changed = True
+        position += 1
+    return changed
+
+
+# MySQL DATE_FORMAT specifiers and their PostgreSQL TO_CHAR equivalents
+MYSQL_DATE_FORMATS = {
+    '%Y': 'YYYY', '%y': 'YY', '%m': 'MM', '%c': 'FMMM', '%d': 'DD', '%e': 'FMDD',
+    '%H': 'HH24', '%k': 'FMHH24', '%h': 'HH12', '%I': 'HH12', '%l': 'FMHH12', '%i': 'MI',
+    '%s': 'SS', '%S': 'SS', '%f': 'US', '%p': 'AM', '%M': 'FMMonth', '%b': 'Mon',
+    '%W': 'FMDay', '%a': 'Dy', '%j': 'DDD', '%%': '%',
+}
+
+
+def rewrite_date_format(arguments):
+    if len(arguments) != 2 or len(arguments[1]) < 2 or arguments[1][0] not in '\'"' or arguments[1][-1] != arguments[1][0]:
+        return None
+    mysql_format = arguments[1][1:-1]
+    postgres_format = re.sub(r'%.', lambda match: MYSQL_DATE_FORMATS.get(match.group(), match.group()), mysql_format)
+    return f"TO_CHAR({arguments[0]}, '{postgres_format}')"
+
+
+def fix_function_calls(tokens):
+    """MySQL/SQL Server functions without a direct PostgreSQL spelling."""
+    changed = rewrite_calls(tokens, 'NOW', lambda arguments: 'CURRENT_TIMESTAMP' if arguments == [''] else None)
+    changed |= rewrite_calls(tokens, 'TEXT', lambda arguments: 'TEXT' if arguments == [''] else None)
+    changed |= rewrite_calls(
+        tokens, 'CONCAT',
+        lambda arguments: f"({' || '.join(arguments)})" if len(arguments) > 1 and all(arguments) else None
+    )
+    changed |= rewrite_calls(tokens, 'DATE_FORMAT', rewrite_date_format)
+    return changed
+
+
+def add_limit_to_select(tokens, select_index, count):
+    """
+    Append LIMIT `count` to the SELECT starting at select_index, unless that
+    query level already has a LIMIT or FETCH clause.
+    """
+    depth = 0
+    end = len(tokens)
+    for position in range(select_index + 1, len(tokens)):
+        token = tokens[position]
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            if depth == 0:
+                end = position
+                break
+            depth -= 1
+        elif depth == 0 and token == ';':
+            end = position
+            break
+        elif depth == 0 and is_word(token) and token.upper() in ('LIMIT', 'FETCH'):
+            return
+    insert_at = prev_significant(tokens, end) + 1
+    tokens[insert_at:insert_at] = [' ', 'LIMIT', ' ', count]
+
+
+def fix_top_clause(tokens):
+    """SQL Server SELECT TOP n (or TOP (n)) becomes a LIMIT on the same query level."""
+    changed = False
+    position = -1
+    while position + 1 < len(tokens):
+        position += 1
+        if not (is_word(tokens[position]) and tokens[position].upper() == 'SELECT'):
+            continue
+        top = next_significant(tokens, position)
+        if top is not None and tokens[top].upper() in ('DISTINCT', 'ALL'):
+            top = next_significant(tokens, top)
+        if top is None or tokens[top].upper() != 'TOP':
+            continue
+
+        count_index = next_significant(tokens, top)
+        end = count_index
+        if count_index is not None and tokens[count_index] == '(':
+            inner = next_significant(tokens, count_index)
+            end = next_significant(tokens, inner) if inner is not None else None
+            if end is None or tokens[end] != ')':
+                continue
+            count_index = inner
+        if count_index is None or not tokens[count_index].isdigit():
+            continue
+        following = next_significant(tokens, end)
+        if following is not None and tokens[following].upper() in ('PERCENT', 'WITH'):
+            continue  # No direct LIMIT equivalent
+
+        count = tokens[count_index]
+        if end + 1 < len(tokens) and tokens[end + 1][0].isspace():
+            end += 1
+        del tokens[top:end + 1]
+        add_limit_to_select(tokens, position, count)
+        changed = True
+    return changed
+
+
+# Tokens after which a double-quoted token is a value, not an identifier
+VALUE_OPERATORS = frozenset(('=', '<>', '!=', '<', '>', '<=', '>=', '||'))
+VALUE_KEYWORDS = frozenset(('LIKE', 'ILIKE', 'THEN', 'ELSE'))
+
+
+def in_value_list(tokens, position):
+    """True if tokens[position] is an element of an IN (...) list."""
+    depth = 0
+    for index in range(position - 1, -1, -1):
+        token = tokens[index]
+        if token == ')':
+            depth += 1
+        elif token == '(':
+            if depth == 0:
+                keyword = prev_significant(tokens, index)
+                return keyword is not None and tokens[keyword].upper() == 'IN'
+            depth -= 1
+        elif depth == 0 and is_significant(token) and token != ',' and not token.startswith('"') \
+                and not is_string_literal(token):
+            return False
+    return False
+
+
+# Double-quoted text shaped like a PostgreSQL identifier that keeps its case: "OtherCol", "user_id"
+CASED_IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_$]*')
+
+
+def is_column_reference(tokens, position):
+    """True if tokens[position] names a column: an identifier, quoted identifier or qualified name."""
+    token = tokens[position]
+    if is_quoted_identifier(token):
+        return True
+    return is_word(token) and token.upper() not in SQL_KEYWORDS
+
+
+def looks_like_identifier(tokens, position):
+    """
+    True if the double-quoted tokens[position] is more likely a column than
+    a value: it is qualified ("t"."col"), a column of the configured schema,
+    or a camelCase or snake_case name.
+    """
+    following = next_significant(tokens, position)
+    if following is not None and tokens[following] == '.':
+        return True
+    content = tokens[position][1:-1]
+    if not CASED_IDENTIFIER_PATTERN.fullmatch(content):
+        return False
+    if schema_index is not None:
+        return content.lower() in schema_index.column_names
+    return '_' in content or re.search(r'[a-z][A-Z]', content) is not None
+
+
+def fix_double_quoted_strings(tokens):
+    """
+    MySQL-style "text" used as a value becomes a 'text' literal. Double
+    quotes stay untouched wherever PostgreSQL reads them as identifiers,
+    including column-like names compared against another column or
+    concatenated.
+    """
+    changed = False
+    for position, token in enumerate(tokens):
+        if token[0] != '"' or is_unterminated(token):
+            continue
+        previous = prev_significant(tokens, position)
+        if previous is None:
+            continue
+        before = tokens[previous]
+        following = next_significant(tokens, position)
+        if before == '||' or (following is not None and tokens[following] == '||'):
+            # Either side of a concatenation
+            if looks_like_identifier(tokens, position):
+                continue
+        elif before in VALUE_OPERATORS:
+            # A comparison against another column, as in t1.a = "OtherCol"
+            left = prev_significant(tokens, previous)
+            if left is not None and is_column_reference(tokens, left) and looks_like_identifier(tokens, position):
+                continue
+        elif not ((is_word(before) and before.upper() in VALUE_KEYWORDS)
+                  or (before in ('(', ',') and in_value_list(tokens, position))):
+            continue
+        content = token[1:-1].replace('""', '"').replace("'", "''")
+        tokens[position] = f"'{content}'"
+        changed = True
+    return changed
+
+
+def close_unterminated_literal(tokens):
+    """Close a string, quoted identifier or comment left open at the end of the query."""
+    if not tokens or not is_unterminated(tokens[-1]):
+        return False
+    token = tokens[-1]
+    closing = {"'": "'", '"': '"', '`': '`', '/': '*/', '$': dollar_quote_tag(token)}.get(token[0], "'")
+    tokens[-1] = token + closing
+    return True
+
+
+def balance_parentheses(tokens):
+    """Close unbalanced parentheses before the terminating semicolon (if any)."""
+    missing = tokens.count('(') - tokens.count(')')
+    if missing <= 0:
+        return False
+    last = last_significant(tokens)
+    insert_at = last if tokens[last] == ';' else last + 1
+    tokens[insert_at:insert_at] = [')'] * missing
+    return True
+
+
+def add_missing_semicolon(tokens):
+    last = last_significant(tokens)
+    if last is None or tokens[last] == ';':
+        return False
+    tokens.insert(last + 1, ';')
+    return True
+
+
+def rewrite_limit_comma(tokens):
+    """MySQL LIMIT offset, count becomes LIMIT count OFFSET offset."""
+    changed = False
+    position = 0
+    while position < len(tokens):
+        if len(tokens[position]) == 5 and tokens[position].upper() == 'LIMIT':
+            offset = next_significant(tokens, position)
+            comma = next_significant(tokens, offset) if offset is not None else None
+            count = next_significant(tokens, comma) if comma is not None else None
+            if count is not None and tokens[offset].isdigit() and tokens[comma] == ',' and tokens[count].isdigit():
+                tokens[offset:count + 1] = [tokens[count], ' ', 'OFFSET', ' ', tokens[offset]]
+                changed = True
+        position += 1
+    return changed
+
+
+def rewrite_regex_operators(tokens):
+    """MySQL RLIKE/REGEXP become ~ (and NOT RLIKE becomes !~)."""
+    removed = set()
+    changed = False
+    for position, token in enumerate(tokens):
+        if is_word(token) and token.upper() in ('RLIKE', 'REGEXP'):
+            previous = prev_significant(tokens, position)
+            if previous is not None and tokens[previous].upper() == 'NOT':
+                tokens[position] = '!~'
+                removed.update(range(previous, position))
+            else:
+                tokens[position] = '~'
+            changed = True
+    if removed:
+        tokens[:] = [token for position, token in enumerate(tokens) if position not in removed]
+    return changed
+
+
+SERIAL_TYPES = {'INT': 'SERIAL', 'INTEGER': 'SERIAL', 'INT4': 'SERIAL',
+                'BIGINT': 'BIGSERIAL', 'INT8': 'BIGSERIAL', 'SMALLINT': 'SMALLSERIAL', 'INT2': 'SMALLSERIAL'}
+
+
+def rewrite_auto_increment(tokens):
+    """id INT AUTO_INCREMENT becomes id SERIAL (BIGSERIAL/SMALLSERIAL for other integer sizes)."""
+    changed = False
+    position = 0
+    while position < len(tokens):
+        token = tokens[position]
+        if is_word(token) and token.upper() == 'AUTO_INCREMENT':
+            column_type = prev_significant(tokens, position)
+            if column_type is not None and tokens[column_type].upper() in SERIAL_TYPES:
+                tokens[column_type] = SERIAL_TYPES[tokens[column_type].upper()]
+                del tokens[column_type + 1:position + 1]
+                position = column_type
+            else:
+                tokens[position] = 'SERIAL'
+            changed = True
+        position += 1
+    return changed
+
+
+def remove_nolock_hints(tokens):
+    """Drop SQL Server WITH (NOLOCK) table hints."""
+    changed = False
+    position = 0
+    while position < len(tokens):
+        if is_word(tokens[position]) and tokens[position].upper() == 'WITH':
+            open_index = next_significant(tokens, position)
+            hint = next_significant(tokens, open_index) if open_index is not None else None
+            close_index = next_significant(tokens, hint) if hint is not None else None
+            if (close_index is not None and tokens[open_index] == '(' and tokens[hint].upper() == 'NOLOCK'
+                    and tokens[close_index] == ')'):
+                start = position - 1 if position > 0 and tokens[position - 1][0].isspace() else position
+                del tokens[start:close_index + 1]
+                position = start
+                changed = True
+                continue
+        position += 1
+    return changed
+
+
+def quote_bracketed_identifiers(tokens):
+    """
+    SQL Server [name] and MySQL `name` identifiers become "name". Array
+    constructors and subscripts such as ARRAY[1, 2] or tags[1] are left alone.
+    """
+    changed = False
+    position = 0
+    while position < len(tokens):
+        token = tokens[position]
+        if token[0] == '`' and not is_unterminated(token):
+            tokens[position] = '"' + token[1:-1].replace('"', '""') + '"'
+            changed = True
+        elif token == '[':
+            close_index = find_closing_bracket(tokens, position)
+            previous = tokens[position - 1] if position > 0 else ' '
+            adjacent = is_word(previous) or is_quoted_identifier(previous) or previous in (')', ']')
+            if close_index is not None and not adjacent:
+                name = ''.join(tokens[position + 1:close_index])
+                if name.strip() and not re.search(r"[\[\],'\"()]", name) and not name.strip().isdigit():
+                    tokens[position:close_index + 1] = ['"' + name + '"']
+                    changed = True
+        position += 1
+    return changed
+
+
+# Keywords the doubled-keyword fix looks for; a query must contain one of them twice
+DOUBLED_KEYWORDS = ('SELECT', 'FROM', 'WHERE', 'GROUP BY', 'ORDER BY', 'HAVING')
+
+# Keywords the missing-space fix separates from a preceding word
+GLUED_KEYWORDS = ('SELECT', 'FROM', 'WHERE', 'GROUP', 'ORDER', 'HAVING', 'JOIN')
+
+
+def has_doubled_keyword(upper):
+    """Cheap guard: True if some keyword of DOUBLED_KEYWORDS occurs more than once."""
+    return any(upper.count(keyword) > 1 for keyword in DOUBLED_KEYWORDS)
+
+
+def has_glued_keyword(upper):
+    """Cheap guard: True unless every keyword occurrence follows a space or starts the query."""
+    padded = ' ' + upper
+    return any(padded.count(keyword) != padded.count(' ' + keyword) for keyword in GLUED_KEYWORDS)
+
+
+class TokenRule:
+    """
+    A rewrite applied to the token list of a query. `triggers` lists
+    substrings (matched case-insensitively) of which at least one must occur
+    in a query for the rule to possibly apply; None means the rule always
+    runs. An optional `guard` gets the upper-cased query and can rule the
+    rule out more cheaply than tokenizing. `function` edits the token list
+    in place and returns True if it changed anything.
+    """
+
+    def __init__(self, function, triggers=None, guard=None):
+        self.function = function
+        self.triggers = tuple(trigger.upper() for trigger in triggers) if triggers else None
+        self.guard = guard
+
+
+class TokenRewriteEngine:
+    """
+    Applies an ordered list of TokenRules to SQL strings.
+
+    The query is upper-cased once and each rule's triggers are checked with
+    plain substring tests, so most queries skip most rules. A query is
+    tokenized at most once, on the first rule that can apply, and every rule
+    edits the same token list in place. Because literals, quoted identifiers
+    and comments are single tokens, no rule can rewrite text inside them.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def apply(self, query):
+        """
+        :param query: SQL query
+        :return: Query with every applicable rule applied in order
+        """
+        upper = query.upper()
+        tokens = None
+        for rule in self.rules:
+            triggers = rule.triggers
+            if triggers is not None:
+                for trigger in triggers:
+                    if trigger in upper:
+                        break
+                else:
+                    continue
+            if rule.guard is not None and not rule.guard(upper):
+                continue
+            if tokens is None:
+                tokens = tokenize_sql(query)
+            if rule.function(tokens):
+                query = ''.join(tokens)
+                upper = query.upper()
+        return query
+
+    def apply_many(self, queries):
+        """
+        :param queries: Iterable of SQL queries
+        :return: List of rewritten queries, in input order
+        """
+        apply = self.apply
+        return [apply(query) for query in queries]
+
+
+# Common PostgreSQL syntax error fixes, applied to the token stream
+QUICK_FIX_ENGINE = TokenRewriteEngine([
+    # Fix common keyword typos in keyword position, then keywords written twice ("FROM FROM")
+    TokenRule(fix_keyword_typos, list(KEYWORD_TYPOS)),
+    TokenRule(fix_doubled_keywords, DOUBLED_KEYWORDS, guard=has_doubled_keyword),
+
+    # Fix missing spaces
+    TokenRule(fix_missing_spaces, GLUED_KEYWORDS, guard=has_glued_keyword),
+
+    # NOW(), TEXT(), CONCAT(...) and DATE_FORMAT(...) to PostgreSQL syntax
+    TokenRule(fix_function_calls, ['NOW', 'TEXT', 'CONCAT', 'DATE_FORMAT']),
+
+    # Fix incorrect TOP syntax (SQL Server) to LIMIT (PostgreSQL)
+    TokenRule(fix_top_clause, ['TOP']),
+
+    # PostgreSQL uses single quotes for strings, double quotes for identifiers
+    TokenRule(fix_double_quoted_strings, ['"']),
+
+    # Close a literal left open, balance parentheses, then terminate with a semicolon
+    TokenRule(close_unterminated_literal, ["'", '"', '`', '/*', '$']),
+    TokenRule(balance_parentheses, ['('], guard=lambda upper: upper.count('(') > upper.count(')')),
+    TokenRule(add_missing_semicolon, guard=lambda upper: not upper.rstrip().endswith(';')),
+])
+
+
+def attempt_quick_postgresql_fix(sql_query):
+    """
+    Attempt to fix common PostgreSQL syntax errors without calling the API.
+    This saves tokens and time for simple errors.
+
+    :param sql_query: Incorrect SQL query string
+    :return: Fixed SQL query string or original if no fixes applied
+    """
+    return QUICK_FIX_ENGINE.apply(sql_query)
+
+
+# Replace functions and syntax that might be incompatible with PostgreSQL
+COMPATIBILITY_ENGINE = TokenRewriteEngine([
+    # Date functions
+    TokenRule(lambda tokens: rewrite_calls(tokens, 'GETDATE', lambda arguments: 'CURRENT_DATE' if arguments == [''] else None),
+              ['GETDATE']),
+    TokenRule(lambda tokens: rewrite_calls(tokens, 'CURRENT_TIMESTAMP',
+                                           lambda arguments: 'CURRENT_TIMESTAMP' if arguments == [''] else None),
+              ['CURRENT_TIMESTAMP']),
+
+    # String functions
+    TokenRule(lambda tokens: rewrite_calls(
+        tokens, 'CHARINDEX',
+        lambda arguments: f"POSITION({arguments[0]} IN {arguments[1]})" if len(arguments) == 2 else None
+    ), ['CHARINDEX']),
+    TokenRule(lambda tokens: rewrite_calls(
+        tokens, 'LEN', lambda arguments: f"LENGTH({arguments[0]})" if len(arguments) == 1 and arguments[0] else None
+    ), ['LEN']),
+    TokenRule(lambda tokens: rewrite_calls(
+        tokens, 'SUBSTRING',
+        lambda arguments: f"SUBSTRING({arguments[0]} FROM {arguments[1]} FOR {arguments[2]})" if len(arguments) == 3 else None
+    ), ['SUBSTRING']),
+
+    # Concatenation
+    TokenRule(lambda tokens: rewrite_calls(
+        tokens, 'CONCAT_WS',
+        lambda arguments: f"array_to_string(ARRAY[{', '.join(arguments[1:])}], {arguments[0]})" if len(arguments) > 1 else None
+    ), ['CONCAT_WS']),
+
+    # Replace LIMIT n,m syntax (MySQL) with LIMIT m OFFSET n (PostgreSQL)
+    TokenRule(rewrite_limit_comma, ['LIMIT']),
+
+    # Replace non-standard operators
+    TokenRule(rewrite_regex_operators, ['RLIKE', 'REGEXP']),
+
+    # Handle auto-increment columns in PostgreSQL (if in CREATE TABLE)
+    TokenRule(rewrite_auto_increment, ['AUTO_INCREMENT']),
+
+    # Handle table hints (not supported in PostgreSQL)
+    TokenRule(remove_nolock_hints, ['NOLOCK']),
+
+    # Fix any use of square brackets (SQL Server style) or backticks (MySQL) for identifiers
+    TokenRule(quote_bracketed_identifiers, ['[', '`']),
+])
+
+
+def ensure_postgresql_compatibility(sql_query):
+    """
+    Ensures the generated SQL is compatible with PostgreSQL.
+
+    :param sql_query: SQL query to check
+    :return: PostgreSQL-compatible SQL query
+    """
+    return COMPATIBILITY_ENGINE.apply(sql_query)
+
+
+# Keywords a PostgreSQL statement can start with
+STATEMENT_KEYWORDS = frozenset((
+    'SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'CREATE', 'ALTER', 'DROP', 'TRUNCATE', 'VALUES',
+    'TABLE', 'EXPLAIN', 'GRANT', 'REVOKE', 'BEGIN', 'START', 'COMMIT', 'ROLLBACK', 'SET', 'SHOW',
+    'ANALYZE', 'VACUUM', 'COPY', 'COMMENT', 'MERGE',
+))
+
+# Words that are never a table, column or alias name in the queries we see
+SQL_KEYWORDS = STATEMENT_KEYWORDS | frozenset((
+    'FROM', 'WHERE', 'GROUP', 'BY', 'HAVING', 'WINDOW', 'ORDER', 'LIMIT', 'OFFSET', 'FETCH', 'FIRST',
+    'NEXT', 'ROW', 'ROWS', 'ONLY', 'TIES', 'FOR', 'SHARE', 'NOWAIT', 'SKIP', 'LOCKED', 'OF',
+    'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS', 'NATURAL', 'LATERAL', 'ON', 'USING',
+    'AS', 'AND', 'OR', 'NOT', 'IN', 'IS', 'NULL', 'LIKE', 'ILIKE', 'SIMILAR', 'TO', 'BETWEEN',
+    'SYMMETRIC', 'EXISTS', 'ANY', 'ALL', 'SOME', 'DISTINCT', 'CASE', 'WHEN', 'THEN', 'ELSE', 'END',
+    'UNION', 'INTERSECT', 'EXCEPT', 'RECURSIVE', 'ASC', 'DESC', 'NULLS', 'LAST', 'OVER', 'PARTITION',
+    'FILTER', 'WITHIN', 'ESCAPE', 'COLLATE', 'AT', 'TIME', 'ZONE', 'TRUE', 'FALSE', 'UNKNOWN', 'CAST',
+    'INTERVAL', 'DATE', 'TIMESTAMP', 'DOUBLE', 'PRECISION', 'CHARACTER', 'VARYING', 'INTO', 'DEFAULT',
+    'RETURNING', 'CONFLICT', 'DO', 'NOTHING', 'YEAR', 'MONTH', 'DAY', 'HOUR', 'MINUTE', 'SECOND',
+    'ARRAY', 'RANGE', 'PRECEDING', 'FOLLOWING', 'UNBOUNDED', 'CURRENT',
+))
+
+# SELECT clauses in the order PostgreSQL accepts them; LIMIT and OFFSET may come in either order
+CLAUSE_RANKS = {
+    'SELECT': 0, 'FROM': 1, 'WHERE': 2, 'GROUP BY': 3, 'HAVING': 4, 'WINDOW': 5,
+    'ORDER BY': 6, 'LIMIT': 7, 'OFFSET': 7, 'FETCH': 8, 'FOR': 9,
+}
+CLAUSE_WORDS = frozenset(clause.split()[0] for clause in CLAUSE_RANKS)
+
+# MySQL/SQL Server constructs the compatibility rules did not (or could not) rewrite
+FOREIGN_FUNCTIONS = frozenset((
+    'GETDATE', 'GETUTCDATE', 'DATEADD', 'DATEDIFF', 'DATE_ADD', 'DATE_SUB', 'DATE_FORMAT', 'STR_TO_DATE',
+    'CHARINDEX', 'LEN', 'IFNULL', 'ISNULL', 'NVL', 'NEWID',
+))
+FOREIGN_KEYWORDS = frozenset(('RLIKE', 'REGEXP', 'AUTO_INCREMENT', 'NOLOCK', 'TOP'))
+
+# Operators that need an operand on both sides
+BINARY_OPERATORS = frozenset(('=', '<>', '!=', '<', '>', '<=', '>=', '||', '/', '%', '^', '~', '!~', '~*', '!~*'))
+BINARY_KEYWORDS = frozenset(('AND', 'OR', 'LIKE', 'ILIKE', 'IN', 'BETWEEN'))
+COMPARISON_OPERATORS = frozenset(('=', '<>', '!=', '<', '>', '<=', '>='))
+
+# Words that end the table list of a JOIN without reaching its ON or USING
+JOIN_END_WORDS = CLAUSE_WORDS | frozenset(('JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'CROSS', 'NATURAL',
+                                           'UNION', 'INTERSECT', 'EXCEPT'))
+
+
+def join_has_condition(tokens, significant, index):
+    """
+    :return: True if the JOIN at significant[index] is followed by ON or USING before
+       the next join, clause or the end of its parentheses
+    """
+    depth = 0
+    for position in significant[index + 1:]:
+        token = tokens[position]
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            if depth == 0:
+                return False
+            depth -= 1
+        elif depth == 0:
+            upper = token.upper()
+            if upper in ('ON', 'USING'):
+                return True
+            if token in (';', ',') or upper in JOIN_END_WORDS:
+                return False
+    return False
+
+
+def is_operand(token):
+    """True for an identifier, quoted identifier or literal, i.e. something a comparison can end with."""
+    return is_quoted_identifier(token) or is_string_literal(token) or token[0].isdigit() or \
+        (is_word(token) and token.upper() not in SQL_KEYWORDS)
+
+
+def clause_at(tokens, significant, index):
+    """
+    :return: The SELECT clause that significant[index] opens ('GROUP BY', 'FROM', ...),
+       or None when the word is used some other way (IS DISTINCT FROM, WITHIN GROUP, ...)
+    """
+    word = tokens[significant[index]].upper()
+    previous = tokens[significant[index - 1]].upper() if index > 0 else None
+    following = tokens[significant[index + 1]].upper() if index + 1 < len(significant) else None
+    if word in ('GROUP', 'ORDER'):
+        return f"{word} BY" if following == 'BY' and previous != 'WITHIN' else None
+    if word == 'FROM':
+        return None if previous == 'DISTINCT' else word
+    if word == 'FOR':
+        return word if following in ('UPDATE', 'SHARE', 'NO', 'KEY') else None
+    return word if word in CLAUSE_RANKS else None
+
+
+def validate_postgresql(sql_query):
+    """
+    Offline syntax check of a PostgreSQL query: balanced brackets and quotes,
+    a known leading keyword, SELECT clauses present at most once and in order,
+    no empty clauses, trailing commas or dangling operators, comparisons
+    joined by AND/OR, joins with ON or USING, INSERT INTO and DELETE FROM,
+    and no MySQL or SQL Server leftovers. It is deliberately conservative about what it calls
+    valid, since a valid verdict means the query never reaches the API.
+
+    :param sql_query: SQL query string
+    :return: List of problems found; empty if the query looks valid
+    """
+    tokens = tokenize_sql(sql_query or '')
+    significant = [position for position, token in enumerate(tokens) if is_significant(token)]
+    if not significant:
+        return ["empty query"]
+
+    problems = []
+    if is_unterminated(tokens[-1]):
+        problems.append("unterminated literal or comment")
+
+    # One entry per open parenthesis: [query clause rank, clauses seen, plain identifiers in a row]
+    scopes = [[None, set(), 0]]
+    brackets = 0
+    statement_start = True
+    count = len(significant)
+    for index, position in enumerate(significant):
+        token = tokens[position]
+        upper = token.upper()
+        scope = scopes[-1]
+        previous = tokens[significant[index - 1]] if index > 0 else None
+        following = tokens[significant[index + 1]] if index + 1 < count else None
+        following_upper = following.upper() if following is not None else None
+
+        if statement_start:
+            statement_start = False
+            if upper not in STATEMENT_KEYWORDS and token != '(':
+                problems.append(f"statement cannot start with {token!r}")
+
+        if token == '(':
+            scopes.append([None, set(), 0])
+            continue
+        if token == ')':
+            if len(scopes) == 1:
+                problems.append("unbalanced ')'")
+            else:
+                scopes.pop()
+                scopes[-1][2] = 0
+            continue
+        if token == '[':
+            brackets += 1
+            # tags[1] and ARRAY[1, 2] are PostgreSQL; FROM [orders] is SQL Server
+            if previous is None or not (previous in (')', ']') or is_quoted_identifier(previous) or (
+                    is_word(previous) and (previous.upper() == 'ARRAY' or previous.upper() not in SQL_KEYWORDS))):
+                problems.append("square-bracket identifier")
+        elif token == ']':
+            brackets -= 1
+            if brackets < 0:
+                problems.append("unbalanced ']'")
+                brackets = 0
+        elif token == ';':
+            if len(scopes) > 1:
+                problems.append("';' inside parentheses")
+            scopes = [[None, set(), 0]]
+            statement_start = True
+            continue
+        elif token[0] == '`':
+            problems.append("backtick identifier")
+        elif token == ',':
+            if previous in (None, '(', ',') or (previous.upper() == 'SELECT') or \
+                    (scope[0] is not None and previous.upper() in ('FROM', 'BY', 'WHERE')):
+                problems.append("leading comma")
+            if following in (None, ')', ';', ',') or \
+                    (scope[0] is not None and following_upper in CLAUSE_WORDS and following_upper != 'SELECT'):
+                problems.append("trailing comma")
+
+        # Dangling operators: "a = ", "x AND", "WHERE AND x"
+        if token in BINARY_OPERATORS or (is_word(token) and upper in BINARY_KEYWORDS):
+            if following in (None, ')', ';', ',') or following_upper in ('AND', 'OR') or \
+                    (following_upper in CLAUSE_WORDS and following_upper not in ('SELECT', 'FOR')):
+                problems.append(f"missing operand after {token!r}")
+            elif upper in ('AND', 'OR', '=') and (previous in (None, '(', ',') or previous.upper() in ('WHERE', 'HAVING', 'ON')):
+                problems.append(f"missing operand before {token!r}")
+            elif token == '=' and previous == '=':
+                problems.append("'==' is not an operator")
+            # "a = 1 b = 2": a new comparison starts right after the last one ended
+            elif token in COMPARISON_OPERATORS and index >= 2 and not is_string_literal(previous) \
+                    and not previous[0].isdigit() and is_operand(previous) and is_operand(tokens[significant[index - 2]]):
+                problems.append(f"missing AND, OR or comma before {previous!r}")
+
+        if not is_word(token):
+            if token not in ('.', '::'):
+                scope[2] = 0
+            continue
+
+        if is_keyword_typo(tokens, position):
+            problems.append(f"misspelled keyword {token!r}")
+        if upper == 'INSERT' and previous in (None, ';', '(') and following_upper != 'INTO':
+            problems.append("INSERT without INTO")
+        elif upper == 'DELETE' and previous in (None, ';', '(') and following_upper != 'FROM':
+            problems.append("DELETE without FROM")
+        elif upper == 'JOIN' and scope[0] is not None and previous.upper() not in ('CROSS', 'NATURAL') \
+                and not join_has_condition(tokens, significant, index):
+            problems.append("JOIN without ON or USING")
+        if upper in FOREIGN_FUNCTIONS and following == '(':
+            problems.append(f"non-PostgreSQL function {token}()")
+        elif upper in FOREIGN_KEYWORDS and previous != '.':
+            if upper != 'TOP' or (previous is not None and previous.upper() in ('SELECT', 'DISTINCT', 'ALL')):
+                problems.append(f"non-PostgreSQL keyword {upper}")
+
+        if upper == 'SELECT':
+            scope[0] = 0
+            scope[1] = {'SELECT'}
+            if following in (None, ')', ';') or following_upper == 'FROM':
+                problems.append("empty select list")
+        elif scope[0] is not None and upper in ('UNION', 'INTERSECT', 'EXCEPT'):
+            scope[0] = None
+        elif scope[0] is not None and upper in ('GROUP', 'ORDER') and following_upper != 'BY' and previous.upper() != 'WITHIN':
+            problems.append(f"{upper} without BY")
+        elif scope[0] is not None and upper in CLAUSE_WORDS:
+            clause = clause_at(tokens, significant, index)
+            if clause is not None:
+                rank = CLAUSE_RANKS[clause]
+                if clause in scope[1]:
+                    problems.append(f"duplicate {clause} clause")
+                elif rank < scope[0]:
+                    problems.append(f"{clause} clause out of order")
+                scope[0] = max(scope[0], rank)
+                scope[1].add(clause)
+                if upper == 'LIMIT' and index + 2 < count and tokens[significant[index + 2]] == ',':
+                    problems.append("MySQL LIMIT offset, count")
+                body = index + 2 if ' ' in clause else index + 1
+                first = tokens[significant[body]].upper() if body < count else None
+                if first in (None, ')', ';') or (first in CLAUSE_WORDS and first not in ('SELECT', 'FOR')):
+                    problems.append(f"empty {clause} clause")
+
+        # Three plain identifiers in a row ("FROM customers were total") inside a query
+        if scope[0] is not None and upper not in SQL_KEYWORDS and following != '(':
+            if previous in ('.', '::'):
+                continue
+            scope[2] += 1
+            if scope[2] >= 3:
+                problems.append(f"unexpected identifier {token!r}")
+        else:
+            scope[2] = 0
+
+    if len(scopes) > 1:
+        problems.append("unclosed '('")
+    if brackets:
+        problems.append("unclosed '['")
+    return problems
+
+
+def classify_sql_correction(incorrect_query):
+    """
+    Decide locally whether a query needs the LLM at all. The quick fixes and
+    compatibility rewrites are applied first, then the result is validated.
+
+    :param incorrect_query: SQL query to correct
+    :return: Tuple (status, query): status is "valid" if the query already passed
+       validation (query is then returned unchanged), "fixed" if the local rules
+       made it pass and "broken" if it still needs an LLM correction; query is
+       the locally fixed query
+    """
+    # A valid query is left exactly as written: the rewrites are only needed to
+    # make a broken one pass, and would otherwise restyle it (CONCAT to ||)
+    with metrics.profile("validate"):
+        if not validate_postgresql(incorrect_query):
+            return "valid", incorrect_query
+    with metrics.profile("quick_fix"):
+        fixed_query = attempt_quick_postgresql_fix(incorrect_query)
+    with metrics.profile("compatibility"):
+        fixed_query = ensure_postgresql_compatibility(fixed_query)
+    with metrics.profile("validate"):
+        if validate_postgresql(fixed_query):
+            return "broken", fixed_query
+    return "fixed", fixed_query
+
+
+# Function to classify one correction input item (module level so worker processes can run it)
+def classify_correction_item(item):
+    """
+    :param item: Correction input item, a dict with IncorrectQuery (or a bare query string)
+    :return: Tuple of (item, (status, locally fixed query)) as from classify_sql_correction
+    """
+    incorrect_query = item.get('IncorrectQuery', '') if isinstance(item, dict) else str(item)
+    return item, classify_sql_correction(incorrect_query) if incorrect_query else ("valid", "")
+
+
+# Functions to run the local rewrite tiers over large lists of queries
+def attempt_quick_postgresql_fix_many(sql_queries):
+    """
+    :param sql_queries: Iterable of incorrect SQL query strings
+    :return: List of fixed queries, in input order
+    """
+    return QUICK_FIX_ENGINE.apply_many(sql_queries)
+
+
+def ensure_postgresql_compatibility_many(sql_queries):
+    """
+    :param sql_queries: Iterable of SQL query strings
+    :return: List of PostgreSQL-compatible queries, in input order
+    """
+    return COMPATIBILITY_ENGINE.apply_many(sql_queries)
+
+
+# Function to build a synthetic SQL corpus for the benchmarks
+def make_synthetic_queries(count, seed=0):
+    """
+    Mix of clean PostgreSQL and queries with typos, MySQL and SQL Server constructs.
+
+    :param count: Number of queries
+    :param seed: Random seed, so runs are comparable
+    :return: List of SQL query strings
+    """
+    rng = random.Random(seed)
+    tables = ["customers", "orders", "products", "employees", "order_items", "payments"]
+    columns = ["id", "name", "email", "total_amount", "created_at", "status", "price", "quantity"]
+    templates = [
+        "SELECT {c1}, {c2} FROM {t1} WHERE {c3} > {n} ORDER BY {c1} LIMIT {n};",
+        "SELECT {c1}, COUNT(*) FROM {t1} GROUP BY {c1} HAVING COUNT(*) > {n};",
+        "SELECT a.{c1}, b.{c2} FROM {t1} a JOIN {t2} b ON a.id = b.{c3} WHERE a.{c2} ILIKE '%{w}%';",
+        "SELET {c1} FROM {t1} WHERE {c2} = {n}",
+        "SELECT {c1} FROM {t1} a JION {t2} b ON a.id = b.id",
+        "SELECT TOP {n} {c1}, {c2} FROM {t1} ORDER BY {c3} DESC",
+        "SELECT CONCAT({c1}, {c2}) FROM {t1} WHERE {c3} = \"{w}\"",
+        "SELECT {c1} FROM {t1} WITH (NOLOCK) WHERE LEN({c2}) > {n} AND {c3} < GETDATE()",
+        "SELECT [{c1}], CHARINDEX('a', {c2}) FROM [{t1}] LIMIT {n}, {m}",
+        "SELECT SUBSTRING({c1}, 1, {n}) FROM {t1} WHERE {c2} RLIKE '^{w}' AND {c3} < NOW()",
+        "SELECT {c1} FROM {t1} WHERE {c2} IN (SELECT {c2} FROM {t2} WHERE {c3} > {n}",
+    ]
+    words = ["acme", "north", "blue", "prime", "delta"]
+    queries = []
+    for _ in range(count):
+        queries.append(rng.choice(templates).format(
+            t1=rng.choice(tables), t2=rng.choice(tables),
+            c1=rng.choice(columns), c2=rng.choice(columns), c3=rng.choice(columns),
+            n=rng.randint(1, 1000), m=rng.randint(1, 100), w=rng.choice(words)
+        ))
+    return queries
+
+
+# Words of a question that never identify a table or column
+SCHEMA_STOPWORDS = frozenset((
+    'a', 'an', 'the', 'of', 'in', 'on', 'for', 'to', 'from', 'by', 'with', 'and', 'or', 'not', 'all', 'each',
+    'every', 'any', 'who', 'which', 'that', 'what', 'where', 'when', 'how', 'many', 'much', 'is', 'are', 'was',
+    'were', 'be', 'been', 'have', 'has', 'had', 'do', 'does', 'did', 'me', 'my', 'i', 'we', 'our', 'their',
+    'list', 'show', 'find', 'get', 'give', 'return', 'display', 'select', 'than', 'more', 'less', 'most',
+    'least', 'top', 'first', 'last', 'per', 'at', 'as', 'it', 'its', 'this', 'these', 'those', 'there',
+))
+
+# Constraint keywords that start a table element instead of a column in CREATE TABLE
+TABLE_CONSTRAINT_KEYWORDS = frozenset(('CONSTRAINT', 'PRIMARY', 'FOREIGN', 'UNIQUE', 'CHECK', 'EXCLUDE', 'LIKE'))
+
+
+class SchemaIndex:
+    """
+    Keyword index over a database schema, built once at startup from a DDL
+    file or a JSON catalog. For each question it selects the few tables and
+    columns that match it and renders them in a compact one-line form, so
+    prompt context stays bounded however many tables the schema has.
+    """
+
+    def __init__(self, tables, max_tables=SCHEMA_MAX_TABLES, max_columns=SCHEMA_MAX_COLUMNS):
+        """
+        :param tables: Dict mapping table name to its list of column names, in declaration order
+        :param max_tables: Maximum number of tables included in a prompt
+        :param max_columns: Maximum number of columns listed per table
+        """
+        self.tables = list(tables.items())
+        self.max_tables = max_tables
+        self.max_columns = max_columns
+
+        # term -> list of (table number, weight); table names weigh more than column names
+        self.postings = collections.defaultdict(list)
+        self.column_terms = []
+        for number, (table, columns) in enumerate(self.tables):
+            weights = {}
+            column_terms = []
+            for column in columns:
+                terms = self.terms(column)
+                column_terms.append(terms)
+                for term in terms:
+                    weights.setdefault(term, 1.0)
+            for term in self.terms(table.rsplit('.', 1)[-1]):
+                weights[term] = 3.0
+            for term, weight in weights.items():
+                self.postings[term].append((number, weight))
+            self.column_terms.append(column_terms)
+        count = len(self.tables)
+        self.idf = {term: math.log(1 + count / len(postings)) for term, postings in self.postings.items()}
+
+        # Lower-case names for checking the identifiers of generated SQL
+        self.table_names = set()
+        for table, _ in self.tables:
+            self.table_names.update((table.lower(), table.rsplit('.', 1)[-1].lower()))
+        self.column_names = {column.lower() for _, columns in self.tables for column in columns}
+
+    @staticmethod
+    def stem(word):
+        if len(word) > 4 and word.endswith('ies'):
+            return word[:-3] + 'y'
+        if len(word) > 4 and word.endswith(('ses', 'xes', 'ches', 'shes')):
+            return word[:-2]
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            return word[:-1]
+        return word
+
+    @classmethod
+    def terms(cls, text):
+        """:return: Set of stemmed lower-case words of a question or identifier (snake_case and camelCase split)"""
+        text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', text).lower()
+        return {cls.stem(word) for word in re.findall(r'[a-z]+', text) if word not in SCHEMA_STOPWORDS}
+
+    @staticmethod
+    def quote(name):
+        """
+        :param name: Table or column name, optionally qualified ("schema.table")
+        :return: Name as written in PostgreSQL, with parts that are not plain lower-case identifiers double-quoted
+        """
+        return '.'.join(part if re.fullmatch(r'[a-z_][a-z0-9_$]*', part) else '"' + part.replace('"', '""') + '"'
+                        for part in name.split('.'))
+
+    @staticmethod
+    def unquote(token):
+        """:return: Identifier token as PostgreSQL stores it: quoted names keep their case, others are folded to lower case"""
+        if is_quoted_identifier(token):
+            return token[1:-1].replace(token[0] * 2, token[0])
+        return token.strip('[]').lower()
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """
+        :param path: DDL file (CREATE TABLE statements) or JSON catalog (.json)
+        :return: SchemaIndex over the tables in the file
+        """
+        with open(path, 'r') as file:
+            text = file.read()
+        if path.endswith('.json'):
+            tables = cls.parse_catalog(json.loads(text))
+        else:
+            tables = cls.parse_ddl(text)
+        logger.info(f"Indexed {len(tables)} tables from {path}")
+        return cls(tables, **kwargs)
+
+    @staticmethod
+    def parse_catalog(catalog):
+        """
+        Accepts {"table": ["column", ...]}, {"tables": {...}} or a list of
+        {"name": ..., "columns": [...]}, where a column is a name or a
+        {"name": ...} object.
+
+        :return: Dict mapping table name to column names
+        """
+        if isinstance(catalog, dict) and 'tables' in catalog:
+            catalog = catalog['tables']
+        if isinstance(catalog, dict):
+            catalog = [{"name": name, "columns": columns.get('columns', []) if isinstance(columns, dict) else columns}
+                       for name, columns in catalog.items()]
+        tables = {}
+        for table in catalog:
+            columns = [column.get('name', '') if isinstance(column, dict) else str(column)
+                       for column in table.get('columns', [])]
+            tables[table['name']] = [column for column in columns if column]
+        return tables
+
+    @staticmethod
+    def parse_ddl(ddl):
+        """
+        :param ddl: SQL text with CREATE TABLE statements; other statements are ignored
+        :return: Dict mapping table name to column names
+        """
+        tokens = [token for token in tokenize_sql(ddl) if is_significant(token)]
+        tables = {}
+        position = 0
+        while position < len(tokens):
+            if tokens[position].upper() != 'CREATE':
+                position += 1
+                continue
+            # CREATE [TEMP | UNLOGGED ...] TABLE [IF NOT EXISTS] name (
+            table_at = position + 1
+            while table_at < len(tokens) and tokens[table_at].upper() not in ('TABLE', ';', '('):
+                table_at += 1
+            if table_at >= len(tokens) or tokens[table_at].upper() != 'TABLE':
+                position = table_at
+                continue
+            name_at = table_at + 1
+            if tokens[name_at:name_at + 3] and [token.upper() for token in tokens[name_at:name_at + 3]] == ['IF', 'NOT', 'EXISTS']:
+                name_at += 3
+            name = []
+            position = name_at
+            while position < len(tokens) and tokens[position] not in ('(', ';') and tokens[position].upper() != 'AS':
+                name.append(SchemaIndex.unquote(tokens[position]))
+                position += 1
+            if position >= len(tokens) or tokens[position] != '(':
+                continue
+
+            columns = []
+            depth = 0
+            element_start = True
+            while position < len(tokens):
+                token = tokens[position]
+                position += 1
+                if token == '(':
+                    depth += 1
+                    element_start = depth == 1
+                elif token == ')':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                elif depth == 1 and token == ',':
+                    element_start = True
+                elif token in ('[', ']'):
+                    continue
+                elif element_start:
+                    element_start = False
+                    if token.upper() not in TABLE_CONSTRAINT_KEYWORDS:
+                        columns.append(SchemaIndex.unquote(token))
+            tables[''.join(name)] = columns
+        return tables
+
+    def select(self, question):
+        """
+        :param question: Natural language question
+        :return: List of (table, columns) pairs relevant to the question, best first
+        """
+        scores = collections.defaultdict(float)
+        query_terms = self.terms(question)
+        for term in query_terms:
+            for number, weight in self.postings.get(term, ()):
+                scores[number] += weight * self.idf[term]
+        best = sorted(scores, key=lambda number: (-scores[number], number))[:self.max_tables]
+
+        selected = []
+        for number in best:
+            table, columns = self.tables[number]
+            # Matching columns first, then keys (useful for joins), then the rest in declaration order
+            ranked = sorted(
+                range(len(columns)),
+                key=lambda column: (not (self.column_terms[number][column] & query_terms),
+                                    not (columns[column].lower() == 'id' or columns[column].lower().endswith('_id')),
+                                    column)
+            )
+            keep = sorted(ranked[:self.max_columns])
+            selected.append((table, [columns[column] for column in keep]))
+        return selected
+
+    def context(self, question):
+        """
+        :param question: Natural language question
+        :return: Compact schema text such as "customers(id, name); orders(id, customer_id)", or "" if nothing matched
+        """
+        return "; ".join(f"{self.quote(table)}({', '.join(map(self.quote, columns))})"
+                         for table, columns in self.select(question))
+
+    def match_identifiers(self, sql_query):
+        """
+        :param sql_query: SQL text
+        :return: Tuple of (table references not in the schema, identifiers that are schema tables or columns)
+        """
+        tokens = [token for token in tokenize_sql(sql_query) if is_significant(token)]
+        unknown_tables = 0
+        known = 0
+        previous = None
+        for position, token in enumerate(tokens):
+            if is_word(token) or is_quoted_identifier(token):
+                name = token.strip('"`').lower()
+                if previous in ('FROM', 'JOIN', 'UPDATE', 'INTO') and token.upper() not in SQL_KEYWORDS:
+                    # Qualified references (schema.table) are checked as a whole and by table name
+                    if position + 2 < len(tokens) and tokens[position + 1] == '.':
+                        name += '.' + tokens[position + 2].strip('"`').lower()
+                    if name in self.table_names or name.rsplit('.', 1)[-1] in self.table_names:
+                        known += 1
+                    else:
+                        unknown_tables += 1
+                elif name in self.column_names or name in self.table_names:
+                    known += 1
+            previous = token.upper()
+        return unknown_tables, known
+
+
+# Schema index consulted when building generation prompts
+schema_index = None
+
+
+# Function to load the schema index used in generation prompts
+def load_schema_index(path):
+    """
+    :param path: DDL or JSON catalog file, or None
+    :return: SchemaIndex, or None when no schema is configured
+    """
+    global schema_index
+    schema_index = SchemaIndex.from_file(path) if path else None
+    return schema_index
+
+
+load_schema_index(SCHEMA_PATH)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections shared by concurrent workers.
+    Connections are opened lazily, up to `size`; a worker that finds the pool
+    exhausted waits for one to be released. Connections that were closed
+    under us (server restart, network error) are dropped and replaced.
+    """
+
+    def __init__(self, factory, size=MAX_CONCURRENCY):
+        """
+        :param factory: Callable returning a new DB-API connection
+        :param size: Maximum number of open connections
+        """
+        self.factory = factory
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.opened < self.size
+            if create:
+                self.opened += 1
+        if not create:
+            return self.idle.get()
+        try:
+            return self.factory()
+        except BaseException:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def release(self, connection):
+        if getattr(connection, 'closed', 0):
+            with self.lock:
+                self.opened -= 1
+            return
+        self.idle.put(connection)
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# SQLite stand-in errors that also mean something to PostgreSQL; anything else
+# (usually PostgreSQL syntax SQLite lacks) says nothing about the query
+STANDIN_NAME_ERROR_PATTERN = re.compile(r'no such (?:table|column)|has no column named')
+
+
+class QueryVerifier:
+    """
+    Checks that SQL actually runs by planning it against a database: EXPLAIN
+    for queries and DML, and execution inside a rolled-back transaction for
+    other statements, so nothing is ever changed.
+
+    `dsn` is a PostgreSQL connection string (needs psycopg2), or
+    "sqlite://[path]" for an embedded stand-in that can run offline. The
+    stand-in creates untyped tables for `tables` (e.g. from the schema index)
+    and checks names against them with SQLite's planner. It only reports
+    unknown tables and columns: SQLite rejects valid PostgreSQL such as
+    INTERVAL, :: casts, ILIKE or date_trunc, so its other errors leave the
+    query unchecked rather than failed.
+    """
+
+    def __init__(self, dsn, tables=None, pool_size=MAX_CONCURRENCY, timeout_ms=VERIFY_TIMEOUT_MS):
+        """
+        :param dsn: Database to verify against
+        :param tables: Dict mapping table name to column names, used by the SQLite stand-in
+        :param pool_size: Maximum number of pooled connections
+        :param timeout_ms: Statement timeout for PostgreSQL
+        """
+        self.tables = tables or {}
+        self.timeout_ms = timeout_ms
+        self.verified = 0
+        self.failed = 0
+        self.repaired = 0
+        self.unchecked = 0
+        self.stats_lock = threading.Lock()
+
+        if dsn.startswith('sqlite:'):
+            self.path = dsn[len('sqlite://'):] if dsn.startswith('sqlite://') else dsn[len('sqlite:'):]
+            if not self.tables and not self.path:
+                raise ValueError("sqlite:// verification needs a schema (--schema); without one every query "
+                                 "fails with 'no such table'")
+            self.errors = (sqlite3.Error,)
+            self.embedded = True
+            factory = self.connect_sqlite
+        else:
+            if psycopg2 is None:
+                raise RuntimeError("psycopg2 is required to verify queries against PostgreSQL")
+            self.errors = (psycopg2.Error,)
+            self.embedded = False
+            factory = lambda: psycopg2.connect(dsn)
+        self.pool = ConnectionPool(factory, pool_size)
+
+    def connect_sqlite(self):
+        connection = sqlite3.connect(self.path or ':memory:', check_same_thread=False)
+        schemas = {table.split('.')[0] for table in self.tables if '.' in table}
+        for schema in schemas:
+            connection.execute(f'ATTACH DATABASE ":memory:" AS "{schema}"')
+        for table, columns in self.tables.items():
+            name = '.'.join(f'"{part}"' for part in table.split('.'))
+            column_list = ', '.join(f'"{column}"' for column in columns) or '"_"'
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {name} ({column_list})")
+        return connection
+
+    @staticmethod
+    def statements(sql_query):
+        """:return: The statements of sql_query, without their terminating semicolons"""
+        statements = []
+        current = []
+        for token in tokenize_sql(sql_query):
+            if token == ';':
+                statements.append(''.join(current).strip())
+                current = []
+            else:
+                current.append(token)
+        statements.append(''.join(current).strip())
+        return [statement for statement in statements if statement]
+
+    def verify(self, sql_query):
+        """
+        :param sql_query: SQL to check
+        :return: None if every statement plans successfully (or the stand-in cannot judge
+                 the query), otherwise the database error message
+        """
+        error = None
+        unchecked = False
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                if not self.embedded:
+                    cursor.execute(f"SET LOCAL statement_timeout = {int(self.timeout_ms)}")
+                for statement in self.statements(sql_query):
+                    first = statement.split(None, 1)[0].upper()
+                    if self.embedded or first in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'VALUES', 'TABLE'):
+                        cursor.execute("EXPLAIN " + statement)
+                        cursor.fetchall()
+                    else:
+                        cursor.execute(statement)
+            except self.errors as db_error:
+                error = str(db_error).strip() or type(db_error).__name__
+                if self.embedded and not STANDIN_NAME_ERROR_PATTERN.search(error):
+                    unchecked = True
+                    error = None
+            finally:
+                try:
+                    connection.rollback()
+                except self.errors:
+                    pass
+                cursor.close()
+
+        with self.stats_lock:
+            if unchecked:
+                self.unchecked += 1
+            elif error is None:
+                self.verified += 1
+            else:
+                self.failed += 1
+        return error
+
+    def stats(self):
+        """
+        :return: Dict with the number of queries verified, failed, repaired by a retry
+                 and left unchecked by the SQLite stand-in
+        """
+        with self.stats_lock:
+            return {"verified": self.verified, "failed": self.failed, "repaired": self.repaired,
+                    "unchecked": self.unchecked}
+
+
+# Verifier for generated and corrected SQL; None disables verification
+query_verifier = None
+
+
+# Function to set up execution-based verification
+def load_query_verifier(dsn):
+    """
+    :param dsn: PostgreSQL connection string, "sqlite://[path]", or None
+    :return: QueryVerifier, or None when verification is disabled
+    """
+    global query_verifier
+    tables = dict(schema_index.tables) if schema_index is not None else None
+    query_verifier = QueryVerifier(dsn, tables) if dsn else None
+    return query_verifier
+
+
+load_query_verifier(VERIFY_DSN)
+
+
+# Function to verify a query and give the model one chance to repair it
+def verify_and_repair(api_key, model, nl_query, sql_query, alternatives=()):
+    """
+    Run the query through the verifier. If the database rejects it, try the
+    alternatives (other candidates from the same call) in order, then ask
+    the model once for a fix, including the error message, and keep the fix
+    only if it verifies.
+
+    :param api_key: API key for Groq
+    :param model: Model name
+    :param nl_query: Natural language request behind the query
+    :param sql_query: SQL to verify
+    :param alternatives: Cleaned-up fallback queries, best first
+    :return: Tuple of (verified, alternative or repaired query, or sql_query unchanged;
+             database error, or None if the query verified or verification is off)
+    """
+    if query_verifier is None or not sql_query:
+        return sql_query, None
+    error = query_verifier.verify(sql_query)
+    if error is None:
+        return sql_query, None
+    for alternative in alternatives:
+        if query_verifier.verify(alternative) is None:
+            return alternative, None
+
+    messages = [
+        {
+            "role": "system",
+            "content": CORRECTION_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": f"Request: {nl_query}\nQuery: {sql_query}\nDatabase error: {error}"
+        }
+    ]
+    try:
+        response, tokens_used = call_with_budget(api_key, model, messages, token_budget.kind("repair", sql_query))
+        repaired = response['choices'][0]['message']['content'].strip()
+    except CircuitBreakerOpen:
+        return sql_query, error
+    except Exception as api_error:
+        logger.warning(f"API call error while repairing a failed query: {str(api_error)}")
+        return sql_query, error
+
+    repaired = ensure_postgresql_compatibility(strip_markdown_fences(repaired))
+    if repaired and query_verifier.verify(repaired) is None:
+        with query_verifier.stats_lock:
+            query_verifier.repaired += 1
+        return repaired, None
+    return sql_query, error
+
+
+# Function to score a candidate query with cheap local checks
+def score_sql_candidate(sql_query):
+    """
+    :param sql_query: Candidate SQL as returned by the model
+    :return: Tuple of (cleaned-up query, sort key); a higher key is a better candidate
+    """
+    raw_query = strip_markdown_fences(sql_query)
+    cleaned_query = ensure_postgresql_compatibility(raw_query)
+    problems = validate_postgresql(cleaned_query)
+    unknown_tables, known_identifiers = (schema_index.match_identifiers(cleaned_query)
+                                         if schema_index is not None else (0, 0))
+    return cleaned_query, (-len(problems), -unknown_tables, known_identifiers, -(cleaned_query != raw_query))
+
+
+# Function to rank candidate queries, best first
+def rank_sql_candidates(candidates):
+    """
+    Candidates are compared on validation problems, then table references
+    missing from the schema, then identifiers found in the schema, then on
+    whether compatibility rewrites were needed. Ties go to the query most
+    candidates agree on, then to the earliest one.
+
+    :param candidates: List of SQL answers from the model
+    :return: List of distinct cleaned-up queries, best first (empty answers dropped)
+    """
+    scored = {}
+    with metrics.profile("rank_candidates"):
+        for position, candidate in enumerate(candidates):
+            cleaned_query, key = score_sql_candidate(candidate)
+            normalized = ' '.join(cleaned_query.split())
+            if not normalized:
+                continue
+            if normalized in scored:
+                scored[normalized][1] += 1
+            else:
+                scored[normalized] = [key, 1, -position, cleaned_query]
+    ranked = sorted(scored.values(), key=lambda entry: entry[:3], reverse=True)
+    return [entry[3] for entry in ranked]
+
+
+# Function to count the HTTP requests one question keeps in flight when asking for candidates
+def candidate_requests(count=CANDIDATES):
+    """
+    :param count: Number of candidates per question
+    :return: 1 if the backend returns all candidates from one call, otherwise count
+    """
+    return 1 if count <= 1 or llm_backend.supports_n else count
+
+
+# Function to request several candidate answers to one prompt in a single round trip
+def request_sql_candidates(api_key, model, messages, kind, count=CANDIDATES, temperature=CANDIDATE_TEMPERATURE):
+    """
+    Uses one call with n=count when the backend supports it. Otherwise the
+    calls are made in parallel: the first at temperature 0, so it is cached
+    and matches the single-candidate answer, the rest at `temperature`.
+
+    :param api_key: API key for Groq
+    :param model: Model name
+    :param messages: Chat messages of the prompt
+    :param kind: Kind key from token_budget.kind(), for the completion budget of each candidate
+    :param count: Number of candidates
+    :param temperature: Sampling temperature of the extra candidates
+    :return: List of answer texts (shorter than count if some calls failed)
+    :raises CircuitBreakerOpen: If the endpoint is currently marked unhealthy
+    :raises Exception: The first error, if no call succeeded
+    """
+    if llm_backend.supports_n:
+        response, tokens_used = call_with_budget(api_key, model, messages, kind, temperature, n=count)
+        return [choice['message']['content'].strip() for choice in response.get('choices', [])
+                if choice.get('message', {}).get('content')]
+
+    def fetch(temperature):
+        # Runs on a helper thread, so its usage is handed back to the item's thread
+        call_usage.tokens = 0
+        call_usage.failures = 0
+        call_usage.requests = 0
+        try:
+            response, tokens_used = call_with_budget(api_key, model, messages, kind, temperature)
+            return response['choices'][0]['message']['content'].strip(), None, (call_usage.tokens, call_usage.requests)
+        except Exception as error:
+            return None, error, (call_usage.tokens, call_usage.requests)
+
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        results = list(executor.map(fetch, [0.0] + [temperature] * (count - 1)))
+    answers = [answer for answer, _, _ in results if answer]
+    errors = [error for _, error, _ in results if error is not None]
+    record_call_usage(tokens=sum(usage[0] for _, _, usage in results), failed=not answers,
+                      requests=sum(usage[1] for _, _, usage in results))
+    if not answers and errors:
+        raise errors[0]
+    return answers
+
+
+# Function to properly test the Groq API call before using it in main functions
+def verify_groq_api_connection(api_key, model):
+    """
+    Test the Groq API connection to ensure it's working properly.
+    Run once at startup; the result seeds the shared endpoint health so a
+    dead endpoint fails fast instead of being probed before every item.
+    The model list is checked first, which costs no tokens; only endpoints
+    without one get a (short) chat round trip.
+
+    :param api_key: API key for authentication
+    :param model: Model name to use
+    :return: True if connection works, False otherwise
+    """
+    logger.info(f"Verifying API connection to {llm_backend.base_url}...")
+    model = llm_backend.model or model
+    try:
+        response = llm_backend.list_models(api_key)
+        if response.status_code == 200:
+            listed = {entry.get('id') for entry in response.json().get('data', [])}
+            if listed and model not in listed:
+                logger.warning(f"Model {model} is not listed by the endpoint")
+            logger.info("API Connection verified.")
+            endpoint_health.record_success()
+            return True
+        if response.status_code not in (404, 405):
+            logger.error(f"API connection failed. Status code: {response.status_code}")
+            logger.error(f"Response: {response.text}")
+            endpoint_health.trip()
+            return False
+    except (requests.RequestException, ValueError) as e:
+        logger.error(f"API connection error: {str(e)}")
+        endpoint_health.trip()
+        return False
+
+    data = {
+        "model": model,
+        "messages": [{"role": "user", "content": "Say 'Connection successful'"}],
+        'temperature': 0.0,
+        'max_tokens': 5,
+        'n': 1
+    }
+
+    try:
+        response, _ = llm_backend.post(api_key, data)
+
+        # Check if we get a successful response
+        if response.status_code == 200:
+            response_json = response.json()
+            if 'choices' in response_json and response_json['choices']:
+                content = response_json['choices'][0]['message']['content']
+                logger.info(f"API Connection verified. Response: {content}")
+                endpoint_health.record_success()
+                return True
+
+        logger.error(f"API connection failed. Status code: {response.status_code}")
+        logger.error(f"Response: {response.text}")
+        endpoint_health.trip()
+        return False
+
+    except Exception as e:
+        logger.error(f"API connection error: {str(e)}")
+        endpoint_health.trip()
+        return False
+
+
+# Function to call the Groq API
+def call_groq_api(api_key, model, messages, temperature=0.0, max_tokens=1000, n=1):
+    """
+    NOTE: DO NOT CHANGE/REMOVE THE TOKEN COUNT CALCULATION
+    Call the Groq API (or the backend set with set_llm_backend) to get a response from the language model.
+    :param api_key: API key for authentication
+    :param model: Model name to use
+    :param messages: List of message dictionaries
+    :param temperature: Temperature for the model
+    :param max_tokens: Maximum number of tokens to generate (these are max new tokens)
+    :param n: Number of responses to generate
+    :return: Response from the API
+    :raises CircuitBreakerOpen: If the endpoint is currently marked unhealthy
+    """
+    global total_tokens
+    model = llm_backend.model or model
+
+    data = {
+        "model": model,
+        "messages": messages,
+        'temperature': temperature,
+        'max_tokens': max_tokens,
+        'n': n
+    }
+
+    start = time.perf_counter()
+
+    # Deterministic calls are served from the response cache without touching the network
+    cache_key = None
+    if response_cache is not None and temperature == 0.0 and n == 1:
+        cache_key = ResponseCache.make_key(model, messages, temperature, llm_backend.base_url)
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            metrics.record_call(time.perf_counter() - start, "cache_hit", cache_hit=True, model=model)
+            return cached_response, total_tokens
+
+    if not endpoint_health.allow_request():
+        record_call_usage(failed=True)
+        metrics.record_call(0.0, "circuit_open", model=model)
+        raise CircuitBreakerOpen("API endpoint is unhealthy; call skipped")
+
+    try:
+        response, estimated_tokens = llm_backend.post(api_key, data)
+    except requests.RequestException:
+        endpoint_health.record_failure()
+        record_call_usage(failed=True)
+        metrics.record_call(time.perf_counter() - start, "error", model=model)
+        raise
+
+    # Only throttling that outlasted the retries and server errors say the endpoint is unhealthy;
+    # a client error (e.g. a prompt that is too long) is about this request alone
+    unserved = response.status_code == 429 or response.status_code >= 500
+    # Calls that were throttled or failed on the server side used no tokens
+    used_tokens = 0 if unserved else estimated_tokens
+    try:
+        response_json = response.json()
+        used_tokens = response_json.get('usage', {}).get('total_tokens', used_tokens)
+    except ValueError:
+        endpoint_health.record_failure()
+        record_call_usage(failed=True)
+        metrics.record_call(time.perf_counter() - start, "error", model=model)
+        raise
+    finally:
+        # Settle the reservation even when the body cannot be read
+        rate_limiter.record_usage(estimated_tokens, used_tokens)
+
+    usage = response_json.get('usage', {})
+    if unserved:
+        endpoint_health.record_failure()
+    else:
+        endpoint_health.record_success()
+    if response.status_code == 200 and response_json.get('choices'):
+        # An answer cut off at max_tokens is not cached, since the key does not include the budget
+        if cache_key is not None and all(choice.get('finish_reason') == 'stop' for choice in response_json['choices']):
+            response_cache.put(cache_key, response_json)
+        record_call_usage(tokens=usage.get('completion_tokens', 0), requests=1)
+        token_budget.calibrate(estimate_prompt_tokens(messages, scaled=False), usage.get('prompt_tokens', 0))
+        status = "ok"
+    else:
+        record_call_usage(failed=True, requests=1)
+        status = f"http_{response.status_code}"
+    metrics.record_call(time.perf_counter() - start, status, usage.get('prompt_tokens', 0),
+                        usage.get('completion_tokens', 0), getattr(response, 'retries', 0), model=model)
+
+    # Update the global token count
+    with total_tokens_lock:
+        total_tokens += response_json.get('usage', {}).get('completion_tokens', 0)
+
+        # You can get the completion from response_json['choices'][0]['message']['content']
+        return response_json, total_tokens
+
+
+# Function to call the API with a completion budget learned for this kind of call
+def call_with_budget(api_key, model, messages, kind, temperature=0.0, n=1):
+    """
+    Like call_groq_api, but max_tokens comes from token_budget. An answer cut
+    off at the budget (finish_reason "length") is retried once with a larger
+    one; complete answers from the backend (not the response cache, whose
+    answers were already recorded) are recorded to refine the budget.
+
+    :param api_key: API key for Groq
+    :param model: Model name
+    :param messages: List of message dictionaries
+    :param kind: Kind key from token_budget.kind()
+    :param temperature: Temperature for the model
+    :param n: Number of responses to generate
+    :return: Response from the API and the running total of tokens, as from call_groq_api
+    :raises CircuitBreakerOpen: If the endpoint is currently marked unhealthy
+    """
+    max_tokens = token_budget.budget(kind)
+    requests_before = getattr(call_usage, 'requests', 0)
+    response, tokens_used = call_groq_api(api_key, model, messages, temperature, max_tokens, n)
+    choices = response.get('choices') or []
+    if any(choice.get('finish_reason') == 'length' for choice in choices):
+        with token_budget.lock:
+            token_budget.truncated += 1
+        metrics.increment("truncated_answers_total", kind=kind.split(':')[0])
+        max_tokens = token_budget.retry_budget(max_tokens)
+        if max_tokens is None:
+            return response, tokens_used
+        response, tokens_used = call_groq_api(api_key, model, messages, temperature, max_tokens, n)
+        choices = response.get('choices') or []
+
+    served = getattr(call_usage, 'requests', 0) > requests_before
+    if served and choices and all(choice.get('finish_reason') == 'stop' for choice in choices):
+        completion_tokens = response.get('usage', {}).get('completion_tokens', 0)
+        token_budget.record(kind, completion_tokens // len(choices))
+    return response, tokens_used
+
+
+# Function to label an item by whether its API calls reached the backend
+def item_source():
+    """
+    :return: "api" if a call made for the item on this thread reached the backend,
+             "response_cache" if every call was answered from the response cache
+    """
+    return "api" if getattr(call_usage, 'requests', 0) else "response_cache"
+
+
+# Function to attribute API usage to the item being processed on this thread
+def record_call_usage(tokens=0, failed=False, requests=0):
+    """
+    :param tokens: Completion tokens spent by the call
+    :param failed: Whether the call failed (the item should be retried on resume)
+    :param requests: Requests that reached the backend (response cache hits do not)
+    """
+    call_usage.tokens = getattr(call_usage, 'tokens', 0) + tokens
+    call_usage.failures = getattr(call_usage, 'failures', 0) + (1 if failed else 0)
+    call_usage.requests = getattr(call_usage, 'requests', 0) + requests
+
+
+class CheckpointJournal:
+    """
+    Append-only JSONL journal of completed batch items, used to resume an interrupted run.
+
+    The first line identifies the input file by path, size and SHA-256 of its
+    contents, so an input edited in place (even to the same size) starts a
+    fresh journal. Every following line records
+    one finished item: its input index, its result and the completion tokens
+    it used. Items whose API calls failed are not journaled, so a resumed run
+    retries them. When resuming, journaled items are replayed in their
+    original position without calling the API, so the output file comes out
+    the same as after an uninterrupted run.
+    """
+
+    def __init__(self, path, input_path, resume=False):
+        self.path = path
+        self.header = self.identify(input_path)
+        self.completed = {}
+        self.resumed_tokens = 0
+        self.lock = threading.Lock()
+
+        if resume:
+            self.load()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a' if self.completed else 'w')
+        if not self.completed:
+            self.file.write(json.dumps(self.header) + '\n')
+            self.file.flush()
+
+    @staticmethod
+    def identify(input_path):
+        """
+        :param input_path: Batch input file
+        :return: Dict identifying the exact file contents the journal belongs to
+        """
+        digest = hashlib.sha256()
+        with open(input_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return {"input": os.path.abspath(input_path), "size": os.path.getsize(input_path),
+                "sha256": digest.hexdigest()}
+
+    def load(self):
+        """Read completed items from an existing journal for the same input."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as file:
+            lines = iter(file)
+            try:
+                header = json.loads(next(lines))
+            except (StopIteration, ValueError):
+                return
+            if header != self.header:
+                logger.warning(f"Checkpoint {self.path} belongs to a different input; starting from the beginning.")
+                return
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Skip a torn final line from the interrupted run
+                self.completed[entry["index"]] = entry
+
+        self.resumed_tokens = sum(entry.get("tokens", 0) for entry in self.completed.values())
+        logger.info(f"Resuming from {self.path}: {len(self.completed)} items already done.")
+
+    def wrap(self, worker):
+        """
+        :param worker: Callable taking (index, item) and returning a result
+        :return: Worker that replays journaled items and journals new ones
+        """
+        def checkpointed(index, item):
+            with self.lock:
+                entry = self.completed.pop(index, None)
+            if entry is not None:
+                return entry["result"]
+
+            call_usage.tokens = 0
+            call_usage.failures = 0
+            result = worker(index, item)
+            if call_usage.failures == 0:
+                self.record(index, result, call_usage.tokens)
+            return result
+
+        return checkpointed
+
+    def record(self, index, result, tokens):
+        line = json.dumps({"index": index, "result": result, "tokens": tokens})
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        """Close the journal but keep it, so a later run can still resume from it."""
+        self.file.close()
+
+    def remove(self):
+        """Close and delete the journal once the whole run has finished."""
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class TimedIterator(CountingIterator):
+    """CountingIterator that also records when each item was drawn, for per-item latency."""
+
+    def __init__(self, items):
+        super().__init__(items)
+        self.drawn_at = []
+
+    def __next__(self):
+        item = super().__next__()
+        self.drawn_at.append(time.perf_counter())
+        return item
+
+
+# Function to build a synthetic workload for both tasks
+def make_synthetic_workload(count, seed=0):
+    """
+    Questions repeat with different numbers, as real traffic does, so the
+    caches get exercised. About one correction in five is broken in a way
+    only the API can fix.
+
+    :param count: Number of items per task
+    :param seed: Random seed, so runs are comparable
+    :return: Tuple of (generation items, correction items)
+    """
+    rng = random.Random(seed)
+    tables = ["customers", "orders", "products", "employees", "payments"]
+    columns = ["total_amount", "created_at", "status", "price", "quantity", "salary"]
+    questions = [
+        "Find all {t} with {c} greater than {n}",
+        "How many {t} have {c} below {n}?",
+        "List the top {n} {t} by {c}",
+        "Show the average {c} of {t} created in the last {n} days",
+    ]
+    broken = [
+        "SELECT {c} FROM {t} WHERE {c} = ;",
+        "SELECT , {c} FROM {t}",
+        "SELECT {c} FROM {t} ORDER BY {c} WHERE {c} > {n}",
+    ]
+    generation = [{"NL": rng.choice(questions).format(t=rng.choice(tables), c=rng.choice(columns), n=rng.randint(1, 50))}
+                  for _ in range(count)]
+    queries = make_synthetic_queries(count, seed)
+    correction = []
+    for position, query in enumerate(queries):
+        if rng.random() < 0.2:
+            query = rng.choice(broken).format(t=rng.choice(tables), c=rng.choice(columns), n=rng.randint(1, 50))
+        correction.append({"NL": generation[position]["NL"], "IncorrectQuery": query})
+    return generation, correction
+
+
+# Function to compute a latency percentile
+def percentile(values, fraction):
+    """
+    :param values: Sorted list of numbers
+    :param fraction: Percentile as a fraction, e.g. 0.95
+    :return: Nearest-rank percentile, or 0.0 for an empty list
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+# Function to benchmark both tasks end to end against the mock server
+def benchmark_pipeline(count=500, generate_path=None, correct_path=None, concurrency=MAX_CONCURRENCY,
+                       batch_size=BATCH_SIZE, candidates=CANDIDATES, latency_ms=100.0, requests_per_minute=600,
+                       tokens_per_minute=200000, seed=0, output_path="benchmark_results.json"):
+    """
+    Run a workload through generation and correction against MockChatServer,
+    with fresh caches, rate limiter and endpoint health so runs are
+    comparable, and write the results as JSON.
+
+    :param count: Items per task for the synthetic workload, or the maximum taken from recorded files
+    :param generate_path: Recorded generation input (JSON/JSONL); synthetic when None
+    :param correct_path: Recorded correction input (JSON/JSONL); synthetic when None
+    :param concurrency: Maximum number of API calls in flight at once
+    :param batch_size: Maximum number of items per API call
+    :param candidates: Candidate queries requested per generated question
+    :param latency_ms: Median latency of the mock server
+    :param requests_per_minute: Request limit of both the mock server and the rate limiter
+    :param tokens_per_minute: Token limit of both the mock server and the rate limiter
+    :param seed: Random seed for the workload and the mock server
+    :param output_path: File the JSON results are written to (None to skip)
+    :return: Dictionary of results
+    """
+    global llm_backend, rate_limiter, endpoint_health, response_cache, semantic_cache, token_budget, total_tokens
+    generation, correction = make_synthetic_workload(count, seed)
+    if generate_path:
+        generation = list(itertools.islice(iter_input_items(generate_path), count))
+    if correct_path:
+        correction = list(itertools.islice(iter_input_items(correct_path), count))
+
+    saved = (llm_backend, rate_limiter, endpoint_health, response_cache, semantic_cache, token_budget, total_tokens)
+    results = {
+        "config": {
+            "items_per_task": {"generate": len(generation), "correct": len(correction)},
+            "workload": {"generate": generate_path or "synthetic", "correct": correct_path or "synthetic"},
+            "concurrency": concurrency, "batch_size": batch_size, "candidates": candidates,
+            "mock_latency_ms": latency_ms,
+            "requests_per_minute": requests_per_minute, "tokens_per_minute": tokens_per_minute, "seed": seed,
+        },
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            MockChatServer(latency_ms, requests_per_minute=requests_per_minute,
+                           tokens_per_minute=tokens_per_minute, seed=seed) as mock:
+        try:
+            llm_backend = ChatBackend(mock.base_url)
+            rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+            endpoint_health = CircuitBreaker()
+            response_cache = ResponseCache(os.path.join(cache_dir, "responses.sqlite3"))
+            semantic_cache = SemanticCache(os.path.join(cache_dir, "semantic.jsonl"))
+            token_budget = TokenBudget(None)
+
+            tasks = (
+                ("generate", generation, iter_generate_sqls, {"candidates": candidates}),
+                ("correct", correction, iter_correct_sqls, {}),
+            )
+            for name, items, run, options in tasks:
+                mock_before = mock.stats()
+                response_before = response_cache.stats()
+                semantic_before = semantic_cache.stats()
+                sleep_before = rate_limiter.total_sleep_time
+                tokens_before = total_tokens
+                truncated_before = token_budget.truncated
+                api_items_key = metrics.key("items_total", {"task": name, "source": "api"})
+                api_items_before = metrics.counters[api_items_key]
+
+                timed_items = TimedIterator(items)
+                latencies = []
+                start = time.perf_counter()
+                for index, result in enumerate(run(timed_items, concurrency, batch_size=batch_size, **options)):
+                    latencies.append(time.perf_counter() - timed_items.drawn_at[index])
+                elapsed = time.perf_counter() - start
+
+                mock_after = mock.stats()
+                response_after = response_cache.stats()
+                lookups = (response_after["hits"] + response_after["misses"]) - (response_before["hits"] + response_before["misses"])
+                response_hits = response_after["hits"] - response_before["hits"]
+                semantic_hits = semantic_cache.stats()["hits"] - semantic_before["hits"]
+                # Items whose answer came from the backend; response cache hits count as local
+                api_items = int(metrics.counters[api_items_key] - api_items_before)
+                served = mock_after["requests"] - mock_before["requests"] - (mock_after["throttled"] - mock_before["throttled"])
+                latencies.sort()
+                results[name] = {
+                    "items": len(latencies),
+                    "seconds": elapsed,
+                    "items_per_second": len(latencies) / elapsed if elapsed else 0.0,
+                    "latency_seconds": {
+                        "p50": percentile(latencies, 0.50),
+                        "p95": percentile(latencies, 0.95),
+                        "p99": percentile(latencies, 0.99),
+                        "max": latencies[-1] if latencies else 0.0,
+                    },
+                    "rate_limit_sleep_seconds": rate_limiter.total_sleep_time - sleep_before,
+                    "api_requests": served,
+                    "throttled_requests": mock_after["throttled"] - mock_before["throttled"],
+                    "response_cache_hit_rate": response_hits / lookups if lookups else 0.0,
+                    "semantic_cache_hits": semantic_hits,
+                    "local_items": len(latencies) - api_items,
+                    "api_items": api_items,
+                    "completion_tokens_per_item": (total_tokens - tokens_before) / len(latencies) if latencies else 0.0,
+                    "total_tokens_per_item": ((mock_after["prompt_tokens"] + mock_after["completion_tokens"])
+                                              - (mock_before["prompt_tokens"] + mock_before["completion_tokens"]))
+                                             / len(latencies) if latencies else 0.0,
+                    "truncated_answers": token_budget.truncated - truncated_before,
+                }
+                logger.info(f"{name}: {results[name]['items_per_second']:.1f} items/sec, "
+                      f"p95 {results[name]['latency_seconds']['p95'] * 1000:.0f} ms, "
+                      f"{served} API requests for {len(latencies)} items")
+        finally:
+            llm_backend, rate_limiter, endpoint_health, response_cache, semantic_cache, token_budget, total_tokens = saved
+
+    if output_path:
+        with open(output_path, 'w') as file:
+            json.dump(results, file, indent=2)
+        logger.info(f"Benchmark results written to {output_path}")
+    return results
+
+
+# Function to clean up a large query corpus with the local rewrite stages only
+def cleanup_queries(input_path, output_path, processes=LOCAL_STAGE_PROCESSES, chunk_size=LOCAL_STAGE_CHUNK_SIZE):
+    """
+    Run the local fix, compatibility and validation stages over every query
+    in a correction-style input (no API calls), spread over a process pool.
+    Output keeps the input order, with a Status of valid, fixed or broken.
+
+    :param input_path: JSON array or JSONL of dicts with IncorrectQuery (or bare query strings)
+    :param output_path: JSON file to write the cleaned-up queries to
+    :param processes: Number of worker processes
+    :param chunk_size: Queries per task sent to a worker
+    :return: Dict counting the queries per status
+    """
+    counts = collections.Counter()
+    start = time.time()
+    with JsonOutputWriter(output_path) as output:
+        for item, (status, fixed_query) in iter_local_stage(classify_correction_item, iter_input_items(input_path),
+                                                            processes, chunk_size):
+            incorrect_query = item.get('IncorrectQuery', '') if isinstance(item, dict) else str(item)
+            output.write({"IncorrectQuery": incorrect_query, "CorrectQuery": fixed_query, "Status": status})
+            counts[status] += 1
+            if output.count % 100000 == 0:
+                logger.info(f"Cleaned up {output.count} queries")
+    elapsed = time.time() - start
+    logger.info(f"Cleaned up {output.count} queries in {elapsed:.1f}s "
+                f"({output.count / elapsed if elapsed else 0:.0f} queries/s) using {processes} processes")
+    return dict(counts)
+
+
+class SqlService:
+    """
+    Long-running front end to generate_sqls and correct_sqls, so traffic is
+    served by one warm process (compiled rules, caches, pooled HTTP
+    connections) instead of a script started per job.
+
+    Identical requests that arrive while one is in flight share its result.
+    Requests are collected for up to `batch_window_ms` (or `max_batch_items`)
+    into a micro-batch, and each micro-batch runs through the streaming
+    pipeline, where concurrent requests share the concurrency window and,
+    with batch_size > 1, the prompt batches. Several micro-batches can be in
+    flight at once.
+
+    Requests come in over HTTP (start()) or as JSON lines (serve_jsonl()).
+    """
+
+    tasks = ("generate", "correct")
+    # Input fields of each task; all optional, but strings when given
+    fields = {"generate": ("NL",), "correct": ("NL", "IncorrectQuery")}
+
+    def __init__(self, batch_window_ms=SERVICE_BATCH_WINDOW_MS, max_batch_items=SERVICE_MAX_BATCH_ITEMS,
+                 max_batches=SERVICE_MAX_BATCHES, concurrency=MAX_CONCURRENCY, batch_size=BATCH_SIZE,
+                 candidates=CANDIDATES):
+        """
+        :param batch_window_ms: How long the first request of a micro-batch waits for others
+        :param max_batch_items: Maximum number of requests in one micro-batch
+        :param max_batches: Maximum number of micro-batches in flight at once
+        :param concurrency: Maximum number of API calls in flight per micro-batch
+        :param batch_size: Maximum number of items sent in one API call
+        :param candidates: Candidate queries requested per generated question
+        """
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch_items = max_batch_items
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.candidates = candidates
+        self.queues = {task: queue.Queue() for task in self.tasks}
+        self.in_flight = {}  # (task, canonical item JSON) -> Future shared by identical requests
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_batches)
+        self.closed = threading.Event()
+        self.server = None
+        self.thread = None
+
+        # Size the shared connection pool for every micro-batch (and candidate request) in flight
+        get_http_session(concurrency * max_batches * candidate_requests(candidates))
+        self.dispatchers = [threading.Thread(target=self.dispatch, args=(task,), daemon=True) for task in self.tasks]
+        for dispatcher in self.dispatchers:
+            dispatcher.start()
+
+    def submit(self, task, item):
+        """
+        :param task: "generate" (item has NL) or "correct" (item has NL and IncorrectQuery)
+        :param item: Input item, as in the input files
+        :return: Future resolving to the output item
+        :raises ValueError: If the request is malformed; nothing is queued then
+        """
+        self.validate(task, item)
+        key = (task, json.dumps(item, sort_keys=True))
+        with self.lock:
+            self.requests += 1
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = Future()
+            self.in_flight[key] = future
+        self.queues[task].put((key, item, future))
+        return future
+
+    @classmethod
+    def validate(cls, task, item):
+        """
+        Reject a malformed request before it joins a micro-batch, where it
+        would fail the other requests with it.
+
+        :raises ValueError: If the task is unknown, the item is not an object or a field is not a string
+        """
+        if not isinstance(task, str) or task not in cls.fields:
+            raise ValueError(f"Unknown task: {task}")
+        if not isinstance(item, dict):
+            raise ValueError(f"Expected an object, got {type(item).__name__}")
+        for field in cls.fields[task]:
+            if field in item and not isinstance(item[field], str):
+                raise ValueError(f"{field} must be a string")
+
+    def run(self, task, items, timeout=None):
+        """
+        :param task: "generate" or "correct"
+        :param items: List of input items
+        :param timeout: Seconds to wait for the results (None = no limit)
+        :return: List of output items, in input order
+        """
+        futures = [self.submit(task, item) for item in items]
+        return [future.result(timeout) for future in futures]
+
+    def dispatch(self, task):
+        # Collect requests into micro-batches and hand them to the executor
+        requests_queue = self.queues[task]
+        while not (self.closed.is_set() and requests_queue.empty()):
+            try:
+                batch = [requests_queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(requests_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.batches += 1
+            metrics.observe("service_batch_items", len(batch), BATCH_ITEM_BUCKETS, task=task)
+            self.executor.submit(self.process, task, batch)
+
+    def answer(self, task, items):
+        if task == "generate":
+            return generate_sqls(items, self.concurrency, self.batch_size, self.candidates)
+        # Micro-batches are too small to be worth a process pool
+        return correct_sqls(items, self.concurrency, self.batch_size, processes=1)
+
+    def process(self, task, batch):
+        items = [item for _, item, _ in batch]
+        try:
+            results = self.answer(task, items)
+        except Exception as error:
+            # Retry item by item, so a request that still breaks the pipeline fails alone
+            logger.error(f"Service {task} batch of {len(batch)} failed: {str(error)}")
+            results = []
+            for item in items:
+                try:
+                    results.extend(self.answer(task, [item]))
+                except Exception as item_error:
+                    results.append(item_error)
+
+        # Resolve before forgetting the keys, so a duplicate arriving in between gets the finished result
+        for (_, _, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        with self.lock:
+            for key, _, _ in batch:
+                self.in_flight.pop(key, None)
+
+    def start(self, host=SERVICE_HOST, port=SERVICE_PORT):
+        """
+        Serve HTTP in a background thread:
+
+        - POST /generate and POST /correct take one input item, or a list of
+          them, and answer with the output item(s); a malformed single item
+          gets a 400, a malformed item in a list gets {"error": ...} in its place
+        - GET /health reports the API endpoint state
+        - GET /stats reports service counters
+        - GET /metrics serves the metrics in Prometheus text format
+
+        :param host: Interface to listen on
+        :param port: Port to listen on (0 = any free port)
+        :return: Base URL of the service
+        """
+        service = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send(self, status, body, content_type='application/json'):
+                payload = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path == '/health':
+                    self.send(200, {"status": "ok", "endpoint": endpoint_health.state})
+                elif self.path == '/stats':
+                    self.send(200, service.stats())
+                elif self.path == '/metrics':
+                    self.send(200, metrics.prometheus(), 'text/plain; version=0.0.4')
+                else:
+                    self.send(404, {"error": f"Unknown path: {self.path}"})
+
+            def do_POST(self):
+                task = self.path.strip('/')
+                length = int(self.headers.get('Content-Length', 0))
+                if task not in service.queues:
+                    self.rfile.read(length)
+                    self.send(404, {"error": f"Unknown path: {self.path}"})
+                    return
+                try:
+                    body = json.loads(self.rfile.read(length) or b'null')
+                except ValueError as error:
+                    self.send(400, {"error": f"Invalid JSON: {str(error)}"})
+                    return
+                if not isinstance(body, list):
+                    try:
+                        result = service.run(task, [body])[0]
+                    except ValueError as error:
+                        self.send(400, {"error": str(error)})
+                        return
+                    except Exception as error:
+                        self.send(500, {"error": str(error)})
+                        return
+                    self.send(200, result)
+                    return
+
+                # In a list, a bad item gets its own error and the others are still answered
+                futures = []
+                for item in body:
+                    try:
+                        futures.append(service.submit(task, item))
+                    except ValueError as error:
+                        futures.append(error)
+                results = []
+                for future in futures:
+                    try:
+                        if isinstance(future, Exception):
+                            raise future
+                        results.append(future.result())
+                    except Exception as error:
+                        results.append({"error": str(error)})
+                self.send(200, results)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(http.server.ThreadingHTTPServer):
+            # The default listen backlog of 5 resets connections when a burst of clients arrives at once
+            request_queue_size = 128
+
+        self.server = Server((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        url = f"http://{host}:{self.server.server_address[1]}"
+        logger.info(f"Serving on {url}")
+        return url
+
+    def serve_jsonl(self, input_file=sys.stdin, output_file=sys.stdout):
+        """
+        Answer JSON lines such as {"task": "generate", "id": 7, "NL": "..."}
+        until the input ends. Each answer is written as soon as it is ready,
+        so answers can come out of order; "id" (if given) and "task" are
+        echoed back to match them up.
+
+        :param input_file: File to read requests from
+        :param output_file: File to write answers to
+        :return: Number of requests answered
+        """
+        write_lock = threading.Lock()
+        futures = []
+
+        def write(answer):
+            with write_lock:
+                output_file.write(json.dumps(answer) + '\n')
+                output_file.flush()
+
+        def reply(header, future):
+            try:
+                write({**header, **future.result()})
+            except Exception as error:
+                write({**header, "error": str(error)})
+
+        for line in input_file:
+            if not line.strip():
+                continue
+            header = {}
+            try:
+                request = json.loads(line)
+                if isinstance(request, dict):
+                    header = {key: request.pop(key) for key in ('id', 'task') if key in request}
+                future = self.submit(header.get('task', 'generate'), request)
+            except ValueError as error:
+                write({**header, "error": f"Invalid request: {str(error)}"})
+                continue
+            future.add_done_callback(functools.partial(reply, header))
+            futures.append(future)
+        for future in futures:
+            with contextlib.suppress(Exception):
+                future.result()
+        return len(futures)
+
+    def stats(self):
+        """:return: Dict with the number of requests, coalesced requests and micro-batches"""
+        with self.lock:
+            return {"requests": self.requests, "coalesced": self.coalesced, "batches": self.batches,
+                    "in_flight": len(self.in_flight)}
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.closed.set()
+        for dispatcher in self.dispatchers:
+            dispatcher.join()
+        self.executor.shutdown(wait=True)
+
+
+# Main function
+# TODO: Specify the path to your input file
+def main(resume=False, checkpoint_dir=CHECKPOINT_DIR, batch_size=BATCH_SIZE, processes=LOCAL_STAGE_PROCESSES,
+         candidates=CANDIDATES, input_file_path_1='/train_generate_task.json',
+         input_file_path_2='/train_query_coorection_task.json',
+         output_file_path_1='output_sql_generation_task.json', output_file_path_2='output_sql_correction_task.json'):
+    """
+    Run both tasks, journaling progress so an interrupted run can be resumed.
+
+    Both journals are kept until the whole run succeeds, so a run interrupted during correction
+    resumes without repeating any generation calls.
+
+    :param resume: Skip items completed by a previous, interrupted run
+    :param checkpoint_dir: Directory holding the checkpoint journals
+    :param batch_size: Maximum number of items sent in one API call
+    :param processes: Worker processes for the local correction stage
+    :param candidates: Candidate queries requested per generated question
+    :param input_file_path_1: JSON array of generation task items
+    :param input_file_path_2: JSON array of correction task items
+    :param output_file_path_1: Where the generated queries are written
+    :param output_file_path_2: Where the corrected queries are written
+    :return: Tuple of (generation time, correction time) in seconds
+    """
+    global total_tokens
+
+    # Check the API connection once; a failure makes every call fail fast (or use local fixes)
+    if not verify_groq_api_connection(API_KEY, MODEL):
+        logger.warning("API unavailable. Generation will return blank queries and correction will use local fixes only.")
+
+    # Stream inputs lazily and append each result to the output as soon as it completes
+    data_1 = CountingIterator(iter_input_items(input_file_path_1))
+    data_2 = CountingIterator(iter_input_items(input_file_path_2))
+
+    # Journal finished items so a restart can skip them
+    journal_1 = CheckpointJournal(os.path.join(checkpoint_dir, 'generate.jsonl'), input_file_path_1, resume)
+    journal_2 = CheckpointJournal(os.path.join(checkpoint_dir, 'correct.jsonl'), input_file_path_2, resume)
+    with total_tokens_lock:
+        total_tokens += journal_1.resumed_tokens + journal_2.resumed_tokens
+
+    start = time.time()
+    # Generate SQL statements
+    # Get the outputs as a list of dicts with keys 'NL' and 'Query'
+    with JsonOutputWriter(output_file_path_1) as sql_statements:
+        try:
+            for result in iter_generate_sqls(data_1, journal=journal_1, batch_size=batch_size,
+                                             candidates=candidates):
+                sql_statements.write(result)
+        finally:
+            journal_1.close()
+    generate_sqls_time = time.time() - start
+
+    start = time.time()
+    # Correct SQL statements
+    # Get the outputs as a list of dicts with keys 'IncorrectQuery' and 'CorrectQuery'
+    with JsonOutputWriter(output_file_path_2) as corrected_sqls:
+        try:
+            for result in iter_correct_sqls(data_2, journal=journal_2, batch_size=batch_size,
+                                            processes=processes):
+                corrected_sqls.write(result)
+        finally:
+            journal_2.close()
+    correct_sqls_time = time.time() - start
+
+    assert data_2.count == corrected_sqls.count  # If no answer, leave blank
+    assert data_1.count == sql_statements.count  # If no answer, leave blank
+
+    # Only now is the whole run done; until here a restart must be able to replay either task
+    journal_1.remove()
+    journal_2.remove()
+
+    # Keep the learned completion budgets for the next run
+    token_budget.save()
+
+    return generate_sqls_time, correct_sqls_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate and correct PostgreSQL queries with the Groq API.")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip items completed by a previous, interrupted run")
+    parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR,
+                        help="directory for checkpoint journals (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, metavar="N",
+                        help="pack up to N items into one API call (default: %(default)s)")
+    parser.add_argument("--candidates", type=int, default=CANDIDATES, metavar="N",
+                        help="request N candidate queries per question and keep the best-ranked one "
+                             "(default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=LOCAL_STAGE_PROCESSES, metavar="N",
+                        help="processes for the local fix and validation stage (default: %(default)s)")
+    parser.add_argument("--serve", type=int, nargs="?", const=SERVICE_PORT, metavar="PORT",
+                        help="serve POST /generate and /correct over HTTP on %s:PORT (default port: %d)"
+                             % (SERVICE_HOST, SERVICE_PORT))
+    parser.add_argument("--serve-jsonl", action="store_true",
+                        help="answer JSON-line requests from stdin on stdout until stdin ends")
+    parser.add_argument("--cleanup", nargs=2, metavar=("INPUT", "OUTPUT"),
+                        help="fix and validate every query in INPUT locally (no API calls), write OUTPUT and exit")
+    parser.add_argument("--schema", metavar="PATH",
+                        help="DDL file or JSON catalog whose relevant tables are added to generation prompts")
+    parser.add_argument("--verify-dsn", metavar="DSN",
+                        help="check that output SQL runs against this database (PostgreSQL DSN or sqlite://[path])")
+    parser.add_argument("--base-url", metavar="URL",
+                        help="OpenAI-compatible API root to use instead of Groq (default: %s)" % API_BASE_URL)
+    parser.add_argument("--mock-server", action="store_true",
+                        help="answer every API call from a local mock server (no network or quota needed)")
+    parser.add_argument("--metrics-jsonl", metavar="PATH",
+                        help="append a JSON record for every API call to PATH")
+    parser.add_argument("--metrics-prom", metavar="PATH",
+                        help="write counters and histograms in Prometheus text format to PATH at the end")
+    parser.add_argument("--profile", action="store_true",
+                        help="time the local rewrite stages (reported in the metrics)")
+    parser.add_argument("--benchmark", type=int, nargs="?", const=500, metavar="N",
+                        help="benchmark both tasks on N items each against the mock server and exit")
+    parser.add_argument("--benchmark-output", default="benchmark_results.json", metavar="PATH",
+                        help="where --benchmark writes its JSON results (default: %(default)s)")
+    parser.add_argument("--workload-generate", metavar="PATH",
+                        help="recorded generation input for --benchmark (default: synthetic)")
+    parser.add_argument("--workload-correct", metavar="PATH",
+                        help="recorded correction input for --benchmark (default: synthetic)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    metrics.profiling = args.profile
+    if args.metrics_jsonl or METRICS_JSONL_PATH:
+        metrics.open_jsonl(args.metrics_jsonl or METRICS_JSONL_PATH)
+
+    if args.cleanup:
+        print(f"Cleanup: {cleanup_queries(*args.cleanup, processes=args.workers)}")
+        sys.exit(0)
+    if args.benchmark:
+        benchmark_pipeline(args.benchmark, args.workload_generate, args.workload_correct,
+                           batch_size=args.batch_size, candidates=args.candidates,
+                           output_path=args.benchmark_output)
+        sys.exit(0)
+
+    mock_server = None
+    if args.mock_server:
+        mock_server = MockChatServer()
+        set_llm_backend(ChatBackend(mock_server.start(), supports_n=True))
+    elif args.base_url:
+        set_llm_backend(ChatBackend(args.base_url))
+
+    if args.schema:
+        load_schema_index(args.schema)
+    if args.schema or args.verify_dsn:
+        try:
+            load_query_verifier(args.verify_dsn or VERIFY_DSN)
+        except (ValueError, RuntimeError) as error:
+            parser.error(str(error))
+
+    if args.serve is not None or args.serve_jsonl:
+        if not verify_groq_api_connection(API_KEY, MODEL):
+            logger.warning("API unavailable. Generation will return blank queries and correction will use local fixes only.")
+        service = SqlService(batch_size=args.batch_size, candidates=args.candidates)
+        try:
+            if args.serve_jsonl:
+                service.serve_jsonl()
+            else:
+                service.start(port=args.serve)
+                service.thread.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+            token_budget.save()
+            if mock_server is not None:
+                mock_server.stop()
+        logger.info(f"Service: {service.stats()}")
+        if args.metrics_prom or METRICS_PROMETHEUS_PATH:
+            metrics.write_prometheus(args.metrics_prom or METRICS_PROMETHEUS_PATH)
+        metrics.close()
+        sys.exit(0)
+
+    generate_sqls_time, correct_sqls_time = main(resume=args.resume, checkpoint_dir=args.checkpoint_dir,
+                                                batch_size=args.batch_size, processes=args.workers,
+                                                candidates=args.candidates)
+    print(f"Time taken to generate SQLs: {generate_sqls_time} seconds")
+    print(f"Time taken to correct SQLs: {correct_sqls_time} seconds")
+    print(f"Total tokens: {total_tokens}")
+    if response_cache is not None:
+        print(f"Response cache: {response_cache.stats()}")
+    if semantic_cache is not None:
+        print(f"Semantic cache: {semantic_cache.stats()}")
+    if query_verifier is not None:
+        print(f"Query verification: {query_verifier.stats()}")
+    print(f"Token budget: {token_budget.stats()}")
+    if mock_server is not None:
+        print(f"Mock server: {mock_server.stats()}")
+        mock_server.stop()
+    print(f"Metrics: {metrics.summary()}")
+    if args.metrics_prom or METRICS_PROMETHEUS_PATH:
+        metrics.write_prometheus(args.metrics_prom or METRICS_PROMETHEUS_PATH)
+    metrics.close()
+
@@ -0,0 +1,30 @@
+import importlib
+
+import pytest
+
+
+# Function to import test-NLP.py through its importable alias
+@pytest.fixture(scope="session")
+def nlp():
+    """
+    :return: The test-NLP.py module
+    """
+    return importlib.import_module("nlp_module")
+
+
+# Function to answer every API call from a fast local mock server, with no caches in the way
+@pytest.fixture
+def mock_server(nlp, monkeypatch):
+    """
+    :return: The running MockChatServer
+    """
+    server = nlp.MockChatServer(latency_ms=1.0, latency_sigma=0.0, requests_per_minute=100000,
+                                tokens_per_minute=10 ** 9)
+    base_url = server.start()
+    monkeypatch.setattr(nlp, "llm_backend", nlp.ChatBackend(base_url))
+    monkeypatch.setattr(nlp, "rate_limiter", nlp.RateLimiter(100000, 10 ** 9))
+    monkeypatch.setattr(nlp, "response_cache", None)
+    monkeypatch.setattr(nlp, "semantic_cache", None)
+    monkeypatch.setattr(nlp, "token_budget", nlp.TokenBudget(path=None))
+    yield server
+    server.stop()
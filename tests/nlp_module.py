@@ -0,0 +1,12 @@
+# Importable alias of test-NLP.py, whose file name is not a valid module name.
+# Worker processes started by the local-stage pool re-import it by this name.
+import importlib.util
+import os
+import sys
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test-NLP.py")
+
+spec = importlib.util.spec_from_file_location(__name__, SCRIPT_PATH)
+module = importlib.util.module_from_spec(spec)
+sys.modules[__name__] = module
+spec.loader.exec_module(module)
@@ -0,0 +1,48 @@
+import pytest
+
+
+@pytest.mark.parametrize("content, expected", [
+    ('[{"id": 1, "sql": "SELECT 1;"}, {"id": 2, "sql": "SELECT 2;"}]', ["SELECT 1;", "SELECT 2;"]),
+    ('```json\n[{"id": 2, "sql": "SELECT 2;"}, {"id": 1, "sql": "SELECT 1;"}]\n```', ["SELECT 1;", "SELECT 2;"]),
+    ('["SELECT 1;", "SELECT 2;"]', ["SELECT 1;", "SELECT 2;"]),
+    ('[{"id": "2", "sql": "SELECT 2;"}]', [None, "SELECT 2;"]),
+    # Cut off by max_tokens: everything before the cut survives
+    ('[{"id": 1, "sql": "SELECT 1;"}, {"id": 2, "sql": "SEL', ["SELECT 1;", None]),
+    # Garbled, duplicate, out-of-range and empty answers are dropped
+    ('Sure! Here are your queries.', [None, None]),
+    ('[{"id": 1, "sql": "SELECT 1;"}, {"id": 1, "sql": "SELECT 9;"}, {"id": 7, "sql": "SELECT 7;"}]',
+     ["SELECT 1;", None]),
+    ('[{"id": 1, "sql": "  "}, {"id": 2, "query": "SELECT 2;"}]', [None, None]),
+    ('[{"id": 1, "sql": "SELECT 1;"} oops {"id": 2, "sql": "SELECT 2;"}]', ["SELECT 1;", None]),
+])
+def test_parse_batch_answers(nlp, content, expected):
+    assert nlp.parse_batch_answers(content, 2) == expected
+
+
+def test_only_unparsed_items_are_retried(nlp, mock_server, monkeypatch):
+    requests = []
+
+    class RecordingBackend(nlp.ChatBackend):
+        def post(self, api_key, data):
+            requests.append(data["messages"][1]["content"].splitlines()[1:])
+            return super().post(api_key, data)
+
+    monkeypatch.setattr(nlp, "llm_backend", RecordingBackend(nlp.llm_backend.base_url))
+    # The mock cuts answers off at max_tokens, so a small budget leaves the tail of each batch unanswered
+    batcher = nlp.PromptBatcher(nlp.GENERATION_SYSTEM_PROMPT, "Requests:", max_batch_size=4, max_tokens=30)
+    entries = ["list customers", "list orders", "list products", "list suppliers"]
+
+    answers = batcher.answer(nlp.API_KEY, nlp.MODEL, entries)
+
+    assert answers == ["SELECT * FROM customers LIMIT 10;", "SELECT * FROM orders LIMIT 10;",
+                       "SELECT * FROM products LIMIT 10;", "SELECT * FROM suppliers LIMIT 10;"]
+    assert requests == [["1. list customers", "2. list orders", "3. list products", "4. list suppliers"],
+                        ["1. list products", "2. list suppliers"]]
+    assert batcher.batch_size == 3  # Halved to 2 after the incomplete batch, then grown by one
+
+
+def test_failed_request_leaves_items_for_the_single_prompt(nlp, mock_server):
+    mock_server.throttle_rate = 1.0
+    nlp.rate_limiter.max_retries = 0
+    batcher = nlp.PromptBatcher(nlp.GENERATION_SYSTEM_PROMPT, "Requests:", max_batch_size=4)
+    assert batcher.answer(nlp.API_KEY, nlp.MODEL, ["list customers", "list orders"]) == [None, None]
@@ -0,0 +1,49 @@
+import pytest
+
+
+def test_valid_candidate_beats_broken_ones(nlp):
+    ranked = nlp.rank_sql_candidates(["SELEC * FROM orders", "SELECT * FROM orders LIMIT 0, 10",
+                                      "SELECT * FROM orders LIMIT 10;"])
+    assert ranked[0] == "SELECT * FROM orders LIMIT 10;"
+
+
+def test_clean_candidate_beats_one_needing_rewrites(nlp):
+    ranked = nlp.rank_sql_candidates(["SELECT IFNULL(name, '') FROM users", "SELECT COALESCE(name, '') FROM users"])
+    assert ranked[0] == "SELECT COALESCE(name, '') FROM users"
+
+
+def test_consensus_breaks_ties_then_order(nlp):
+    ranked = nlp.rank_sql_candidates(["SELECT a FROM t", "SELECT b FROM t", "```sql\nSELECT  b FROM t\n```", ""])
+    assert ranked == ["SELECT b FROM t", "SELECT a FROM t"]
+    assert nlp.rank_sql_candidates(["SELECT a FROM t", "SELECT b FROM t"])[0] == "SELECT a FROM t"
+    assert nlp.rank_sql_candidates(["", "  "]) == []
+
+
+def test_schema_prefers_known_tables(nlp, monkeypatch):
+    monkeypatch.setattr(nlp, "schema_index", nlp.SchemaIndex({"customers": ["id", "name"]}))
+    ranked = nlp.rank_sql_candidates(["SELECT name FROM clients", "SELECT name FROM customers"])
+    assert ranked[0] == "SELECT name FROM customers"
+
+
+@pytest.mark.parametrize("supports_n, requests", [(True, 1), (False, 4)])
+def test_candidates_from_the_mock_server(nlp, mock_server, monkeypatch, supports_n, requests):
+    monkeypatch.setattr(nlp, "llm_backend", nlp.ChatBackend(nlp.llm_backend.base_url, supports_n=supports_n))
+    messages = [{"role": "system", "content": nlp.GENERATION_SYSTEM_PROMPT},
+                {"role": "user", "content": "Request: list all customers"}]
+
+    # Sampled candidates come back with typos or MySQL constructs every time
+    answers = nlp.request_sql_candidates(nlp.API_KEY, nlp.MODEL, messages, "generate:8", count=4, temperature=1.0)
+
+    assert len(answers) == 4
+    assert mock_server.stats()["requests"] == requests
+    assert nlp.rank_sql_candidates(answers)[0] == "SELECT * FROM customers LIMIT 10;"
+
+
+def test_generation_keeps_the_best_candidate(nlp, mock_server, monkeypatch):
+    monkeypatch.setattr(nlp, "llm_backend", nlp.ChatBackend(nlp.llm_backend.base_url, supports_n=True))
+    monkeypatch.setattr(nlp, "CANDIDATE_TEMPERATURE", 1.0)
+    items = [{"NL": f"List all {table}"} for table in ("customers", "orders", "products")]
+    results = list(nlp.iter_generate_sqls(items, concurrency=2, batch_size=1, candidates=3))
+    assert [result["Query"] for result in results] == [
+        "SELECT * FROM customers LIMIT 10;", "SELECT * FROM orders LIMIT 10;", "SELECT * FROM products LIMIT 10;"]
+    assert mock_server.stats()["requests"] == 3
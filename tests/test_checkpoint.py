@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+
+GENERATE_ITEMS = [{"NL": f"Show the names of customers in city number {i}."} for i in range(12)]
+CORRECT_ITEMS = [{"IncorrectQuery": f"SELECT name, COUNT(* FROM orders{i} GROUP name"} for i in range(12)]
+
+
+# Function to write the task inputs and return the keyword arguments main() needs
+def task_paths(directory, run):
+    """
+    :param directory: pytest tmp_path
+    :param run: Name of the run, which gets its own output files
+    :return: Dict of main() path arguments
+    """
+    for name, items in (("generate.json", GENERATE_ITEMS), ("correct.json", CORRECT_ITEMS)):
+        (directory / name).write_text(json.dumps(items))
+    return {"checkpoint_dir": str(directory / "checkpoints"), "processes": 1,
+            "input_file_path_1": str(directory / "generate.json"),
+            "input_file_path_2": str(directory / "correct.json"),
+            "output_file_path_1": str(directory / f"{run}_generate_out.json"),
+            "output_file_path_2": str(directory / f"{run}_correct_out.json")}
+
+
+# Function to make a task iterator stop the run after it has produced a number of items
+def interrupt_after(function, count):
+    def interrupted(*args, **kwargs):
+        for number, result in enumerate(function(*args, **kwargs)):
+            if number == count:
+                raise KeyboardInterrupt
+            yield result
+    return interrupted
+
+
+@pytest.mark.parametrize("task", ["iter_generate_sqls", "iter_correct_sqls"])
+def test_resumed_run_matches_uninterrupted_run(nlp, mock_server, monkeypatch, tmp_path, task):
+    baseline = task_paths(tmp_path, "baseline")
+    nlp.main(**baseline)
+    assert not (tmp_path / "checkpoints" / "generate.jsonl").exists()
+    assert not (tmp_path / "checkpoints" / "correct.jsonl").exists()
+
+    resumed = task_paths(tmp_path, "resumed")
+    original = getattr(nlp, task)
+    with monkeypatch.context() as patch:
+        patch.setattr(nlp, task, interrupt_after(original, 5))
+        with pytest.raises(KeyboardInterrupt):
+            nlp.main(**resumed)
+    # Both journals survive the interruption, including one whose task had already finished
+    assert (tmp_path / "checkpoints" / "generate.jsonl").exists()
+    assert (tmp_path / "checkpoints" / "correct.jsonl").exists()
+
+    requests_before = mock_server.stats()["requests"]
+    generate_requests = []
+
+    def counted_generation(*args, **kwargs):
+        yield from nlp_iter_generate_sqls(*args, **kwargs)
+        generate_requests.append(mock_server.stats()["requests"] - requests_before)
+
+    nlp_iter_generate_sqls = nlp.iter_generate_sqls
+    monkeypatch.setattr(nlp, "iter_generate_sqls", counted_generation)
+    nlp.main(resume=True, **resumed)
+
+    for output in ("generate_out.json", "correct_out.json"):
+        assert (tmp_path / f"resumed_{output}").read_bytes() == (tmp_path / f"baseline_{output}").read_bytes()
+    if task == "iter_correct_sqls":
+        assert generate_requests == [0]  # Generation was replayed entirely from its journal
+    assert not (tmp_path / "checkpoints" / "generate.jsonl").exists()
+    assert not (tmp_path / "checkpoints" / "correct.jsonl").exists()
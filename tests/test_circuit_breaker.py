@@ -0,0 +1,60 @@
+class FakeClock:
+    def __init__(self):
+        self.now = 500.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_half_opens_and_closes(nlp):
+    clock = FakeClock()
+    breaker = nlp.CircuitBreaker(failure_threshold=3, reset_timeout=30.0, clock=clock)
+
+    # Failures only count while consecutive
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+    clock.now += 29.9
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+    # Half-open lets exactly one trial through
+    clock.now += 0.1
+    assert breaker.state == "half-open"
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+    # A failed trial re-opens for a full timeout
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 29.0
+    assert not breaker.allow_request()
+    clock.now += 1.0
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+    # A successful trial closes the breaker for everyone
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+    assert breaker.allow_request()
+
+
+def test_trip_opens_immediately(nlp):
+    clock = FakeClock()
+    breaker = nlp.CircuitBreaker(failure_threshold=3, reset_timeout=10.0, clock=clock)
+    breaker.trip()
+    assert not breaker.allow_request()
+    clock.now += 10.0
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
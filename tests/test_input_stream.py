@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 7, 64])
+@pytest.mark.parametrize("items", [
+    [123, 4.5],
+    [1500.0],
+    [-1.25e-3, 1e10, True, False, None, "4.5", {"a": [1, 2.5]}],
+    [{"NL": f"Question {i}", "Query": f"SELECT {i}.{i}"} for i in range(305)],
+])
+def test_json_array_is_split_across_chunks(nlp, tmp_path, chunk_size, items):
+    path = tmp_path / "input.json"
+    path.write_text(json.dumps(items, indent=2))
+    assert list(nlp.iter_input_items(str(path), chunk_size=chunk_size)) == items
+
+
+def test_numbers_straddling_chunks_are_not_cut(nlp, tmp_path):
+    path = tmp_path / "input.json"
+    path.write_text(json.dumps([4.5, 305, 1500.0] * 100, indent=2))
+    for chunk_size in range(1, 12):
+        assert list(nlp.iter_input_items(str(path), chunk_size=chunk_size)) == [4.5, 305, 1500.0] * 100
+
+
+@pytest.mark.parametrize("text", ["[1, 2", "[4x]", "[1, {\"a\": 1]"])
+def test_malformed_array_is_rejected(nlp, tmp_path, text):
+    path = tmp_path / "input.json"
+    path.write_text(text)
+    with pytest.raises(ValueError):
+        list(nlp.iter_input_items(str(path), chunk_size=2))
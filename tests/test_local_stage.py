@@ -0,0 +1,28 @@
+def test_pool_matches_single_process_with_schema(nlp):
+    previous = nlp.schema_index
+    nlp.schema_index = nlp.SchemaIndex({"orders": ["id", "status", "Region"]})
+    try:
+        items = [{"IncorrectQuery": 'SELET * FROM orders o WHERE o.status = "Region"'},
+                 {"IncorrectQuery": 'SELET * FROM orders o WHERE o.status = "North"'}] * 50
+        single = list(nlp.iter_local_stage(nlp.classify_correction_item, items, processes=1))
+        pooled = list(nlp.iter_local_stage(nlp.classify_correction_item, items, processes=2,
+                                           chunk_size=16, min_items=1))
+    finally:
+        nlp.schema_index = previous
+
+    assert pooled == single
+    assert single[0][1] == ("fixed", 'SELECT * FROM orders o WHERE o.status = "Region";')
+    assert single[1][1] == ("fixed", "SELECT * FROM orders o WHERE o.status = 'North';")
+
+
+def test_pool_merges_worker_stage_timings(nlp):
+    previous = nlp.metrics
+    nlp.metrics = nlp.Metrics(jsonl_path=None, profiling=True)
+    try:
+        items = [{"IncorrectQuery": f"SELET name FORM t{i}"} for i in range(40)]
+        list(nlp.iter_local_stage(nlp.classify_correction_item, items, processes=2, chunk_size=8, min_items=1))
+        histograms = nlp.metrics.summary()["histograms"]
+    finally:
+        nlp.metrics = previous
+
+    assert histograms["local_stage_seconds[quick_fix]"]["count"] == 40
@@ -0,0 +1,36 @@
+import threading
+import time
+
+
+def test_completion_tokens_are_charged_to_their_own_request(nlp):
+    server = nlp.MockChatServer(latency_ms=200.0, latency_sigma=0.0, requests_per_minute=100, tokens_per_minute=10 ** 6)
+    short = {"messages": [{"role": "user", "content": "Request: list orders"}]}
+    long = {"messages": [{"role": "user", "content": "Request: list customer_subscription_renewal_notifications"}]}
+    usages = {}
+
+    def call(name, data):
+        usages[name] = server.respond(data)[2]["usage"]
+
+    first = threading.Thread(target=call, args=("long", long))
+    first.start()
+    time.sleep(0.05)  # The short request joins the window while the long one is still being answered
+    second = threading.Thread(target=call, args=("short", short))
+    second.start()
+    first.join()
+    second.join()
+
+    assert sorted(tokens for _, tokens in server.window) == sorted(
+        usage["total_tokens"] for usage in usages.values())
+    assert usages["long"]["completion_tokens"] != usages["short"]["completion_tokens"]
+
+
+def test_limits_are_enforced_with_headers(nlp):
+    server = nlp.MockChatServer(latency_ms=0.0, latency_sigma=0.0, requests_per_minute=2, tokens_per_minute=None)
+    data = {"messages": [{"role": "user", "content": "Request: list orders"}]}
+    statuses = [server.respond(data)[0] for _ in range(3)]
+    status, headers, _ = server.respond(data)
+
+    assert statuses == [200, 200, 429]
+    assert headers["x-ratelimit-remaining-requests"] == "0"
+    assert float(headers["retry-after"]) >= 1.0
+    assert server.stats()["throttled"] == 2
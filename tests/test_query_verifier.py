@@ -0,0 +1,31 @@
+import pytest
+
+TABLES = {"orders": ["id", "customer_id", "status", "created_at"], "products": ["id", "name", "price"]}
+
+
+def test_standin_needs_a_schema(nlp):
+    with pytest.raises(ValueError):
+        nlp.QueryVerifier("sqlite://")
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM orders WHERE created_at > now() - INTERVAL '7 days'",
+    "SELECT id::text FROM orders",
+    "SELECT * FROM products WHERE name ILIKE '%a%'",
+    "SELECT date_trunc('month', created_at) FROM orders",
+])
+def test_standin_does_not_fail_postgresql_syntax(nlp, query):
+    verifier = nlp.QueryVerifier("sqlite://", TABLES)
+    assert verifier.verify(query) is None
+    assert verifier.stats()["unchecked"] == 1
+
+
+@pytest.mark.parametrize("query, error", [
+    ("SELECT nme FROM products", "no such column: nme"),
+    ("SELECT * FROM customers", "no such table: customers"),
+])
+def test_standin_reports_unknown_names(nlp, query, error):
+    verifier = nlp.QueryVerifier("sqlite://", TABLES)
+    assert verifier.verify(query) == error
+    assert verifier.verify("SELECT name FROM products") is None
+    assert verifier.stats() == {"verified": 1, "failed": 1, "repaired": 0, "unchecked": 0}
@@ -0,0 +1,113 @@
+import pytest
+
+
+class FakeClock:
+    """Monotonic clock that only moves when the limiter sleeps."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+
+def make_limiter(nlp, requests_per_minute=60, tokens_per_minute=600, **options):
+    clock = FakeClock()
+    limiter = nlp.RateLimiter(requests_per_minute, tokens_per_minute, clock=clock, sleep=clock.sleep, **options)
+    return limiter, clock
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2m59.56s", 179.56), ("7.66s", 7.66), ("250ms", 0.25), ("1h", 3600.0), ("12", 12.0),
+    (None, None), ("soon", None),
+])
+def test_parse_reset_duration(nlp, value, expected):
+    assert nlp.parse_reset_duration(value) == (None if expected is None else pytest.approx(expected))
+
+
+@pytest.mark.parametrize("value, expected", [("14", 14.0), ("0.5", 0.5), (None, None), ("n/a", None)])
+def test_parse_header_number(nlp, value, expected):
+    assert nlp.parse_header_number(value) == expected
+
+
+def test_request_bucket_refills_over_time(nlp):
+    limiter, clock = make_limiter(nlp, requests_per_minute=60)
+    for _ in range(60):
+        limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(1.0)]  # One request per second at 60 RPM
+
+
+def test_token_bucket_refills_over_time(nlp):
+    limiter, clock = make_limiter(nlp, tokens_per_minute=600)
+    limiter.acquire(300)
+    limiter.acquire(300)
+    limiter.acquire(300)
+    assert clock.sleeps == [pytest.approx(30.0)]  # 300 tokens at 10 tokens per second
+
+
+def test_settled_usage_returns_unused_tokens(nlp):
+    limiter, clock = make_limiter(nlp, tokens_per_minute=600)
+    limiter.acquire(600)
+    limiter.record_usage(600, 100)
+    limiter.acquire(500)
+    assert clock.sleeps == []
+
+
+def test_remaining_headers_lower_the_buckets(nlp):
+    limiter, clock = make_limiter(nlp, requests_per_minute=60, tokens_per_minute=600)
+    limiter.update_from_headers({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2.5s",
+                                 "x-ratelimit-remaining-tokens": "100", "x-ratelimit-reset-tokens": "50s"})
+    limiter.acquire(100)
+    assert clock.sleeps == [pytest.approx(2.5)]  # Blocked until the request reset, tokens were enough
+    limiter.acquire(100)
+    assert clock.sleeps[1:] == [pytest.approx(7.5)]  # 100 reported + 25 refilled - 100 taken, 75 short
+
+
+def test_retry_after_holds_back_retries(nlp, mock_server):
+    mock_server.throttle_rate = 1.0
+    limiter, clock = make_limiter(nlp, requests_per_minute=600, tokens_per_minute=100000, max_retries=2,
+                                  base_backoff=0.0)
+    response, _ = nlp.post_with_rate_limit(nlp.llm_backend.chat_url, {}, {"messages": [], "max_tokens": 10},
+                                           limiter=limiter)
+    assert response.status_code == 429
+    assert response.retries == 2
+    assert clock.sleeps == [pytest.approx(1.0), pytest.approx(1.0)]
+    # Throttled attempts are not charged a request slot
+    assert limiter.request_tokens == pytest.approx(600.0, abs=1.0)
+
+
+def test_model_listing_goes_through_the_limiter(nlp, mock_server, monkeypatch):
+    limiter, clock = make_limiter(nlp, requests_per_minute=60)
+    monkeypatch.setattr(nlp, "rate_limiter", limiter)
+    assert nlp.verify_groq_api_connection(nlp.API_KEY, nlp.MODEL)
+    assert limiter.request_tokens == pytest.approx(59.0)
+
+
+def test_unreadable_body_settles_the_reservation(nlp, mock_server, monkeypatch):
+    limiter, clock = make_limiter(nlp, tokens_per_minute=10000)
+    monkeypatch.setattr(nlp, "rate_limiter", limiter)
+
+    class GatewayPage:
+        status_code = 502
+        headers = {}
+        text = "<html>Bad gateway</html>"
+
+        def json(self):
+            raise ValueError("not JSON")
+
+    class GatewayBackend(nlp.ChatBackend):
+        def post(self, api_key, data):
+            limiter.acquire(1000)
+            return GatewayPage(), 1000
+
+    monkeypatch.setattr(nlp, "llm_backend", GatewayBackend(nlp.llm_backend.base_url))
+    with pytest.raises(ValueError):
+        nlp.call_groq_api(nlp.API_KEY, nlp.MODEL, [{"role": "user", "content": "hi"}])
+    assert limiter.token_tokens == pytest.approx(10000.0)
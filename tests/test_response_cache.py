@@ -0,0 +1,70 @@
+import time
+
+
+def answer(text):
+    return {"choices": [{"message": {"content": text}, "finish_reason": "stop"}],
+            "usage": {"completion_tokens": 3}}
+
+
+def test_hits_misses_and_expiry(nlp, tmp_path):
+    cache = nlp.ResponseCache(str(tmp_path / "cache.sqlite"), ttl=0.2)
+    key = nlp.ResponseCache.make_key("m", [{"role": "user", "content": "hi"}], 0.0)
+    assert cache.get(key) is None
+    cache.put(key, answer("SELECT 1;"))
+    assert cache.get(key) == answer("SELECT 1;")
+
+    time.sleep(0.3)
+    assert cache.get(key) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "stores": 1, "evictions": 0, "hit_rate": 1 / 3}
+
+
+def test_least_recently_used_entry_is_evicted(nlp, tmp_path):
+    cache = nlp.ResponseCache(str(tmp_path / "cache.sqlite"), ttl=None, max_entries=2, evict_every=1)
+    cache.put("a", answer("a"))
+    time.sleep(0.01)
+    cache.put("b", answer("b"))
+    time.sleep(0.01)
+    assert cache.get("a") is not None  # a is now more recently used than b
+    time.sleep(0.01)
+    cache.put("c", answer("c"))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_key_ignores_whitespace_but_not_endpoint(nlp):
+    messages = [{"role": "user", "content": "List  all\ncustomers"}]
+    same = [{"role": "user", "content": "List all customers"}]
+    assert nlp.ResponseCache.make_key("m", messages, 0.0) == nlp.ResponseCache.make_key("m", same, 0.0)
+    assert nlp.ResponseCache.make_key("m", messages, 0.0, "http://a") != \
+        nlp.ResponseCache.make_key("m", messages, 0.0, "http://b")
+
+
+def test_repeated_call_is_served_from_the_cache(nlp, mock_server, monkeypatch, tmp_path):
+    cache = nlp.ResponseCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(nlp, "response_cache", cache)
+    messages = [{"role": "user", "content": "Convert to PostgreSQL: list all customers"}]
+
+    first, _ = nlp.call_groq_api(nlp.API_KEY, nlp.MODEL, messages)
+    second, _ = nlp.call_groq_api(nlp.API_KEY, nlp.MODEL, messages)
+    assert second == first
+    assert mock_server.stats()["requests"] == 1
+    assert cache.stats()["hits"] == 1
+
+    # Sampled calls are never cached
+    nlp.call_groq_api(nlp.API_KEY, nlp.MODEL, messages, temperature=0.5)
+    assert mock_server.stats()["requests"] == 2
+
+
+def test_truncated_answer_is_not_cached(nlp, mock_server, monkeypatch, tmp_path):
+    cache = nlp.ResponseCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(nlp, "response_cache", cache)
+    messages = [{"role": "user", "content": "Convert to PostgreSQL: list customer_subscription_renewals"}]
+
+    cut, _ = nlp.call_groq_api(nlp.API_KEY, nlp.MODEL, messages, max_tokens=2)
+    assert cut["choices"][0]["finish_reason"] == "length"
+    nlp.call_groq_api(nlp.API_KEY, nlp.MODEL, messages, max_tokens=2)
+    assert mock_server.stats()["requests"] == 2
+    assert cache.stats()["stores"] == 0
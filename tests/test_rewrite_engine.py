@@ -0,0 +1,94 @@
+import pytest
+
+
+@pytest.mark.parametrize("query, expected", [
+    # Quoted identifiers stay identifiers
+    ('SELECT * FROM t1 JOIN t2 ON t1.a = "OtherCol"', 'SELECT * FROM t1 JOIN t2 ON t1.a = "OtherCol";'),
+    ('SELECT * FROM t WHERE a = "user_id"', 'SELECT * FROM t WHERE a = "user_id";'),
+    ('SELECT * FROM t WHERE x = "t"."col"', 'SELECT * FROM t WHERE x = "t"."col";'),
+    ('SELECT * FROM "Orders" WHERE "Orders"."CustomerId" = c."Id"',
+     'SELECT * FROM "Orders" WHERE "Orders"."CustomerId" = c."Id";'),
+    ('SELECT "first_name" || \' \' || "last_name" FROM t', 'SELECT "first_name" || \' \' || "last_name" FROM t;'),
+    # Double-quoted values become string literals
+    ('SELECT * FROM orders WHERE status = "shipped"', "SELECT * FROM orders WHERE status = 'shipped';"),
+    ('SELECT * FROM customers WHERE city = "Berlin"', "SELECT * FROM customers WHERE city = 'Berlin';"),
+    ('SELECT * FROM t WHERE name IN ("a", "b")', "SELECT * FROM t WHERE name IN ('a', 'b');"),
+    # Nested CONCAT and SUBSTRING
+    ('SELECT CONCAT(SUBSTRING(name, 1, 3), CONCAT("-", id)) FROM users',
+     "SELECT (SUBSTRING(name, 1, 3) || ('-' || id)) FROM users;"),
+    ('SELECT SUBSTRING(CONCAT(first, last), 1, 5) FROM users', 'SELECT SUBSTRING((first || last), 1, 5) FROM users;'),
+    # Keywords inside identifiers are not split off
+    ('SELECT USER_FROM, COUNT(*)FROM t GROUP BY USER_FROM', 'SELECT USER_FROM, COUNT(*) FROM t GROUP BY USER_FROM;'),
+    ('SELECT USER_FROM FROM logs WHERE USER_FROM = "admin"', "SELECT USER_FROM FROM logs WHERE USER_FROM = 'admin';"),
+    ('SELECT nameFROM users', 'SELECT name FROM users;'),
+])
+def test_quick_fix(nlp, query, expected):
+    assert nlp.attempt_quick_postgresql_fix(query) == expected
+
+
+@pytest.mark.parametrize("query, expected", [
+    ('SELECT CONCAT(SUBSTRING(name, 1, 3), CONCAT("-", id)) FROM users',
+     'SELECT CONCAT(SUBSTRING(name FROM 1 FOR 3), CONCAT("-", id)) FROM users'),
+    ('SELECT SUBSTRING(CONCAT(first, last), 1, 5) FROM users',
+     'SELECT SUBSTRING(CONCAT(first, last) FROM 1 FOR 5) FROM users'),
+    ('SELECT USER_FROM FROM logs', 'SELECT USER_FROM FROM logs'),
+])
+def test_compatibility(nlp, query, expected):
+    assert nlp.ensure_postgresql_compatibility(query) == expected
+
+
+def test_schema_columns_stay_identifiers(nlp):
+    previous = nlp.schema_index
+    nlp.schema_index = nlp.SchemaIndex({"orders": ["id", "status", "Region"]})
+    try:
+        assert nlp.attempt_quick_postgresql_fix('SELECT * FROM orders o WHERE o.status = "Region"') == \
+            'SELECT * FROM orders o WHERE o.status = "Region";'
+        assert nlp.attempt_quick_postgresql_fix('SELECT * FROM orders o WHERE o.status = "North"') == \
+            "SELECT * FROM orders o WHERE o.status = 'North';"
+    finally:
+        nlp.schema_index = previous
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT CONCAT(first_name, ' ', last_name) FROM customers;",
+    'SELECT "Col" FROM t WHERE "Col" > 1;',
+    "SELECT USER_FROM FROM logs",
+])
+def test_valid_query_is_returned_unchanged(nlp, query):
+    assert nlp.classify_sql_correction(query) == ("valid", query)
+
+
+def test_broken_query_is_fixed_locally(nlp):
+    assert nlp.classify_sql_correction("SELET name FORM customers") == ("fixed", "SELECT name FROM customers;")
+
+
+def test_tagged_dollar_quote_is_one_token(nlp):
+    body = "$fn$ SELECT 'a;b'; $$x$$ $fn$"
+    sql_query = f"CREATE FUNCTION f() RETURNS text AS {body} LANGUAGE sql"
+    assert body in nlp.tokenize_sql(sql_query)
+    assert nlp.validate_postgresql(sql_query) == []
+    assert nlp.attempt_quick_postgresql_fix(sql_query) == sql_query + ";"
+    assert nlp.attempt_quick_postgresql_fix("SELECT $body$ it's") == "SELECT $body$ it's$body$;"
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT * FROM t WHERE FORM = 1", "SELECT * FROM t WHERE FORM = 1;"),
+    ("SELECT FORM, WERE FROM t", "SELECT FORM, WERE FROM t;"),
+    ("SELECT x AS FORM FROM t", "SELECT x AS FORM FROM t;"),
+    ("SELECT a, b FORM t WERE a = 1 GRUOP BY a ODER BY a DESC LIMT 5",
+     "SELECT a, b FROM t WHERE a = 1 GROUP BY a ORDER BY a DESC LIMIT 5;"),
+    ("SELECT * FROM a LEFT JION b ON a.x = b.x", "SELECT * FROM a LEFT JOIN b ON a.x = b.x;"),
+    ("SELECT * FORM t WHERE x IN (SELET y FORM u)", "SELECT * FROM t WHERE x IN (SELECT y FROM u);"),
+])
+def test_keyword_typos_only_in_keyword_position(nlp, query, expected):
+    assert nlp.attempt_quick_postgresql_fix(query) == expected
+
+
+def test_column_named_like_a_typo_is_valid(nlp):
+    assert nlp.validate_postgresql("SELECT * FROM t WHERE FORM = 1") == []
+
+
+def test_many_variants_match_single_queries(nlp):
+    queries = nlp.make_synthetic_queries(200, seed=1)
+    assert nlp.attempt_quick_postgresql_fix_many(queries) == [nlp.attempt_quick_postgresql_fix(q) for q in queries]
+    assert nlp.ensure_postgresql_compatibility_many(queries) == [nlp.ensure_postgresql_compatibility(q) for q in queries]
@@ -0,0 +1,13 @@
+def test_context_quotes_mixed_case_identifiers(nlp):
+    index = nlp.SchemaIndex({"customers": ["id", "firstName"], "Sales.Orders": ["ID", "customer_id"]})
+    context = index.context("first names of customers with orders")
+    assert 'customers(id, "firstName")' in context
+    assert '"Sales"."Orders"("ID", customer_id)' in context
+
+
+def test_ddl_folds_unquoted_names_like_postgresql(nlp):
+    tables = nlp.SchemaIndex.parse_ddl(
+        'CREATE TABLE Sales."Orders" (Id int, "firstName" text, [Last] text, total numeric(10, 2));'
+    )
+    assert tables == {'sales.Orders': ['id', 'firstName', 'last', 'total']}
+    assert nlp.SchemaIndex(tables).context("orders") == 'sales."Orders"(id, "firstName", last, total)'
@@ -0,0 +1,91 @@
+import itertools
+
+import pytest
+
+PARAPHRASES = [
+    ("Get the top 10 products by sales volume", "10 best-selling products"),
+    ("top 10 products by sales", "10 best-selling products"),
+    ("List all customers from Berlin", "Show customers located in Berlin"),
+    ("How many orders were placed in 2023?", "Count the orders placed in 2023"),
+    ("Find all employees in the sales department", "Show employees who work in the sales department"),
+    ("What is the average price of products?", "Average product price"),
+    ("List the 5 most expensive products", "Show the top 5 products by price"),
+    ("Show all orders with status shipped", "List orders whose status is shipped"),
+    ("Get the names of all customers", "List customer names"),
+    ("Total amount of payments per customer", "Sum of payment amounts for each customer"),
+]
+
+DIFFERENT_INTENT = [
+    ("List all customers from Berlin", "List all orders from Berlin"),
+    ("Top 10 products by sales", "Bottom 10 products by sales"),
+    ("How many orders were placed in 2023?", "How many customers signed up in 2023?"),
+    ("Average price of products", "Maximum price of products"),
+    ("Show employees in the sales department", "Show employees in the marketing department"),
+    ("List customers with more than 5 orders", "List customers with no orders"),
+    ("Total amount of payments per customer", "Total amount of payments per month"),
+    ("Get the names of all customers", "Get the emails of all customers"),
+]
+
+BACKGROUND = [
+    "List all products",
+    "Show orders from last month",
+    "Count employees per department",
+    "Average salary by department",
+    "Top 3 suppliers by revenue",
+    "List product categories",
+]
+
+
+def make_cache(nlp, cached_question, **options):
+    cache = nlp.SemanticCache(None, **options)
+    for question in BACKGROUND:
+        cache.add(question, "SELECT 1")
+    cache.add(cached_question, "SELECT 'cached'")
+    return cache
+
+
+@pytest.mark.parametrize("cached_question, question", PARAPHRASES)
+def test_paraphrase_hits(nlp, cached_question, question):
+    assert make_cache(nlp, cached_question).lookup(question) == "SELECT 'cached'"
+
+
+@pytest.mark.parametrize("cached_question, question", DIFFERENT_INTENT)
+def test_different_intent_misses(nlp, cached_question, question):
+    assert make_cache(nlp, cached_question).lookup(question) is None
+
+
+def test_numbers_are_adapted(nlp):
+    cache = nlp.SemanticCache(None)
+    cache.add("Top 10 products by sales", "SELECT name FROM products ORDER BY sales DESC LIMIT 10")
+    assert cache.lookup("5 best-selling products") == "SELECT name FROM products ORDER BY sales DESC LIMIT 5"
+
+
+def test_full_cache_evicts_oldest(nlp, tmp_path):
+    path = str(tmp_path / "semantic.jsonl")
+    cache = nlp.SemanticCache(path, max_entries=3)
+    questions = ["List customers", "List orders", "List products", "List suppliers", "List employees"]
+    for question in questions:
+        cache.add(question, f"SELECT '{question}'")
+
+    assert cache.stats()["entries"] == 3
+    assert cache.stats()["evicted"] == 2
+    assert cache.lookup("Show customers") is None
+    assert cache.lookup("Show employees") == "SELECT 'List employees'"
+
+    # The compacted file reloads to the same entries
+    reloaded = nlp.SemanticCache(path, max_entries=3)
+    assert reloaded.lookup("Show orders") is None
+    assert reloaded.lookup("Show suppliers") == "SELECT 'List suppliers'"
+
+
+def test_index_never_grows_past_max_entries(nlp):
+    regions = ["".join(letters) for letters in itertools.product("abcdefghij", repeat=3)]
+    cache = nlp.SemanticCache(None, max_entries=100)
+    for region in regions:
+        cache.add(f"List customers in region {region}", f"SELECT * FROM customers WHERE region = '{region}'")
+    cache.add("List customers in region jjj", "SELECT 'newest'")
+
+    assert len(cache.entries) == 100
+    assert cache.stats()["evicted"] == 900
+    assert cache.lookup("Show customers in region jjj") == "SELECT 'newest'"
+    assert cache.lookup("Show customers in region aaa") is None
@@ -0,0 +1,83 @@
+import io
+import json
+import threading
+
+import pytest
+import requests
+
+
+@pytest.fixture
+def service(nlp, mock_server):
+    services = []
+
+    def make(**options):
+        services.append(nlp.SqlService(**options))
+        return services[-1]
+
+    yield make
+    for started in services:
+        started.close()
+
+
+def test_identical_concurrent_requests_share_one_call(nlp, mock_server, service):
+    sql_service = service(batch_window_ms=10)
+    url = sql_service.start(port=0)
+    barrier = threading.Barrier(20)
+    answers = []
+
+    def ask():
+        barrier.wait()
+        answers.append(requests.post(f"{url}/generate", json={"NL": "List all customers"}, timeout=30).json())
+
+    threads = [threading.Thread(target=ask) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert answers == [{"NL": "List all customers", "Query": "SELECT * FROM customers LIMIT 10;"}] * 20
+    assert mock_server.stats()["requests"] == 1
+    assert sql_service.stats()["coalesced"] == 19
+
+
+def test_requests_in_one_window_share_a_micro_batch(nlp, mock_server, service):
+    sql_service = service(batch_window_ms=500, max_batch_items=8, batch_size=8)
+    tables = ["customers", "orders", "products", "suppliers", "employees", "invoices", "payments", "regions"]
+    futures = [sql_service.submit("generate", {"NL": f"List all {table}"}) for table in tables]
+
+    results = [future.result(30) for future in futures]
+
+    assert [result["Query"] for result in results] == [f"SELECT * FROM {table} LIMIT 10;" for table in tables]
+    assert sql_service.stats()["batches"] == 1
+    assert mock_server.stats()["requests"] == 1  # All eight questions went out in one batched prompt
+
+
+def test_full_micro_batch_is_sent_without_waiting(nlp, mock_server, service):
+    sql_service = service(batch_window_ms=60000, max_batch_items=2)
+    futures = [sql_service.submit("generate", {"NL": f"List all {table}"}) for table in ("orders", "products")]
+    assert [future.result(10)["Query"] for future in futures] == [
+        "SELECT * FROM orders LIMIT 10;", "SELECT * FROM products LIMIT 10;"]
+
+
+def test_bad_item_in_a_list_fails_alone(nlp, mock_server, service):
+    url = service().start(port=0)
+    answer = requests.post(f"{url}/correct", json=[{"IncorrectQuery": "SELET * FORM orders"}, {"NL": 5}],
+                           timeout=30).json()
+    assert answer == [{"IncorrectQuery": "SELET * FORM orders", "CorrectQuery": "SELECT * FROM orders;"},
+                      {"error": "NL must be a string"}]
+    assert requests.post(f"{url}/generate", json=[1], timeout=30).status_code == 200
+    assert requests.post(f"{url}/generate", json="x", timeout=30).status_code == 400
+
+
+def test_jsonl_answers_echo_the_request_id(nlp, mock_server, service):
+    lines = [{"id": 1, "task": "generate", "NL": "List all customers"},
+             {"id": 2, "task": "correct", "IncorrectQuery": "SELET * FORM orders"},
+             {"id": 3, "task": "unknown"}]
+    output = io.StringIO()
+    answered = service().serve_jsonl(io.StringIO("\n".join(json.dumps(line) for line in lines)), output)
+
+    answers = {answer["id"]: answer for answer in map(json.loads, output.getvalue().splitlines())}
+    assert answered == 2
+    assert answers[1]["Query"] == "SELECT * FROM customers LIMIT 10;"
+    assert answers[2]["CorrectQuery"] == "SELECT * FROM orders;"
+    assert answers[3]["error"] == "Invalid request: Unknown task: unknown"
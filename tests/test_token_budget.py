@@ -0,0 +1,33 @@
+def test_truncated_answer_is_retried_with_a_larger_budget(nlp, mock_server, monkeypatch):
+    budgets = []
+
+    class RecordingBackend(nlp.ChatBackend):
+        def post(self, api_key, data):
+            budgets.append(data['max_tokens'])
+            return super().post(api_key, data)
+
+    monkeypatch.setattr(nlp, "llm_backend", RecordingBackend(nlp.llm_backend.base_url))
+    budget = nlp.TokenBudget(path=None, default_tokens=256, min_tokens=4, min_samples=1)
+    monkeypatch.setattr(nlp, "token_budget", budget)
+    question = "List every row of customer_subscription_renewal_notifications"
+    kind = budget.kind("generate", question)
+    budget.record(kind, 1)  # Learned budget of 9 tokens, too small for any query
+    messages = [{"role": "user", "content": f"Convert to PostgreSQL: {question}"}]
+
+    response, _ = nlp.call_with_budget(nlp.API_KEY, nlp.MODEL, messages, kind)
+
+    assert budgets == [9, 256]
+    assert response["choices"][0]["finish_reason"] == "stop"
+    assert budget.truncated == 1
+    # Only the complete answer becomes a sample
+    assert list(budget.samples[kind]) == [1, response["usage"]["completion_tokens"]]
+
+
+def test_budget_follows_observed_lengths(nlp):
+    budget = nlp.TokenBudget(path=None, default_tokens=512, min_tokens=16, min_samples=5, headroom=1.25)
+    assert budget.budget("correct:64") == 512
+    for tokens in (20, 30, 40, 50, 60):
+        budget.record("correct:64", tokens)
+    assert budget.budget("correct:64") == int(60 * 1.25) + 8
+    assert budget.retry_budget(83) == 512
+    assert budget.retry_budget(budget.max_tokens) is None
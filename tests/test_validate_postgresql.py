@@ -0,0 +1,33 @@
+import pytest
+
+
+INVALID = [
+    ("SELECT * FROM t WHERE a == 1", "'==' is not an operator"),
+    ("SELECT * FROM t WHERE a = 1 b = 2", "missing AND, OR or comma before 'b'"),
+    ("SELECT * FROM t WHERE \"a\" = 'x' \"b\" = 2", "missing AND, OR or comma before '\"b\"'"),
+    ("UPDATE t SET a = 1 b = 2", "missing AND, OR or comma before 'b'"),
+    ("SELECT * FROM t JOIN u WHERE t.id = 1", "JOIN without ON or USING"),
+    ("SELECT * FROM t LEFT JOIN u JOIN v ON v.id = t.id", "JOIN without ON or USING"),
+    ("INSERT t VALUES (1)", "INSERT without INTO"),
+    ("DELETE t WHERE id = 1", "DELETE without FROM"),
+]
+
+VALID = [
+    "SELECT * FROM t WHERE a = 1 AND b = 2",
+    "SELECT * FROM t JOIN u USING (id) JOIN LATERAL (SELECT 1) x ON true WHERE t.a = 'x'",
+    "SELECT * FROM t CROSS JOIN u NATURAL JOIN v",
+    "SELECT * FROM t JOIN (u JOIN v ON v.id = u.id) ON u.id = t.id",
+    "WITH d AS (DELETE FROM t RETURNING *) INSERT INTO x SELECT * FROM d",
+    "UPDATE t SET a = 1, b = 2 WHERE x::int = 3 AND y COLLATE \"C\" = 'z'",
+    "SELECT * FROM t WHERE a >= 1 OR b <> c",
+]
+
+
+@pytest.mark.parametrize("sql_query, problem", INVALID)
+def test_invalid_query_is_rejected(nlp, sql_query, problem):
+    assert problem in nlp.validate_postgresql(sql_query)
+
+
+@pytest.mark.parametrize("sql_query", VALID)
+def test_valid_query_passes(nlp, sql_query):
+    assert nlp.validate_postgresql(sql_query) == []